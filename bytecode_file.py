@@ -0,0 +1,328 @@
+'''
+cilly 字节码文件 (.cillyc)
+
+把 cilly_vm_compiler 产生的 (code, consts, scopes) 保存成二进制文件, 下次运行直接装入,
+不再词法分析、语法分析和编译. 所有整数都是小端序, 文件布局:
+
+    头部    magic 'CILC', 格式版本, 源码哈希, 编译器版本哈希, 各段的长度
+    函数段  每个代码对象 9 个 u32: 指令段中的 (起始下标, 指令个数), 常量段中的 (起始下标, 常量个数),
+            参数个数, 槽位个数, 栈深度, 名字在字符串区中的 (offset, 长度). 第 0 个是主程序
+    指令段  int32 数组, 各个代码对象的指令依次排列
+    常量段  每个常量 12 字节: 类型 u32 + 8 字节内容, 同一个代码对象的常量连续排列
+            CONST_INT    int64
+            CONST_FLOAT  double
+            CONST_BIGNUM 超出 int64 的整数, 十进制文本在字符串区中的 (offset, 长度)
+            CONST_STR    字符串区中的 (offset, 长度)
+            CONST_CODE   函数段中的下标
+    作用域段 每个作用域的变量个数 u32, 之后是每个变量名在字符串区中的 (offset, 长度)
+    字符串区 utf-8 编码的字符串
+
+装入时指令是映射到内存中的文件之上的 memoryview, 不复制也不解析,
+cilly_vm 可以直接执行. 常量装入为 int / float / str 和指令为 memoryview 的 CodeObject.
+load 返回的 MappedProgram 用完后要 close() 释放映射.
+'''
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import traceback
+from array import array
+from functools import lru_cache
+
+from compile_cache import compiler_version
+from lexical_analyzer import error, cilly_lexer
+from syntactic_analyzer import cilly_parser
+from vm import cilly_vm_compiler, CodeObject
+
+MAGIC = b'CILC'
+# 文件布局变化时加一
+FORMAT_VERSION = 2
+
+CONST_INT = 1
+CONST_FLOAT = 2
+CONST_BIGNUM = 3
+CONST_STR = 4
+CONST_CODE = 5
+
+# magic, 格式版本, 保留, 源码哈希, 编译器版本哈希,
+# 代码对象个数, 指令总数, 常量个数, 作用域个数, 变量名个数, 字符串区字节数
+HEADER = struct.Struct('<4sHH32s32sIIIIII')
+CONST_INT_RECORD = struct.Struct('<Iq')
+CONST_FLOAT_RECORD = struct.Struct('<Id')
+CONST_REF_RECORD = struct.Struct('<III')
+CONST_RECORD_SIZE = 12
+FUNCTION_RECORD = struct.Struct('<9I')
+CONST_KIND = struct.Struct('<I')
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+def err(msg):
+    error('cilly bytecode', msg)
+
+
+def source_hash(source):
+    return hashlib.sha256(source.encode('utf-8', 'surrogatepass')).digest()
+
+
+@lru_cache(maxsize=None)
+def compiler_hash():
+    """编译器版本, 与编译缓存使用同一个哈希, 每个进程只计算一次"""
+    return bytes.fromhex(compiler_version())
+
+
+def dumps(code, consts, scopes, source=None):
+    """把 cilly_vm_compiler 的结果编码成 .cillyc 文件的内容"""
+    functions = []
+    words = array('i')
+    records = []
+    blob = bytearray()
+
+    def add_str(s):
+        b = s.encode('utf-8', 'surrogatepass')
+        offset = len(blob)
+        blob.extend(b)
+        return offset, len(b)
+
+    def add_const(c):
+        # 函数常量是 CodeObject, 其余是数或字符串
+        if isinstance(c, CodeObject):
+            return CONST_REF_RECORD.pack(CONST_CODE, add_function(c), 0)
+
+        if isinstance(c, str):
+            return CONST_REF_RECORD.pack(CONST_STR, *add_str(c))
+        elif isinstance(c, bool) or not isinstance(c, (int, float)):
+            err(f'非法常量{c}')
+        elif isinstance(c, float):
+            return CONST_FLOAT_RECORD.pack(CONST_FLOAT, c)
+        elif INT64_MIN <= c <= INT64_MAX:
+            return CONST_INT_RECORD.pack(CONST_INT, c)
+        else:
+            return CONST_REF_RECORD.pack(CONST_BIGNUM, *add_str(str(c)))
+
+    def add_function(c):
+        index = len(functions)
+        functions.append(None)
+        code_start = len(words)
+        words.extend(c.code)
+        # 先占住自己的常量位置, 内层函数的常量排在后面
+        const_start = len(records)
+        records.extend([None] * len(c.consts))
+        for i, v in enumerate(c.consts):
+            records[const_start + i] = add_const(v)
+        functions[index] = FUNCTION_RECORD.pack(code_start, len(c.code), const_start, len(c.consts),
+                                                c.nparams, c.nlocals, c.max_stack, *add_str(c.name))
+        return index
+
+    add_function(CodeObject(code, consts, 0, 0, 0, '<program>'))
+
+    counts = array('I', [len(scope) for scope in scopes])
+    names = array('I')
+    for scope in scopes:
+        for name in scope:
+            names.extend(add_str(name))
+
+    if sys.byteorder != 'little':
+        for a in (words, counts, names):
+            a.byteswap()
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0,
+                         source_hash(source) if source is not None else bytes(32), compiler_hash(),
+                         len(functions), len(words), len(records), len(scopes), len(names) // 2, len(blob))
+    return b''.join([header, *functions, words.tobytes(), *records, counts.tobytes(), names.tobytes(),
+                     bytes(blob)])
+
+
+def dump(path, code, consts, scopes, source=None):
+    data = dumps(code, consts, scopes, source)
+    # 先写临时文件再改名, 其他进程不会读到写了一半的文件
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def read_header(data):
+    if len(data) < HEADER.size:
+        err('文件太短')
+    (magic, version, _, src_hash, comp_hash,
+     n_functions, code_len, n_consts, n_scopes, n_names, blob_size) = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        err('不是cilly字节码文件')
+    if version != FORMAT_VERSION:
+        err(f'不支持的格式版本{version}')
+    size = (HEADER.size + FUNCTION_RECORD.size * n_functions + 4 * code_len + CONST_RECORD_SIZE * n_consts +
+            4 * n_scopes + 8 * n_names + blob_size)
+    if len(data) != size or n_functions == 0:
+        err('文件已损坏')
+    return src_hash, comp_hash, n_functions, code_len, n_consts, n_scopes, n_names, blob_size
+
+
+def loads(data, source=None):
+    """从 .cillyc 文件的内容中装入 (code, consts, scopes)
+
+    data 可以是 bytes 或 mmap, 指令段是 data 之上的 memoryview, 不复制.
+    文件必须由当前的编译器生成, 否则其中的 opcode 编号等可能已经不同. 给出 source 时还检查文件是否由这份源码生成.
+    """
+    src_hash, comp_hash, n_functions, code_len, n_consts, n_scopes, n_names, _ = read_header(data)
+    if comp_hash != compiler_hash():
+        err('字节码文件由其他版本的编译器生成')
+    if source is not None and src_hash != source_hash(source):
+        err('字节码文件与源码不一致')
+
+    functions = [FUNCTION_RECORD.unpack_from(data, HEADER.size + FUNCTION_RECORD.size * i)
+                 for i in range(n_functions)]
+
+    view = memoryview(data)
+    offset = HEADER.size + FUNCTION_RECORD.size * n_functions
+    words = view[offset:offset + 4 * code_len]
+    if sys.byteorder == 'little':
+        words = words.cast('i')
+    else:
+        words = array('i', words)
+        words.byteswap()
+    offset = offset + 4 * code_len
+    consts_start = offset
+
+    blob_start = offset + CONST_RECORD_SIZE * n_consts + 4 * n_scopes + 8 * n_names
+
+    def get_str(start, length):
+        start = blob_start + start
+        return str(data[start:start + length], 'utf-8', 'surrogatepass')
+
+    def get_const(i, owner):
+        offset = consts_start + CONST_RECORD_SIZE * i
+        kind = CONST_KIND.unpack_from(data, offset)[0]
+        if kind == CONST_INT:
+            return CONST_INT_RECORD.unpack_from(data, offset)[1]
+        elif kind == CONST_FLOAT:
+            return CONST_FLOAT_RECORD.unpack_from(data, offset)[1]
+        _, a, b = CONST_REF_RECORD.unpack_from(data, offset)
+        if kind == CONST_STR:
+            return get_str(a, b)
+        elif kind == CONST_BIGNUM:
+            return int(get_str(a, b))
+        # 内层函数总是排在外层函数之后, 损坏的文件也不会引起无限递归
+        elif kind == CONST_CODE and owner < a < n_functions:
+            return get_function(a)
+        err(f'非法常量类型{kind}')
+
+    def get_function(index):
+        code_start, length, const_start, const_count, nparams, nlocals, max_stack, *name = functions[index]
+        if code_start + length > code_len or const_start + const_count > n_consts:
+            err('文件已损坏')
+        consts = [get_const(i, index) for i in range(const_start, const_start + const_count)]
+        return CodeObject(words[code_start:code_start + length], consts, nparams, nlocals, max_stack,
+                          get_str(*name))
+
+    try:
+        program = get_function(0)
+    finally:
+        # get_const 和 get_function 互相引用, 要等垃圾回收才释放. 先释放它们引用的 memoryview,
+        # 映射上就只剩下各个代码对象的指令, MappedProgram.close() 才能关闭映射
+        view.release()
+        if isinstance(words, memoryview):
+            words.release()
+    offset = consts_start + CONST_RECORD_SIZE * n_consts
+
+    counts = struct.unpack_from(f'<{n_scopes}I', data, offset)
+    offset = offset + 4 * n_scopes
+    names = struct.unpack_from(f'<{2 * n_names}I', data, offset)
+    if sum(counts) != n_names:
+        err('文件已损坏')
+
+    scopes = []
+    i = 0
+    for count in counts:
+        scopes.append([get_str(names[2 * j], names[2 * j + 1]) for j in range(i, i + count)])
+        i = i + count
+
+    return program.code, program.consts, scopes
+
+
+class MappedProgram(tuple):
+    """load 装入的 (code, consts, scopes), 可以像元组一样解包
+
+    指令是映射到内存中的文件之上的 memoryview, 映射在 close() 时释放, 也可以用 with 语句:
+
+        with bytecode_file.load(path) as (code, consts, scopes):
+            cilly_vm(code, consts, scopes)
+
+    close() 之后这些指令不能再使用. 不调用 close() 时映射要等所有指令都被回收后才释放,
+    在这之前 Windows 上不能改写或删除这个文件.
+    """
+
+    def __new__(cls, program, data=None):
+        self = super().__new__(cls, program)
+        self.data = data
+        return self
+
+    def close(self):
+        if self.data is None:
+            return
+
+        def release(code, consts):
+            if isinstance(code, memoryview):
+                code.release()
+            for c in consts:
+                if isinstance(c, CodeObject):
+                    release(c.code, c.consts)
+
+        code, consts, _ = self
+        release(code, consts)
+        self.data.close()
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load(path, source=None):
+    """把 .cillyc 文件映射进内存后装入, 返回 MappedProgram, 用完后 close() 释放映射, 之前不要改写这个文件"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            err('文件太短')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return MappedProgram(loads(data, source), data)
+    except BaseException as e:
+        # 异常的 traceback 引用着 loads 的栈帧, 先清掉其中指向映射的 memoryview 才能关闭
+        traceback.clear_frames(e.__traceback__)
+        data.close()
+        raise
+
+
+def compile_file(path):
+    """编译源文件, 结果保存在旁边的 .cillyc 文件中; 源码和编译器都没有变时直接装入
+
+    返回 MappedProgram, 与 load 一样用完后 close(), 重新编译时 close() 什么也不做.
+    """
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+
+    bytecode_path = os.path.splitext(path)[0] + '.cillyc'
+    try:
+        return load(bytecode_path, source)
+    except Exception:
+        pass
+
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    try:
+        dump(bytecode_path, code, consts, scopes, source)
+    except OSError:
+        pass
+    return MappedProgram((code, consts, scopes))
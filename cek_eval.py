@@ -0,0 +1,471 @@
+'''
+cilly cek eval: 不递归的解释器, 控制、环境和续延都放在堆上
+
+cilly_eval 把 cilly 的递归映射成 Python 的递归, 每层 cilly 调用要嵌套 visit -> ev_call -> visit(body)
+-> ev_block ... 好几层 Python 栈帧, 递归几百层就 RecursionError. 这里按 CEK 机器的方式执行:
+要做的事是续延栈 todo 上的 (续延, 参数), 子表达式的值放在值栈 vals 上. 每一步弹出一个续延执行,
+它可以压入值, 也可以再压入续延, 例如 binary 先压入 "算右边" 的续延再压入 "算左边".
+每一步都回到主循环, Python 栈的深度是常数, cilly 递归的深度只受内存限制, 上百万层也可以.
+
+与 eval.py 中的 cilly_eval 语义相同 (动态作用域, 块不建立新环境, return 不中断块等都一样).
+函数调用中定义的变量 (包括参数) 与 closure_eval 一样用浅绑定: 每个变量名当前的值在一个字典中,
+调用返回时恢复被覆盖的值, 查找变量不必沿着调用链逐层查找, 调用也不新建 Environment.
+最外层程序的变量直接定义在传入的 Environment 中.
+
+主循环每 CHUNK 步才检查一次 interrupt 标志, 所以可以很便宜地单步执行、限定步数执行、
+在信号处理函数或别的线程中调用 interrupt() 暂停, 之后再调用 run 从停下的地方继续.
+'''
+
+from itertools import repeat
+
+from lexical_analyzer import error
+from eval import mk_proc, val, define_var, NULL, TRUE, FALSE, BREAK, CONTINUE, Environment, Proc, Primitive
+
+# 主循环每执行 CHUNK 步检查一次是否要暂停
+CHUNK = 1000
+
+# 浅绑定中没有定义的变量
+UNBOUND = object()
+
+
+class Halt(Exception):
+    """程序执行完毕, 由续延栈最底下的续延抛出"""
+
+
+class CEKMachine:
+    """执行一个 program 节点的 CEK 机器
+
+    run(max_steps) 最多执行 max_steps 步, step() 执行一步, 执行完毕时返回 True, 结果在 result 中.
+    interrupt() 让正在执行的 run 在 CHUNK 步之内返回 False, 再调用 run 继续执行.
+    """
+
+    def __init__(self, ast, env=None):
+        self.env = Environment() if env is None else env
+        self.result = None
+        self.done = False
+        self.interrupted = False
+        self.loop = cek_loop(self, ast)
+
+    def run(self, max_steps=None):
+        # 执行完毕后续延栈已经空了, 再调用 run 或 step 什么也不做
+        if self.done:
+            return True
+        self.interrupted = False
+        try:
+            while not self.interrupted:
+                if max_steps is None:
+                    self.loop(CHUNK)
+                elif max_steps > 0:
+                    n = min(CHUNK, max_steps)
+                    max_steps -= n
+                    self.loop(n)
+                else:
+                    break
+        except Halt:
+            self.done = True
+        return self.done
+
+    def step(self):
+        return self.run(1)
+
+    def interrupt(self):
+        self.interrupted = True
+
+
+def cek_loop(machine, ast):
+    """建立 machine 的续延栈和值栈, 返回执行 n 步的主循环 loop(n)"""
+    def err(msg):
+        return error('cilly eval', msg)
+
+    env = machine.env
+    # 续延栈和值栈
+    todo = []
+    vals = []
+    kpush = todo.append
+    kpop = todo.pop
+    push = vals.append
+    pop = vals.pop
+
+    # 函数调用中定义的变量的当前值和定义它的调用深度, 最外层程序是 1
+    values = {}
+    owners = {}
+    depth = 1
+
+    def ev(node):
+        kpush((evaluators.get(node[0], ev_illegal), node))
+
+    def lookup_var(name):
+        v = values.get(name, UNBOUND)
+        if v is UNBOUND:
+            return env.lookup_var(name)
+        return v
+
+    def define(name, v, undo):
+        if owners.get(name) == depth:
+            error('define var', f'变量已定义{name}')
+        undo.append((name, values.get(name, UNBOUND), owners.get(name)))
+        values[name] = v
+        owners[name] = depth
+
+    # 每层调用定义过的 (变量名, 原来的值, 原来的深度), 返回时恢复
+    frames = []
+
+    def define_var_here(name, v):
+        if depth == 1:
+            env.define_var(name, v)
+        else:
+            define(name, v, frames[-1])
+
+    def halt(_):
+        machine.result = pop()
+        raise Halt
+
+    def k_program(it):
+        s = next(it, None)
+        if s is None:
+            return
+        pop()
+        kpush((k_program, it))
+        ev(s)
+
+    def ev_program(node):
+        push(NULL)
+        kpush((k_program, iter(node[1])))
+
+    def ev_expr_stat(node):
+        ev(node[1])
+
+    def k_print_item(_):
+        print(val(pop()), end=' ')
+
+    def k_print_end(_):
+        print('')
+        push(NULL)
+
+    def ev_print(node):
+        kpush((k_print_end, None))
+        for a in reversed(node[1]):
+            kpush((k_print_item, None))
+            ev(a)
+
+    def ev_literal(node):
+        tag = node[0]
+
+        if tag in ['num', 'str']:
+            push(node[1])
+        elif tag in ['true', 'false']:
+            push(TRUE if tag == 'true' else FALSE)
+        elif tag == 'null':
+            push(NULL)
+        else:
+            err(f'非法字面量{node}')
+
+    def k_unary(op):
+        v = pop()
+
+        if op == '-':
+            push(-v)
+        elif op == '!':
+            push(FALSE if v else TRUE)
+        else:
+            err(f'非法一元运算符{op}')
+
+    def ev_unary(node):
+        _, op, e = node
+        kpush((k_unary, op))
+        ev(e)
+
+    def k_and(e2):
+        if vals[-1] == False:
+            vals[-1] = FALSE
+        else:
+            pop()
+            ev(e2)
+
+    def k_or(e2):
+        if vals[-1] == True:
+            vals[-1] = TRUE
+        else:
+            pop()
+            ev(e2)
+
+    binary_ops = {
+        '+': lambda v1, v2: v1 + v2,
+        '-': lambda v1, v2: v1 - v2,
+        '*': lambda v1, v2: v1 * v2,
+        '/': lambda v1, v2: v1 / v2,
+        '^': lambda v1, v2: v1 ** v2,
+        '>': lambda v1, v2: v1 > v2,
+        '>=': lambda v1, v2: v1 >= v2,
+        '<': lambda v1, v2: v1 < v2,
+        '<=': lambda v1, v2: v1 <= v2,
+        '==': lambda v1, v2: v1 == v2,
+        '!=': lambda v1, v2: v1 != v2,
+    }
+
+    def k_binary(op):
+        v2 = pop()
+        f = binary_ops.get(op)
+        if f is None:
+            err(f'非法二元运算符{op}')
+        vals[-1] = f(vals[-1], v2)
+
+    def k_binary_right(node):
+        kpush((k_binary, node[1]))
+        ev(node[3])
+
+    def ev_binary(node):
+        _, op, e1, e2 = node
+        if op == '&&':
+            kpush((k_and, e2))
+        elif op == '||':
+            kpush((k_or, e2))
+        else:
+            kpush((k_binary_right, node))
+        ev(e1)
+
+    def k_ternary(node):
+        _, _, true_expr, false_expr = node
+        ev(true_expr if pop() is TRUE else false_expr)
+
+    def ev_ternary(node):
+        kpush((k_ternary, node))
+        ev(node[1])
+
+    def k_if(node):
+        _, _, true_s, false_s = node
+
+        if pop() is TRUE:
+            ev(true_s)
+        elif false_s != None:
+            ev(false_s)
+        else:
+            push(NULL)
+
+    def ev_if(node):
+        kpush((k_if, node))
+        ev(node[1])
+
+    # 循环执行时值栈顶上是 r 和 prev_r, 与 cilly_eval 中的两个局部变量相同
+    def loop_body_done():
+        """循环体的结果已经在栈顶, 更新 r 和 prev_r. 遇到 break 时循环的结果留在栈顶, 返回 True"""
+        r = pop()
+        if r is BREAK:
+            prev_r = pop()
+            vals[-1] = prev_r
+            return True
+
+        vals[-2] = r
+        if r is not CONTINUE:
+            vals[-1] = r
+        return False
+
+    def k_while_test(node):
+        if pop() is TRUE:
+            kpush((k_while_body, node))
+            ev(node[2])
+        else:
+            pop()
+
+    def k_while_body(node):
+        if not loop_body_done():
+            kpush((k_while_test, node))
+            ev(node[1])
+
+    def ev_while(node):
+        push(NULL)
+        push(NULL)
+        kpush((k_while_test, node))
+        ev(node[1])
+
+    def k_for_next(node):
+        # 丢掉初始化语句或增量语句的结果, 再判断条件
+        pop()
+        kpush((k_for_test, node))
+        ev(node[2])
+
+    def k_for_test(node):
+        if pop() is TRUE:
+            kpush((k_for_body, node))
+            ev(node[4])
+        else:
+            pop()
+
+    def k_for_body(node):
+        if not loop_body_done():
+            kpush((k_for_next, node))
+            ev(node[3])
+
+    def ev_for(node):
+        push(NULL)
+        push(NULL)
+        kpush((k_for_next, node))
+        ev(node[1])
+
+    def ev_break(node):
+        push(BREAK)
+
+    def ev_continue(node):
+        push(CONTINUE)
+
+    def k_block(it):
+        v = vals[-1]
+        if v is BREAK or v is CONTINUE:
+            return
+        s = next(it, None)
+        if s is None:
+            return
+        pop()
+        kpush((k_block, it))
+        ev(s)
+
+    def ev_block(node):
+        push(NULL)
+        kpush((k_block, iter(node[1])))
+
+    def ev_id(node):
+        push(lookup_var(node[1]))
+
+    def k_define(name):
+        define_var_here(name, pop())
+        push(NULL)
+
+    def ev_define(node):
+        _, name, e = node
+        kpush((k_define, name))
+        ev(e)
+
+    def k_assign(name):
+        v = pop()
+        if name in values:
+            values[name] = v
+        else:
+            env.set_var(name, v)
+        push(NULL)
+
+    def ev_assign(node):
+        _, name, e = node
+        kpush((k_assign, name))
+        ev(e)
+
+    def ev_return(node):
+        _, e = node
+
+        if e != None:
+            ev(e)
+        else:
+            push(NULL)
+
+    def ev_fun(node):
+        _, params, body = node
+        push(mk_proc(params, body))
+
+    def ev_fun_def(node):
+        _, name, params, body = node
+        proc = mk_proc(params, body)
+        if depth == 1:
+            define_var(env, name, proc)
+        else:
+            define(name, proc, frames[-1])
+        push(NULL)
+
+    def k_return(undo):
+        nonlocal depth
+        for name, v, owner in reversed(undo):
+            if v is UNBOUND:
+                del values[name], owners[name]
+            else:
+                values[name] = v
+                owners[name] = owner
+        frames.pop()
+        depth = depth - 1
+
+    def k_apply(n):
+        nonlocal depth
+        if n:
+            args = vals[-n:]
+            del vals[-n:]
+        else:
+            args = []
+        p = pop()
+
+        if isinstance(p, Primitive):
+            r = p.f(*[val(a) for a in args])
+            # 返回 None 的 Python 函数返回 null
+            push(NULL if r is None else r)
+            return
+
+        depth = depth + 1
+        undo = []
+        frames.append(undo)
+        kpush((k_return, undo))
+        for param, arg in zip(p.params, args):
+            define(param, arg, undo)
+        ev(p.body)
+
+    def k_call(args):
+        p = vals[-1]
+        if not isinstance(p, (Proc, Primitive)):
+            err(f'非法函数{p}')
+
+        kpush((k_apply, len(args)))
+        for a in reversed(args):
+            ev(a)
+
+    def ev_call(node):
+        _, f_expr, args = node
+        kpush((k_call, args))
+        ev(f_expr)
+
+    def ev_illegal(node):
+        err(f'非法节点{node}')
+
+    evaluators = {
+        'program': ev_program,
+        'expr_stat': ev_expr_stat,
+        'print': ev_print,
+        'if': ev_if,
+        'while': ev_while,
+        'for': ev_for,
+        'break': ev_break,
+        'continue': ev_continue,
+        'block': ev_block,
+
+        'define': ev_define,
+        'assign': ev_assign,
+
+        'unary': ev_unary,
+        'binary': ev_binary,
+        'ternary': ev_ternary,
+
+        'return': ev_return,
+        'fun': ev_fun,
+        'fun_def': ev_fun_def,
+        'call': ev_call,
+
+        'id': ev_id,
+        'num': ev_literal,
+        'str': ev_literal,
+        'true': ev_literal,
+        'false': ev_literal,
+        'null': ev_literal,
+    }
+
+    # 与 cilly_eval 一样依次执行各条语句, 没有语句时结果是 None
+    kpush((halt, None))
+    push(None)
+    kpush((k_program, iter(ast[1])))
+
+    def loop(n):
+        for _ in repeat(None, n):
+            k, a = kpop()
+            k(a)
+
+    return loop
+
+
+def cilly_cek_eval(ast, env=None):
+    """与 cilly_eval 接口相同, 返回 (最后一条语句的结果, 环境)"""
+    machine = CEKMachine(ast, env)
+    machine.run()
+    return machine.result, machine.env
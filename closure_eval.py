@@ -0,0 +1,433 @@
+'''
+cilly closure eval: 把 ast 一次性编译成嵌套的 Python 闭包再执行
+
+与 eval.py 中的 cilly_eval 语义完全相同 (值的表示, 函数调用时以调用者的环境为父环境,
+块不建立新环境, return 不中断块等都一样), 只是不再每访问一个节点就按标签查一次 visitors 表、
+拆一次节点. 每个节点在编译时拆开, 子节点编译成闭包, 运算符在编译时选好专门的闭包,
+例如 binary '+' 编译成 lambda: l() + r().
+执行程序时只剩闭包调用.
+
+变量在编译时静态解析: 每个变量名分到一个槽位, 所有变量的当前值放在一个按槽位下标的列表中.
+cilly 的函数调用是动态作用域的, 查找变量就是找最近一次执行的、还没有返回的定义,
+所以用浅绑定实现: 函数调用中定义变量 (包括参数) 时记下槽位原来的值, 返回时恢复.
+读写变量都是一次列表下标操作, 不再沿着环境链逐层查字典, 调用也不再新建 Environment.
+执行前从传入的 Environment 中取出各个变量的值, 执行完把最外层的变量写回去.
+
+非法的节点和运算符与 cilly_eval 一样, 执行到时才报错.
+'''
+
+from lexical_analyzer import error
+from eval import mk_proc, val, NULL, TRUE, FALSE, BREAK, CONTINUE, Environment, Proc, Primitive
+
+# 没有定义的变量槽位的值
+UNBOUND = object()
+
+
+def cilly_closure_compiler(ast):
+    """把 program 节点编译成 run(env), 依次执行各条语句, 返回最后一条语句的结果"""
+    def err(msg):
+        return error('cilly eval', msg)
+
+    # 变量名 -> 槽位, names 是按槽位排列的变量名
+    slots = {}
+    names = []
+    # 各个槽位的当前值, 以及定义它的调用深度: 最外层程序是 1, 0 是没有定义,
+    # -1 是定义在传入的环境的祖先环境中, 包括内置函数表
+    values = []
+    owners = []
+    depth = 1
+    # 每层调用定义过的 (槽位, 原来的值, 原来的深度), 返回时恢复, 最外层的用来写回环境
+    frames = [[]]
+    # 正在执行的程序的最外层环境
+    env = None
+
+    def bind_from_env(i):
+        name = names[i]
+        values[i], owners[i] = UNBOUND, 0
+        if name in env.variables:
+            values[i], owners[i] = env.variables[name], 1
+            return
+        e = env.parent
+        while e:
+            if name in e.variables:
+                values[i], owners[i] = e.variables[name], -1
+                return
+            e = e.parent
+
+    def resolve(name):
+        i = slots.get(name)
+        if i is None:
+            i = len(names)
+            slots[name] = i
+            names.append(name)
+            values.append(UNBOUND)
+            owners.append(0)
+            # 执行中才编译的函数体 (别的引擎建立的函数) 用到的新变量
+            if env is not None:
+                bind_from_env(i)
+        return i
+
+    def define(i, v):
+        if owners[i] == depth:
+            error('define var', f'变量已定义{names[i]}')
+        frames[-1].append((i, values[i], owners[i]))
+        values[i] = v
+        owners[i] = depth
+
+    # id(函数体) -> (函数体, 参数, 参数的槽位, 闭包). 函数值是 Proc(params, body),
+    # 调用时按 body 取出编译好的闭包, 别的引擎建立的函数第一次调用时才编译
+    bodies = {}
+
+    def compile_body(params, body):
+        entry = bodies.get(id(body))
+        if entry is None or entry[0] is not body or entry[1] is not params:
+            entry = body, params, [resolve(p) for p in params], visit(body)
+            bodies[id(body)] = entry
+        return entry
+
+    def illegal(msg):
+        def r():
+            err(msg)
+        return r
+
+    def co_program(node):
+        _, statements = node
+        stats = [visit(s) for s in statements]
+
+        def r():
+            v = NULL
+            for s in stats:
+                v = s()
+            return v
+        return r
+
+    def co_expr_stat(node):
+        _, e = node
+        return visit(e)
+
+    def co_print(node):
+        _, args = node
+        args = [visit(a) for a in args]
+
+        def r():
+            for a in args:
+                print(val(a()), end=' ')
+            print('')
+            return NULL
+        return r
+
+    def co_literal(node):
+        tag, v, _, _ = node
+
+        if tag in ['num', 'str']:
+            return lambda: v
+
+        if tag in ['true', 'false']:
+            v = TRUE if tag == 'true' else FALSE
+            return lambda: v
+
+        if tag == 'null':
+            return lambda: NULL
+
+        return illegal(f'非法字面量{node}')
+
+    def co_unary(node):
+        _, op, e = node
+        e = visit(e)
+
+        if op == '-':
+            return lambda: -e()
+
+        if op == '!':
+            return lambda: FALSE if e() else TRUE
+
+        def r():
+            val(e())
+            err(f'非法一元运算符{op}')
+        return r
+
+    def co_binary(node):
+        _, op, e1, e2 = node
+        l, r = visit(e1), visit(e2)
+
+        if op == '&&':
+            return lambda: FALSE if l() == False else r()
+        if op == '||':
+            return lambda: TRUE if l() == True else r()
+
+        if op == '+':
+            return lambda: l() + r()
+        if op == '-':
+            return lambda: l() - r()
+        if op == '*':
+            return lambda: l() * r()
+        if op == '/':
+            return lambda: l() / r()
+        if op == '^':
+            return lambda: l() ** r()
+
+        # 比较的结果直接是 bool
+        if op == '>':
+            return lambda: l() > r()
+        if op == '>=':
+            return lambda: l() >= r()
+        if op == '<':
+            return lambda: l() < r()
+        if op == '<=':
+            return lambda: l() <= r()
+        if op == '==':
+            return lambda: l() == r()
+        if op == '!=':
+            return lambda: l() != r()
+
+        def bad():
+            val(l())
+            val(r())
+            err(f'非法二元运算符{op}')
+        return bad
+
+    def co_ternary(node):
+        _, cond, true_expr, false_expr = node
+        cond, true_expr, false_expr = visit(cond), visit(true_expr), visit(false_expr)
+        return lambda: true_expr() if cond() is TRUE else false_expr()
+
+    def co_if(node):
+        _, cond, true_s, false_s = node
+        cond, true_s = visit(cond), visit(true_s)
+
+        if false_s is None:
+            return lambda: true_s() if cond() is TRUE else NULL
+
+        false_s = visit(false_s)
+        return lambda: true_s() if cond() is TRUE else false_s()
+
+    def co_while(node):
+        _, cond, body = node
+        cond, body = visit(cond), visit(body)
+
+        def r():
+            v = NULL
+            prev_v = NULL
+            while cond() is TRUE:
+                v = body()
+                if v is BREAK:
+                    v = prev_v
+                    break
+
+                if v is CONTINUE:
+                    continue
+                prev_v = v
+
+            return v
+        return r
+
+    def co_for(node):
+        _, init, cond, incr, body = node
+        init, cond, incr, body = visit(init), visit(cond), visit(incr), visit(body)
+
+        def r():
+            v = NULL
+            prev_v = NULL
+
+            init()
+
+            while True:
+                if cond() is not TRUE:
+                    break
+
+                v = body()
+                if v is BREAK:
+                    v = prev_v
+                    break
+
+                if v is CONTINUE:
+                    incr()
+                    continue
+
+                prev_v = v
+                incr()
+
+            return v
+        return r
+
+    def co_break(node):
+        return lambda: BREAK
+
+    def co_continue(node):
+        return lambda: CONTINUE
+
+    def co_block(node):
+        _, statements = node
+        stats = [visit(s) for s in statements]
+
+        def r():
+            v = NULL
+            for s in stats:
+                v = s()
+                if v is BREAK or v is CONTINUE:
+                    return v
+            return v
+        return r
+
+    def co_id(node):
+        _, name, _, _ = node
+        i = resolve(name)
+
+        def r():
+            v = values[i]
+            if v is UNBOUND:
+                error('lookup var', f'未定义变量{name}')
+            return v
+        return r
+
+    def co_define(node):
+        _, name, e = node
+        i = resolve(name)
+        e = visit(e)
+
+        def r():
+            define(i, e())
+            return NULL
+        return r
+
+    def co_assign(node):
+        _, name, e = node
+        i = resolve(name)
+        e = visit(e)
+
+        def r():
+            v = e()
+            if values[i] is UNBOUND:
+                error('set var', f'未定义变量{name}')
+            values[i] = v
+            if owners[i] < 0:
+                env.set_var(name, v)
+                # 给内置函数名赋值时 set_var 在最外层环境中定义了同名变量
+                if name in env.variables:
+                    owners[i] = 1
+            return NULL
+        return r
+
+    def co_return(node):
+        _, e = node
+        if e is None:
+            return lambda: NULL
+        return visit(e)
+
+    def co_fun(node):
+        _, params, body = node
+        compile_body(params, body)
+        return lambda: mk_proc(params, body)
+
+    def co_fun_def(node):
+        _, name, params, body = node
+        i = resolve(name)
+        compile_body(params, body)
+
+        def r():
+            define(i, mk_proc(params, body))
+            return NULL
+        return r
+
+    def co_call(node):
+        _, f_expr, args = node
+        f_expr = visit(f_expr)
+        args = [visit(a) for a in args]
+
+        def r():
+            nonlocal depth
+            p = f_expr()
+            if not isinstance(p, (Proc, Primitive)):
+                err(f'非法函数{p}')
+
+            if isinstance(p, Primitive):
+                v = p.f(*[val(a()) for a in args])
+                return NULL if v is None else v
+
+            params, body = p.params, p.body
+            arg_values = [a() for a in args]
+            _, _, param_slots, run_body = compile_body(params, body)
+
+            depth = depth + 1
+            undo = []
+            frames.append(undo)
+            try:
+                for i, v in zip(param_slots, arg_values):
+                    define(i, v)
+                return run_body()
+            finally:
+                for i, v, owner in reversed(undo):
+                    values[i] = v
+                    owners[i] = owner
+                frames.pop()
+                depth = depth - 1
+        return r
+
+    compilers = {
+        'program': co_program,
+        'expr_stat': co_expr_stat,
+        'print': co_print,
+        'if': co_if,
+        'while': co_while,
+        'for': co_for,
+        'break': co_break,
+        'continue': co_continue,
+        'block': co_block,
+
+        'define': co_define,
+        'assign': co_assign,
+
+        'unary': co_unary,
+        'binary': co_binary,
+        'ternary': co_ternary,
+
+        'return': co_return,
+        'fun': co_fun,
+        'fun_def': co_fun_def,
+        'call': co_call,
+
+        'id': co_id,
+        'num': co_literal,
+        'str': co_literal,
+        'true': co_literal,
+        'false': co_literal,
+        'null': co_literal,
+    }
+
+    def visit(node):
+        tag = node[0]
+        if tag not in compilers:
+            return illegal(f'非法节点{node}')
+        return compilers[tag](node)
+
+    stats = [visit(s) for s in ast[1]]
+
+    def run(e):
+        nonlocal env
+        env = e
+        frames[:] = [[]]
+        for i in range(len(names)):
+            bind_from_env(i)
+        try:
+            result = None
+            for s in stats:
+                result = s()
+            return result
+        finally:
+            # 最外层程序定义和修改过的变量写回环境, 新定义的按定义的顺序
+            for i, _, _ in frames[0]:
+                env.variables[names[i]] = values[i]
+            for i in range(len(names)):
+                if owners[i] == 1:
+                    env.variables[names[i]] = values[i]
+            env = None
+
+    return run
+
+
+def cilly_closure_eval(ast, env=None):
+    """与 cilly_eval 接口相同, 返回 (最后一条语句的结果, 环境)"""
+    if env is None:
+        env = Environment()
+
+    return cilly_closure_compiler(ast)(env), env
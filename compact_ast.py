@@ -0,0 +1,257 @@
+'''
+cilly 紧凑 AST
+
+每种节点是一个只有 __slots__ 的类, 节点种类是整数 kind, 类型名只存在类上.
+标识符和字面量也是节点, 不再是 4 个元素的 token 列表: 行号列号合成一个整数保存,
+标识符名字转换时驻留, 同名的标识符共用一个字符串.
+
+为了兼容按列表处理 AST 的代码 (evaluate_node, cilly_vm_compiler 等),
+节点支持 node[0] 取类型名、node[i] 取第 i 个字段、按列表的顺序解包, 以及与列表形式比较相等.
+
+cilly_parser(tokens, compact=True) 用 NODE_BUILDERS 直接生成紧凑节点, 不先建立列表形式的 AST.
+'''
+
+import sys
+from operator import attrgetter
+
+# 标识符和字面量节点在列表形式中的字段, 实际只保存 value 和 position
+LEAF_FIELDS = ('value', 'line', 'column')
+# position = line << POSITION_SHIFT | column
+POSITION_SHIFT = 32
+
+# 节点类型 -> 字段, 字段顺序与列表形式中的元素顺序相同
+NODE_FIELDS = [
+    ('program', ('statements',)),
+    ('expr_stat', ('expr',)),
+    ('print', ('args',)),
+    ('if', ('cond', 'true_stat', 'false_stat')),
+    ('while', ('cond', 'body')),
+    ('for', ('init', 'cond', 'incr', 'body')),
+    ('break', ()),
+    ('continue', ()),
+    ('block', ('statements',)),
+    ('define', ('name', 'expr')),
+    ('assign', ('name', 'expr')),
+    ('unary', ('op', 'expr')),
+    ('binary', ('op', 'left', 'right')),
+    ('ternary', ('cond', 'true_expr', 'false_expr')),
+    ('return', ('expr',)),
+    ('fun', ('params', 'body')),
+    ('fun_def', ('name', 'params', 'body')),
+    ('call', ('fun', 'args')),
+    ('id', LEAF_FIELDS),
+    ('num', LEAF_FIELDS),
+    ('str', LEAF_FIELDS),
+    ('true', LEAF_FIELDS),
+    ('false', LEAF_FIELDS),
+    ('null', LEAF_FIELDS),
+]
+
+NODE_TAGS = [tag for tag, _ in NODE_FIELDS]
+NODE_KINDS = {tag: kind for kind, tag in enumerate(NODE_TAGS)}
+
+
+class Node:
+    __slots__ = ()
+
+    kind = None
+    tag = None
+    fields = ()
+
+    def __len__(self):
+        return len(self.fields) + 1
+
+    def __eq__(self, other):
+        if isinstance(other, Node):
+            return self.kind == other.kind and list(self) == list(other)
+        if isinstance(other, list):
+            # 编译器查找常量时大多在这里就不相等了, 不必展开整个节点
+            if len(other) != len(self) or other[0] != self.tag:
+                return False
+            return list(self) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def leaf_values(self):
+    position = self.position
+    if position is None:
+        return self.value, None, None
+    return self.value, position >> POSITION_SHIFT, position & ((1 << POSITION_SHIFT) - 1)
+
+
+def leaf_line(self):
+    position = self.position
+    return None if position is None else position >> POSITION_SHIFT
+
+
+def leaf_column(self):
+    position = self.position
+    return None if position is None else position & ((1 << POSITION_SHIFT) - 1)
+
+
+def make_node_class(tag, fields):
+    slots = fields
+    if fields is LEAF_FIELDS:
+        slots = ('value', 'position')
+        values = leaf_values
+        getters = (attrgetter('value'), leaf_line, leaf_column)
+    else:
+        getters = tuple(attrgetter(f) for f in fields)
+    # node[i] 的取值函数, 下标 0 是类型名
+    getters = (lambda self: tag,) + getters
+
+    if fields is LEAF_FIELDS:
+        pass
+    elif len(fields) == 0:
+        values = lambda self: ()
+    elif len(fields) == 1:
+        get = attrgetter(fields[0])
+        values = lambda self: (get(self),)
+    else:
+        values = attrgetter(*fields)
+
+    # 与 namedtuple 一样按字段生成 __init__, 逐个字段 setattr 太慢, 语法分析器每个节点都要调用
+    namespace = {}
+    exec(f'def __init__(self, {", ".join(slots)}):\n'
+         + ''.join(f'    self.{f} = {f}\n' for f in slots)
+         + '    pass\n', namespace)
+    __init__ = namespace['__init__']
+
+    # 同类节点直接比较字段, 不经过列表形式
+    if fields is LEAF_FIELDS:
+        def __eq__(self, other):
+            if type(other) is type(self):
+                return self.value == other.value and self.position == other.position
+            return Node.__eq__(self, other)
+    else:
+        def __eq__(self, other):
+            if type(other) is type(self):
+                return values(self) == values(other)
+            return Node.__eq__(self, other)
+
+    def __iter__(self):
+        return iter((tag,) + values(self))
+
+    def __getitem__(self, i):
+        # 直接读取对应的字段, 不构造整个节点的元组
+        get = getters[i]
+        if type(get) is tuple:
+            return tuple(g(self) for g in get)
+        return get(self)
+
+    # expr_stat -> ExprStatNode
+    name = ''.join(w.capitalize() for w in tag.split('_')) + 'Node'
+    return type(name, (Node,), {
+        '__slots__': slots,
+        '__module__': __name__,
+        '__qualname__': name,
+        '__init__': __init__,
+        '__eq__': __eq__,
+        '__hash__': None,
+        '__iter__': __iter__,
+        '__getitem__': __getitem__,
+        'kind': NODE_KINDS[tag],
+        'tag': tag,
+        'fields': fields,
+    })
+
+
+# 以 kind 为下标的节点类, 同时以类名导出, pickle 时按类名找到它们
+NODE_CLASSES = []
+for _tag, _fields in NODE_FIELDS:
+    _cls = make_node_class(_tag, _fields)
+    NODE_CLASSES.append(_cls)
+    globals()[_cls.__name__] = _cls
+del _tag, _fields, _cls
+
+# 子节点列表所在的字段
+NODE_LIST_FIELDS = {'statements', 'args'}
+
+
+def leaf_node(token):
+    """token 或列表形式的标识符、字面量节点 [tag, val, line, column] 对应的紧凑节点"""
+    tag, v, line, column = token
+    if tag == 'id':
+        v = sys.intern(v)
+    return NODE_CLASSES[NODE_KINDS[tag]](v, None if line is None else line << POSITION_SHIFT | column)
+
+
+def named_node(cls):
+    def make(name, *args):
+        return cls(sys.intern(name), *args)
+    return make
+
+
+def params_node(cls):
+    def make(params, body):
+        return cls([sys.intern(p) for p in params], body)
+    return make
+
+
+def fun_def_node(name, params, body):
+    return FunDefNode(sys.intern(name), [sys.intern(p) for p in params], body)
+
+
+# 类型名 -> 用各个字段构造紧凑节点的函数, 语法分析器直接用它们生成紧凑形式的 AST.
+# 与 to_compact 一样驻留变量名和参数名
+NODE_BUILDERS = {tag: cls for tag, cls in zip(NODE_TAGS, NODE_CLASSES)}
+NODE_BUILDERS.update({
+    'define': named_node(DefineNode),
+    'assign': named_node(AssignNode),
+    'fun': params_node(FunNode),
+    'fun_def': fun_def_node,
+})
+
+
+def to_compact(node):
+    """把列表形式的 AST 转换为紧凑形式"""
+    if node is None or isinstance(node, Node):
+        return node
+
+    tag = node[0]
+    kind = NODE_KINDS.get(tag)
+    if kind is None:
+        raise Exception(f'cilly ast : 非法节点{node}')
+
+    fields = NODE_FIELDS[kind][1]
+    if fields is LEAF_FIELDS:
+        return leaf_node(node)
+
+    args = []
+    for f, v in zip(fields, node[1:]):
+        if f in NODE_LIST_FIELDS:
+            v = [to_compact(c) for c in v]
+        elif f == 'name':
+            v = sys.intern(v)
+        elif f == 'params':
+            v = [sys.intern(p) for p in v]
+        elif f != 'op':
+            v = to_compact(v)
+        args.append(v)
+
+    return NODE_CLASSES[kind](*args)
+
+
+def to_list(node):
+    """把紧凑形式的 AST 转换回列表形式"""
+    if not isinstance(node, Node):
+        return node
+
+    if node.fields is LEAF_FIELDS:
+        return list(node)
+
+    r = [node.tag]
+    for f, v in zip(node.fields, node[1:]):
+        if f in NODE_LIST_FIELDS:
+            v = [to_list(c) for c in v]
+        elif f == 'params':
+            v = list(v)
+        elif f not in ('name', 'op'):
+            v = to_list(v)
+        r.append(v)
+    return r
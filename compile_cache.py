@@ -0,0 +1,221 @@
+'''
+cilly 编译缓存
+
+以源码文本和编译器版本的哈希为键, 缓存 token、AST 以及 cilly_vm_compiler 产生的
+(code, consts, scopes). 内存中一层按最近使用淘汰, 磁盘上一层按文件修改时间淘汰,
+两层都按 pickle 后的字节数限制总大小. 源码不变时再次运行直接取出结果,
+不再词法分析、语法分析和编译.
+
+缓存取出的对象会被多次返回, 调用者不能修改它们.
+'''
+
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import compact_ast
+import lexical_analyzer
+import syntactic_analyzer
+import values
+import vm
+from lexical_analyzer import cilly_lexer
+from syntactic_analyzer import cilly_parser
+from vm import cilly_vm_compiler
+
+# 缓存文件的格式版本, pickle 的内容结构变化时加一
+CACHE_FORMAT = 2
+
+# 产生缓存内容的模块: 词法分析器、语法分析器和它输出的节点、编译器和它输出的常量
+SOURCE_MODULES = (lexical_analyzer, syntactic_analyzer, compact_ast, vm, values)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__cillycache__')
+
+
+def compiler_version():
+    """SOURCE_MODULES 源码的哈希, 其中任何一个改动后旧的缓存自动失效"""
+    h = hashlib.sha256(f'cilly-cache-{CACHE_FORMAT}'.encode())
+    for m in SOURCE_MODULES:
+        with open(m.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class CompileCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, memory_limit=32 * 1024 * 1024,
+                 disk_limit=256 * 1024 * 1024, version=None):
+        """directory 为 None 时只使用内存缓存"""
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.version = compiler_version() if version is None else version
+
+        # key -> (对象, pickle 后的字节数), 越靠后越是最近用过
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        # 第一次写磁盘时才统计目录里已有的缓存大小
+        self.disk_size = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, kind, source):
+        h = hashlib.sha256(self.version.encode())
+        h.update(kind.encode())
+        h.update(source.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, kind, source):
+        """查缓存, 没有时返回 None"""
+        key = self.key(kind, source)
+
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            self.memory_hits = self.memory_hits + 1
+            return entry[0]
+
+        if self.directory is not None:
+            path = self.path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                value = pickle.loads(data)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                # 写了一半或已损坏的缓存文件当作不存在
+                self.remove_file(path)
+            else:
+                # 刷新修改时间, 磁盘淘汰时最近用过的文件排在后面
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                self.remember(key, value, len(data))
+                self.disk_hits = self.disk_hits + 1
+                return value
+
+        self.misses = self.misses + 1
+        return None
+
+    def put(self, kind, source, value):
+        key = self.key(kind, source)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.remember(key, value, len(data))
+        if self.directory is not None:
+            self.store(key, data)
+
+    def lookup(self, kind, source, build):
+        """取缓存中的结果, 没有时调用 build() 生成并放入缓存"""
+        value = self.get(kind, source)
+        if value is None:
+            value = build()
+            self.put(kind, source, value)
+        return value
+
+    def tokens(self, source):
+        return self.lookup('tokens', source, lambda: cilly_lexer(source))
+
+    def ast(self, source):
+        return self.lookup('ast', source, lambda: cilly_parser(self.tokens(source)))
+
+    def compile(self, source, optimize=0):
+        """源码对应的 (code, consts, scopes), 不同优化级别的结果分别缓存"""
+        kind = 'code' if optimize == 0 else f'code-O{optimize}'
+        return self.lookup(kind, source, lambda: cilly_vm_compiler(self.ast(source), [], [], [], optimize))
+
+    def remember(self, key, value, size):
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_size = self.memory_size - old[1]
+
+        # 比整个内存缓存还大的结果不放进内存
+        if size > self.memory_limit:
+            return
+
+        self.memory[key] = (value, size)
+        self.memory_size = self.memory_size + size
+        while self.memory_size > self.memory_limit:
+            _, (_, n) = self.memory.popitem(last=False)
+            self.memory_size = self.memory_size - n
+
+    def store(self, key, data):
+        if len(data) > self.disk_limit:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        if self.disk_size is None:
+            self.disk_size = sum(size for _, size, _ in self.disk_entries())
+
+        path = self.path(key)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        # 先写临时文件再改名, 其他进程不会读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            self.remove_file(tmp)
+            raise
+
+        self.disk_size = self.disk_size - old_size + len(data)
+        if self.disk_size > self.disk_limit:
+            self.evict_disk()
+
+    def disk_entries(self):
+        """磁盘缓存中的 (修改时间, 字节数, 路径)"""
+        r = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return r
+        for name in names:
+            if not name.endswith('.pickle'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            r.append((st.st_mtime, st.st_size, path))
+        return r
+
+    def evict_disk(self):
+        # 其他进程也可能写同一个目录, 淘汰前重新统计一次
+        entries = sorted(self.disk_entries())
+        size = sum(n for _, n, _ in entries)
+        for _, n, path in entries:
+            if size <= self.disk_limit:
+                break
+            self.remove_file(path)
+            size = size - n
+        self.disk_size = size
+
+    def remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """清空内存和磁盘两层缓存"""
+        self.memory.clear()
+        self.memory_size = 0
+        if self.directory is not None:
+            for _, _, path in self.disk_entries():
+                self.remove_file(path)
+            self.disk_size = 0
+
+
+default_cache = CompileCache()
@@ -1,32 +1,13 @@
+from importlib import import_module
+
 from lexical_analyzer import cilly_lexer, error
 from syntactic_analyzer import cilly_parser
+# 运行时值的表示在 values.py 中, 这里导出原来的名字
+from values import mk_num, mk_str, mk_bool, mk_proc, mk_primitive, val, NULL, TRUE, FALSE, Proc, Primitive
 
-
-def mk_num(i):
-    return ['num', i]
-
-
-def mk_str(s):
-    return ['str', s]
-
-
-TRUE = ['bool', True]
-FALSE = ['bool', False]
-
-
-def mk_bool(b):
-    return TRUE if b else FALSE
-
-
-def mk_proc(params, body):
-    return ['proc', params, body]
-
-
-NULL = ['null', None]
-
-
-def val(v):
-    return v[1]
+# 块和循环体执行到 break / continue 时的结果
+BREAK = ['break']
+CONTINUE = ['continue']
 
 
 def lookup_var(env, var):
@@ -98,7 +79,7 @@ def evaluate_node(node, env):
         tag, v, _, _ = node
 
         if tag in ['num', 'str']:
-            return node
+            return v
 
         if tag in ['true', 'false']:
             return TRUE if tag == 'true' else FALSE
@@ -111,7 +92,7 @@ def evaluate_node(node, env):
     def ev_unary(node,env):
         _, op, e = node
 
-        v = val(visit(e, env))
+        v = visit(e, env)
 
         if op == '-':
             return mk_num(-v)
@@ -124,7 +105,7 @@ def evaluate_node(node, env):
     def ev_binary(node,env):
         _, op, e1, e2 = node
 
-        v1 = val(visit(e1, env))
+        v1 = visit(e1, env)
         if op == '&&':
             if v1 == False:
                 return FALSE
@@ -137,7 +118,7 @@ def evaluate_node(node, env):
             else:
                 return visit(e2, env)
 
-        v2 = val(visit(e2, env))
+        v2 = visit(e2, env)
 
         if op == '+':
             return mk_num(v1 + v2)
@@ -172,7 +153,7 @@ def evaluate_node(node, env):
     def ev_ternary(node,env):
         _, cond, true_expr, false_expr = node
 
-        if visit(cond, env) == TRUE:
+        if visit(cond, env) is TRUE:
             return visit(true_expr, env)
         else:
             return visit(false_expr, env)
@@ -180,7 +161,7 @@ def evaluate_node(node, env):
     def ev_if(node,env):
         _, cond, true_s, false_s = node
 
-        if visit(cond, env) == TRUE:
+        if visit(cond, env) is TRUE:
             return visit(true_s, env)
 
         if false_s != None:
@@ -193,13 +174,13 @@ def evaluate_node(node, env):
 
         r = NULL
         prev_r = NULL
-        while visit(cond, env) == TRUE:
+        while visit(cond, env) is TRUE:
             r = visit(body, env)
-            if r[0] == 'break':
+            if r is BREAK:
                 r = prev_r
                 break
 
-            if r[0] == 'continue':
+            if r is CONTINUE:
                 continue
             prev_r = r
 
@@ -214,19 +195,15 @@ def evaluate_node(node, env):
         visit(init, env)  # 执行初始化语句
 
         while True:
-            cond_val = visit(cond, env)
-            if cond_val[0] == 'expr_stat':
-                cond_val = cond_val[1]
-
-            if cond_val != TRUE:
+            if visit(cond, env) is not TRUE:
                 break
 
             r = visit(body, env)
-            if r[0] == 'break':
+            if r is BREAK:
                 r = prev_r
                 break
 
-            if r[0] == 'continue':
+            if r is CONTINUE:
                 visit(incr, env)
                 continue
 
@@ -236,10 +213,10 @@ def evaluate_node(node, env):
         return r
 
     def ev_break(node,env):
-        return ['break']
+        return BREAK
 
     def ev_continue(node,env):
-        return ['continue']
+        return CONTINUE
 
     def ev_block(node,env):
         _, statements = node
@@ -248,10 +225,7 @@ def evaluate_node(node, env):
 
         for s in statements:
             r = visit(s, env)
-            # 检查 r 是否为 None
-            if r is None:
-                continue
-            if r[0] in ['break', 'continue', 'return']:
+            if r is BREAK or r is CONTINUE:
                 return r
 
         return r
@@ -294,15 +268,16 @@ def evaluate_node(node, env):
         _, f_expr, args = node
 
         p = visit(f_expr, env)
-        if p[0] not in ['proc', 'primitive']:
+        if not isinstance(p, (Proc, Primitive)):
             err(f'非法函数{p}')
 
-        if p[0] == 'primitive':
-            _, f = p
+        if isinstance(p, Primitive):
             args = [ val( visit(a, env) ) for a in args]
-            return f(*args)
+            r = p.f(*args)
+            # 返回 None 的 Python 函数返回 null
+            return NULL if r is None else r
         
-        _, params, body = p
+        params, body = p.params, p.body
         args = [visit(a, env) for a in args]
         
         # 创建新的环境，继承当前环境
@@ -381,11 +356,61 @@ def greet(name):
     print("Hello " + name)
     return NULL
 
+
+class BuiltinFrame:
+    """所有环境共享的内置函数表, 是每条环境链的根. 程序不能在其中定义或修改变量"""
+
+    def __init__(self):
+        self.parent = None
+        self.variables = {}
+
+    def lookup_var(self, name):
+        if name in self.variables:
+            return self.variables[name]
+        error('lookup var', f'未定义变量{name}')
+
+    def define_var(self, name, value):
+        error('define var', f'不能在内置函数表中定义变量{name}')
+
+    def set_var(self, name, value):
+        if name in self.variables:
+            error('set var', f'不能修改内置函数{name}')
+        error('set var', f'未定义变量{name}')
+
+
+builtin_frame = BuiltinFrame()
+
+
+def register_native(name, f):
+    """把 Python 函数 f 注册为内置函数 name"""
+    builtin_frame.variables[name] = mk_primitive(f)
+
+
+def register_native_module(module, names):
+    """把模块 module 中的函数 names 注册为内置函数, 第一次调用其中的函数时才导入模块
+
+    导入后把函数值中的占位函数换成真正的函数, 之后的调用没有额外开销.
+    """
+    for name in names:
+        p = mk_primitive(None)
+
+        def load(*args, p=p, name=name):
+            p.f = getattr(import_module(module), name)
+            return p.f(*args)
+
+        p.f = load
+        builtin_frame.variables[name] = p
+
+
+register_native('greet', greet)
+register_native_module('turtle', ['forward', 'right', 'pencolor', 'left', 'penup', 'backward', 'pendown'])
+
+
 class Environment:
     def __init__(self, parent=None):
-        self.parent = parent
+        # 最外层环境的父环境是共享的内置函数表
+        self.parent = builtin_frame if parent is None else parent
         self.variables = {}
-        self.import_external_functions()
     
     def lookup_var(self, name):
         if name in self.variables:
@@ -402,29 +427,18 @@ class Environment:
     def set_var(self, name, value):
         if name in self.variables:
             self.variables[name] = value
+        elif self.parent is builtin_frame and name in builtin_frame.variables:
+            # 内置函数表是共享的, 给内置函数名赋值时在最外层环境中定义同名变量
+            self.variables[name] = value
         elif self.parent:
             self.parent.set_var(name, value)
         else:
             error('set var', f'未定义变量{name}')
-    
-    def mk_primitive_proc(self, f):
-        return ['primitive', f]
-
-    def import_external_functions(self):
-        # 引入外部函数
-        from turtle import forward,right,pencolor,left,penup,backward,pendown
-        self.define_var('greet', self.mk_primitive_proc(greet))
-        self.define_var('forward', self.mk_primitive_proc(forward))
-        self.define_var('right', self.mk_primitive_proc(right))
-        self.define_var('pencolor', self.mk_primitive_proc(pencolor))
-        self.define_var('penup', self.mk_primitive_proc(penup))
-        self.define_var('backward', self.mk_primitive_proc(backward))
-        self.define_var('pendown', self.mk_primitive_proc(pendown))
-        self.define_var('left', self.mk_primitive_proc(left))
-        # 可以在这里添加更多的外部函数
 
 
 if __name__ == "__main__":
+    from compile_cache import default_cache
+
     test_cases = [
         # 测试基本语法和运算
         '''
@@ -496,10 +510,10 @@ if __name__ == "__main__":
 
     for i, test in enumerate(test_cases):
         print(f"\n测试 {i + 1}:")
-        tokens = cilly_lexer(test)
+        tokens = default_cache.tokens(test)
         print("tokens:", tokens)
 
-        ast = cilly_parser(tokens)
+        ast = default_cache.ast(test)
         print("ast:", ast)
 
         print("执行结果:")
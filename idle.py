@@ -3,8 +3,10 @@ from tkinter import scrolledtext, ttk, messagebox
 import sys
 import io
 from lexical_analyzer import cilly_lexer, error as cilly_error
+from incremental_lexer import IncrementalLexer
 from syntactic_analyzer import cilly_parser
 from eval import cilly_eval, reset_environment, val
+from compile_cache import default_cache
 
 
 class CillyIDE:
@@ -17,6 +19,9 @@ class CillyIDE:
         self.interactive_mode = False
         self.run_count = 0  # 添加运行次数计数器
 
+        # 编辑器内容的增量词法分析, 再次运行时只重新扫描改动过的部分
+        self.lexer = IncrementalLexer()
+
         # 设置样式
         self.style = ttk.Style()
         self.style.configure("TButton", font=("微软雅黑", 10))
@@ -334,6 +339,10 @@ greet("me");
         """关闭交互模式窗口"""
         self.interactive_window.destroy()
 
+    def parse(self, code):
+        self.lexer.update(code)
+        return cilly_parser(self.lexer.tokens())
+
     def run_code(self):
         """运行用户编写的代码"""
         code = self.code_editor.get("1.0", tk.END)
@@ -350,10 +359,8 @@ greet("me");
             # 重置环境 - 只在主界面重置
             reset_environment()
             
-            # 词法分析
-            tokens = cilly_lexer(code)
-            # 语法分析
-            ast = cilly_parser(tokens)
+            # 代码没有改动过时直接从编译缓存取出 ast, 否则增量词法分析后再做语法分析
+            ast = default_cache.lookup('ast', code, lambda: self.parse(code))
             
             # 执行代码
             old_stdout = sys.stdout
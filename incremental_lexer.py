@@ -0,0 +1,320 @@
+'''
+cilly 增量词法分析
+
+编辑器每次修改 (offset, 删除长度, 插入文本) 后, 只从编辑点之前最后一个完整的 token
+重新扫描, 一旦新扫描出的 token 与旧 token 流在编辑点之后的某一行重新对齐就停止.
+
+token 分块存放, 每块带有整块的 offset 偏移和行号偏移.
+编辑点之后的块只需要修改偏移, 不逐个移动其中的 token.
+'''
+
+from array import array
+from bisect import bisect_left
+
+from lexical_analyzer import (error, mk_tk, TokenStore, match_tokens, cilly_token_tags,
+                              KIND_COMMENT, KIND_UNTERMINATED)
+
+# 每块 token 的个数, 编辑时只复制编辑点所在的块, 之后的块只改偏移
+BLOCK_SIZE = 512
+
+
+def scan(prog, pos=0, line=1, line_start=0):
+    """从 pos 开始扫描, 逐个产生 (kind, val, start, end, line, column)"""
+
+    def err(msg, line, column):
+        error('cilly lexer', f'第{line}行第{column}列 : {msg}')
+
+    count = prog.count
+    last = pos
+
+    for kind, v, start, end in match_tokens(prog, pos):
+        n = count('\n', last, start)
+        if n:
+            line = line + n
+            line_start = prog.rfind('\n', last, start) + 1
+        last = start
+
+        if kind >= 0:
+            yield kind, v, start, end, line, start - line_start + 1
+        elif kind == KIND_COMMENT:
+            continue
+        elif kind == KIND_UNTERMINATED:
+            end = len(prog)
+            n = count('\n', start, end)
+            if n:
+                line = line + n
+                line_start = prog.rfind('\n', start, end) + 1
+            err('期望", 实际eof', line, end - line_start + 1)
+        else:
+            err(f'非法字符{v}', line, start - line_start + 1)
+
+
+def shifted(arr, lo, hi, d):
+    if d == 0:
+        return arr[lo:hi]
+    return array('i', map(d.__add__, arr[lo:hi]))
+
+
+class TokenBlock:
+    """
+    一块 token 的列存储, 比 TokenStore 多了每个 token 的起止 offset,
+    块内的 offset 和行号都要再加上整块的 shift 和 line_shift
+    """
+
+    __slots__ = ('kinds', 'values', 'starts', 'ends', 'lines', 'columns', 'shift', 'line_shift')
+
+    def __init__(self, tokens=()):
+        self.kinds = array('i')
+        self.values = []
+        self.starts = array('i')
+        self.ends = array('i')
+        self.lines = array('i')
+        self.columns = array('i')
+        self.shift = 0
+        self.line_shift = 0
+
+        for kind, val, start, end, line, column in tokens:
+            self.kinds.append(kind)
+            self.values.append(val)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.lines.append(line)
+            self.columns.append(column)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def extend(self, block, lo, hi):
+        """追加 block[lo:hi], 两块的偏移不同时逐个换算成本块的偏移"""
+        d = block.shift - self.shift
+        ld = block.line_shift - self.line_shift
+        self.kinds.extend(block.kinds[lo:hi])
+        self.values.extend(block.values[lo:hi])
+        self.starts.extend(shifted(block.starts, lo, hi, d))
+        self.ends.extend(shifted(block.ends, lo, hi, d))
+        self.lines.extend(shifted(block.lines, lo, hi, ld))
+        self.columns.extend(block.columns[lo:hi])
+
+    def slice(self, lo, hi):
+        """block[lo:hi] 组成的新块, 偏移不变, 不需要逐个换算"""
+        b = TokenBlock()
+        b.shift = self.shift
+        b.line_shift = self.line_shift
+        b.extend(self, lo, hi)
+        return b
+
+    def split(self):
+        """超过两倍 BLOCK_SIZE 时切成若干块. 空块不保留, locate 要求每块至少有一个 token"""
+        n = len(self)
+        if n == 0:
+            return []
+        if n <= BLOCK_SIZE * 2:
+            return [self]
+        return [self.slice(lo, min(lo + BLOCK_SIZE, n)) for lo in range(0, n, BLOCK_SIZE)]
+
+    def tokens(self):
+        """按 scan 的格式产生块内的 token"""
+        shift = self.shift
+        line_shift = self.line_shift
+        for k in range(len(self.kinds)):
+            yield (self.kinds[k], self.values[k], self.starts[k] + shift, self.ends[k] + shift,
+                   self.lines[k] + line_shift, self.columns[k])
+
+
+def find_edit(old, new):
+    """求两段文本的公共前后缀, 把差异表示成一次编辑 (offset, deleted, inserted)"""
+    n = min(len(old), len(new))
+
+    # 二分求公共前缀, 每次只比较新增的一段, 总代价与文本长度成正比
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old.startswith(new[lo:mid], lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+
+    lo, hi = 0, n - prefix
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old.endswith(new[len(new) - mid:len(new) - lo], 0, len(old) - lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    suffix = lo
+
+    return prefix, len(old) - prefix - suffix, new[prefix:len(new) - suffix]
+
+
+class IncrementalLexer:
+    def __init__(self, prog=''):
+        self.text = ''
+        self.blocks = []
+        self.error = None
+        self.reset(prog)
+
+    def reset(self, prog):
+        """丢弃旧的 token 流, 整体重新扫描"""
+        self.text = prog
+        self.blocks = []
+        self.error = None
+
+        try:
+            self.blocks = TokenBlock(scan(prog)).split()
+        except Exception as e:
+            self.error = e
+            raise
+
+    def update(self, prog):
+        """编辑器只给出新全文时, 先求出差异再按一次编辑处理"""
+        offset, deleted, inserted = find_edit(self.text, prog)
+        return self.edit(offset, deleted, inserted)
+
+    def edit(self, offset, deleted, inserted):
+        """
+        应用一次编辑并增量重扫, 返回新文本中被重新扫描的区间 (start, end)
+        上一次扫描出错时没有可信的旧 token 流, 直接整体重扫
+        """
+        old = self.text
+        text = old[:offset] + inserted + old[offset + deleted:]
+
+        if self.error is not None:
+            self.reset(text)
+            return 0, len(text)
+
+        old_end = offset + deleted
+        new_end = offset + len(inserted)
+        delta = len(inserted) - deleted
+        line_delta = inserted.count('\n') - old.count('\n', offset, old_end)
+
+        blocks = self.blocks
+
+        # 编辑点之前最后一个完整结束的 token 前面都不受影响, 从它开始重新扫描,
+        # 与 finditer 从上一个 token 结尾继续匹配的状态完全一致
+        i, k = self.step_back(*self.locate('ends', offset))
+        if i < 0:
+            i, k = 0, 0
+            pos, line, line_start = 0, 1, 0
+        else:
+            b = blocks[i]
+            pos = b.starts[k] + b.shift
+            line = b.lines[k] + b.line_shift
+            line_start = pos - b.columns[k] + 1
+
+        # 起点在被删除区间之后的旧 token 才可能与新扫描的结果重新对齐
+        olds = self.positions_from(*self.locate('starts', old_end))
+        cand = next(olds, None)
+        sync = None
+
+        new_tokens = []
+        try:
+            for t in scan(text, pos, line, line_start):
+                start = t[2]
+                if start >= new_end:
+                    while cand is not None and cand[2] + delta < start:
+                        cand = next(olds, None)
+                    # 中间隔着换行才算对齐, 这样对齐点之后的 token 列号都不变
+                    if cand is not None and cand[2] + delta == start and text.find('\n', new_end, start) >= 0:
+                        sync = cand
+                        break
+                new_tokens.append(t)
+        except Exception as e:
+            self.text = text
+            self.blocks = []
+            self.error = e
+            raise
+
+        # 编辑点所在的块拆成两块: 旧块的前半加上新扫描的 token, 以及对齐块的后半.
+        # 两块都沿用原来的偏移, 只有新 token 和太小而要并入邻块的部分需要逐个换算
+        if i < len(blocks):
+            left = blocks[i].slice(0, k)
+        else:
+            left = TokenBlock()
+        left.extend(TokenBlock(new_tokens), 0, len(new_tokens))
+
+        if sync is not None:
+            si, sk, _ = sync
+            right = blocks[si].slice(sk, len(blocks[si]))
+            rest = [right] + blocks[si + 1:]
+            for b in rest[1:]:
+                b.shift = b.shift + delta
+                b.line_shift = b.line_shift + line_delta
+            right.shift = right.shift + delta
+            right.line_shift = right.line_shift + line_delta
+        else:
+            rest = []
+
+        before = blocks[:i]
+        if rest and len(rest[0]) < BLOCK_SIZE // 4:
+            left.extend(rest[0], 0, len(rest[0]))
+            rest = rest[1:]
+        if before and len(left) < BLOCK_SIZE // 4:
+            before[-1].extend(left, 0, len(left))
+            left = before.pop()
+
+        self.text = text
+        self.blocks = before + left.split() + rest
+
+        return pos, sync[2] + delta if sync is not None else len(text)
+
+    def locate(self, column, offset):
+        """找到第一个 column('starts' 或 'ends') 不小于 offset 的 token, 返回 (块下标, 块内下标)"""
+        blocks = self.blocks
+
+        lo, hi = 0, len(blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            b = blocks[mid]
+            if getattr(b, column)[-1] + b.shift < offset:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == len(blocks):
+            return lo, 0
+
+        b = blocks[lo]
+        return lo, bisect_left(getattr(b, column), offset - b.shift)
+
+    def step_back(self, i, k):
+        """(i, k) 的前一个 token, 没有时返回 (-1, 0)"""
+        if k > 0:
+            return i, k - 1
+        if i > 0:
+            return i - 1, len(self.blocks[i - 1]) - 1
+        return -1, 0
+
+    def positions_from(self, i, k):
+        """从 (i, k) 开始依次产生 (块下标, 块内下标, 旧 offset)"""
+        blocks = self.blocks
+        while i < len(blocks):
+            b = blocks[i]
+            starts = b.starts
+            shift = b.shift
+            for kk in range(k, len(starts)):
+                yield i, kk, starts[kk] + shift
+            i = i + 1
+            k = 0
+
+    def __len__(self):
+        return sum(len(b) for b in self.blocks)
+
+    def __iter__(self):
+        tags = cilly_token_tags
+        for b in self.blocks:
+            for kind, val, _, _, line, column in b.tokens():
+                yield mk_tk(tags[kind], val, line, column)
+
+    def tokens(self):
+        """当前 token 流的 TokenStore, 交给 cilly_parser"""
+        if self.error is not None:
+            raise self.error
+
+        r = TokenStore(self.text)
+        for b in self.blocks:
+            r.kinds.extend(b.kinds)
+            r.values.extend(b.values)
+            r.starts.extend(map(b.shift.__add__, b.starts))
+            r.lengths.extend(map(int.__sub__, b.ends, b.starts))
+        return r
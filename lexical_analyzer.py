@@ -23,6 +23,12 @@ ws : (' ' | '\r' | '\n' | '\t)+
 comment : '#' 非换行符号* '\r'? '\n'
 '''
 
+import mmap
+import os
+import re
+from array import array
+from bisect import bisect_right
+
 
 def error(src, msg, token=None):
     if token:
@@ -53,11 +59,21 @@ def tk_column(t):
     return t[3]
 
 
+def make_line_starts(source):
+    """源码中每一行行首的 offset, 升序排列, 第一项总是 0"""
+    nl = '\n' if isinstance(source, str) else b'\n'
+    r = array('q', [0])
+    pos = source.find(nl)
+    while pos >= 0:
+        r.append(pos + 1)
+        pos = source.find(nl, pos + 1)
+    return r
+
+
 def make_str_reader(s, err):
     cur = None
     pos = -1
-    line = 1
-    line_start = 0
+    line_starts = None
 
     def peek(p=0):
         if pos + p >= len(s):
@@ -72,7 +88,7 @@ def make_str_reader(s, err):
         return next()
 
     def next():
-        nonlocal pos, cur, line, line_start
+        nonlocal pos, cur
 
         old = cur
         pos = pos + 1
@@ -81,16 +97,23 @@ def make_str_reader(s, err):
             cur = 'eof'
         else:
             cur = s[pos]
-            if cur == '\n':
-                line = line + 1
-                line_start = pos + 1
 
         return old
 
+    def get_line_start():
+        # 行号在需要时才由行首表二分查找, 当前字符是换行时算作下一行
+        nonlocal line_starts
+        if line_starts is None:
+            line_starts = make_line_starts(s)
+        line = bisect_right(line_starts, pos + 1)
+        return line, line_starts[line - 1]
+
     def get_line():
+        line, _ = get_line_start()
         return line
 
     def get_column():
+        _, line_start = get_line_start()
         return pos - line_start + 1
 
     next()
@@ -116,8 +139,95 @@ cilly_keywords = [
     'var', 'print', 'if', 'else', 'while', 'for', 'break', 'continue', 'return', 'fun', 'true', 'false', 'null'
 ]
 
+'''
+紧凑 token 表示
+
+token 类别编号由 cilly_op1, cilly_op2 和 cilly_keywords 生成, 
+cilly_token_tags[kind] 是与 mk_tk 相同的字符串 tag
+'''
+
+cilly_token_tags = ['eof', 'id', 'num', 'str'] + cilly_op1 + list(cilly_op2) + list(cilly_op2.values()) + cilly_keywords
+
+cilly_token_kinds = {tag: kind for kind, tag in enumerate(cilly_token_tags)}
+
+KIND_EOF = cilly_token_kinds['eof']
+KIND_ID = cilly_token_kinds['id']
+KIND_NUM = cilly_token_kinds['num']
+KIND_STR = cilly_token_kinds['str']
+
+
+class TokenStore:
+    """
+    列式 token 存储: kind, 起始 offset 和长度各占一列 array, 值放在 values 列表中.
+    token 不保存行号列号, 需要时由源码的行首表二分查找得到,
+    下标访问和迭代得到与 mk_tk 相同的 [tag, val, line, column] 兼容视图
+    """
+
+    __slots__ = ('kinds', 'values', 'starts', 'lengths', 'source', 'line_starts')
+
+    def __init__(self, source=''):
+        self.kinds = array('i')
+        self.values = []
+        self.starts = array('q')
+        self.lengths = array('i')
+        self.source = source
+        self.line_starts = None
+
+    def append(self, kind, val, start, length):
+        self.kinds.append(kind)
+        self.values.append(val)
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def tag(self, i):
+        return cilly_token_tags[self.kinds[i]]
+
+    def get_line_starts(self):
+        # 行首表每份源码只在第一次需要行号时建立一次
+        if self.line_starts is None:
+            self.line_starts = make_line_starts(self.source)
+        return self.line_starts
+
+    def column(self, line_start, offset):
+        return offset - line_start + 1
+
+    def position(self, offset):
+        """源码 offset 对应的 (行号, 列号)"""
+        line_starts = self.get_line_starts()
+        line = bisect_right(line_starts, offset)
+        return line, self.column(line_starts[line - 1], offset)
+
+    def line_column(self, i):
+        return self.position(self.starts[i])
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        line, column = self.line_column(i)
+        return mk_tk(cilly_token_tags[self.kinds[i]], self.values[i], line, column)
+
+    def __iter__(self):
+        # 顺序遍历时行号单调增加, 沿行首表向前走即可, 不必每个 token 二分
+        tags = cilly_token_tags
+        line_starts = self.get_line_starts()
+        n = len(line_starts)
+        line = 1
+        for kind, val, start in zip(self.kinds, self.values, self.starts):
+            while line < n and line_starts[line] <= start:
+                line = line + 1
+            yield mk_tk(tags[kind], val, line, self.column(line_starts[line - 1], start))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def cilly_lexer_ref(prog):
+    """逐字符扫描的词法分析器, 仅作为 cilly_lexer 的参考实现保留"""
 
-def cilly_lexer(prog):
     def err(msg):
         # 获取当前的行号和列号
         line = get_line()
@@ -243,6 +353,283 @@ def cilly_lexer(prog):
     return program()
 
 
+'''
+cilly 正则主模式词法分析器
+
+所有词素合并为一个编译好的正则分支表达式, 每次匹配整体消费一个词素,
+不再逐字符调用 peek/next, 也不再用 r = r + next() 拼接字符串
+'''
+
+
+def make_op_pattern():
+    ops = set(cilly_op1) | set(cilly_op2) | set(cilly_op2.values())
+    # 长的运算符在前, 保证 '>=' 优先于 '>'
+    return '|'.join(re.escape(op) for op in sorted(ops, key=len, reverse=True))
+
+
+# 分支前的空白被一并吃掉, 每个词素只对应一次匹配, 分组序号即词素类别
+CILLY_TOKEN_RE = re.compile(
+    r'[ \t\r\n]*(?:'
+    r'([0-9]+(?:\.[0-9]*)?)'
+    r'|([_a-zA-Z][_0-9a-zA-Z]*)'
+    rf'|({make_op_pattern()})'
+    r'|("[^"]*")'
+    r'|(#[^\r\n]*)'
+    r'|("[^"]*)'
+    r'|([^ \t\r\n])'
+    r')'
+)
+
+RE_NUM = 1
+RE_ID = 2
+RE_OP = 3
+RE_STR = 4
+RE_COMMENT = 5
+RE_UNTERMINATED = 6
+RE_ILLEGAL = 7
+
+cilly_keyword_set = frozenset(cilly_keywords)
+
+# 同一个主模式的字节版本, 供 cilly_lexer_mmap 直接在 mmap 的字节上匹配
+CILLY_TOKEN_BYTES_RE = re.compile(CILLY_TOKEN_RE.pattern.encode('ascii'))
+
+# 运算符和关键字的 kind, 标识符不在其中. 字节版本的键是 ascii 字节
+cilly_fixed_kinds = {tag: cilly_token_kinds[tag] for tag in cilly_token_tags[KIND_STR + 1:]}
+cilly_fixed_kinds_bytes = {tag.encode('ascii'): kind for tag, kind in cilly_fixed_kinds.items()}
+
+# match_tokens 产生的不是 token 的词素, kind 为负数
+KIND_COMMENT = -1
+KIND_UNTERMINATED = -2
+KIND_ILLEGAL = -3
+
+
+def match_tokens(text, pos=0):
+    """
+    用主模式从 pos 开始匹配 text (str 或 bytes), 逐个产生 (kind, val, start, end).
+    start 是词素的起点, 不含前面的空白; end 是匹配的终点. 字节版本的标识符和字符串解码为 str.
+
+    注释、未闭合的字符串和非法字符也产生, kind 分别是 KIND_COMMENT、KIND_UNTERMINATED 和 KIND_ILLEGAL,
+    非法字符的 val 是这个字符. 如何跳过注释、在哪里报错由调用者决定.
+    """
+    if isinstance(text, str):
+        token_re, kinds, dot = CILLY_TOKEN_RE, cilly_fixed_kinds, '.'
+    else:
+        token_re, kinds, dot = CILLY_TOKEN_BYTES_RE, cilly_fixed_kinds_bytes, b'.'
+    decode = not isinstance(text, str)
+
+    for m in token_re.finditer(text, pos):
+        g = m.lastindex
+        start = m.start(g)
+        end = m.end()
+
+        if g == RE_OP:
+            yield kinds[m.group(g)], None, start, end
+        elif g == RE_ID:
+            v = m.group(g)
+            kind = kinds.get(v)
+            if kind is not None:
+                yield kind, None, start, end
+            else:
+                yield KIND_ID, v.decode('ascii') if decode else v, start, end
+        elif g == RE_NUM:
+            v = m.group(g)
+            yield KIND_NUM, float(v) if dot in v else int(v), start, end
+        elif g == RE_STR:
+            v = text[start + 1:end - 1]
+            yield KIND_STR, v.decode('utf-8') if decode else v, start, end
+        elif g == RE_COMMENT:
+            yield KIND_COMMENT, None, start, end
+        elif g == RE_UNTERMINATED:
+            yield KIND_UNTERMINATED, None, start, end
+        elif decode:
+            # 非法字符可能是多字节的 utf-8 字符, 解码出完整的一个字符
+            yield KIND_ILLEGAL, text[start:start + 4].decode('utf-8', 'ignore')[:1] or text[start:start + 1], start, end
+        else:
+            yield KIND_ILLEGAL, m.group(g), start, end
+
+
+def read_chunks(source, chunk_size):
+    if isinstance(source, str):
+        yield source
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+
+def cilly_lexer_stream(source, chunk_size=64 * 1024):
+    """
+    流式词法分析: source 可以是字符串、文件对象或文本块的迭代器,
+    按块读入并逐个 yield token, 内存只保留当前块和一个跨块的词素
+    """
+
+    def err(msg, line, column):
+        error('cilly lexer', f'第{line}行第{column}列 : {msg}')
+
+    tags = cilly_token_tags
+    chunks = read_chunks(source, chunk_size)
+
+    buf = next(chunks, '')
+    more = next(chunks, None)
+
+    pos = 0  # 下次从这里开始匹配
+    line = 1
+    line_start = 0  # 当前行行首在 buf 中的位置, 丢弃已扫描部分后可能为负
+    last = 0  # 换行已经统计到的位置
+
+    while True:
+        n = len(buf)
+        count = buf.count
+
+        for kind, v, start, end in match_tokens(buf, pos):
+            # 匹配碰到块尾时词素可能跨越块边界, 读入下一块后从 pos 重新匹配
+            if more is not None and (kind == KIND_UNTERMINATED or end == n):
+                break
+
+            k = count('\n', last, start)
+            if k:
+                line = line + k
+                line_start = buf.rfind('\n', last, start) + 1
+            last = start
+            pos = end
+
+            if kind >= 0:
+                yield mk_tk(tags[kind], v, line, start - line_start + 1)
+            elif kind == KIND_COMMENT:
+                continue
+            elif kind == KIND_UNTERMINATED:
+                # 与参考实现一致, 在源码末尾报告缺少的右引号
+                k = count('\n', start, n)
+                if k:
+                    line = line + k
+                    line_start = buf.rfind('\n', start, n) + 1
+                err('期望", 实际eof', line, n - line_start + 1)
+            else:
+                err(f'非法字符{v}', line, start - line_start + 1)
+
+        if more is None:
+            return
+
+        # 丢弃已经扫描过的部分, 行首位置随之平移
+        k = count('\n', last, pos)
+        if k:
+            line = line + k
+            line_start = buf.rfind('\n', last, pos) + 1
+        buf = buf[pos:] + more
+        line_start = line_start - pos
+        pos = 0
+        last = 0
+
+        more = next(chunks, None)
+
+
+def cilly_lexer(prog):
+    """一次性词法分析整个源码, 结果直接写入 TokenStore, token 只记录 offset 和长度"""
+
+    r = TokenStore(prog)
+
+    def err(msg, offset):
+        line, column = r.position(offset)
+        error('cilly lexer', f'第{line}行第{column}列 : {msg}')
+
+    append_kind = r.kinds.append
+    append_val = r.values.append
+    append_start = r.starts.append
+    append_length = r.lengths.append
+
+    for kind, v, start, end in match_tokens(prog):
+        if kind < 0:
+            if kind == KIND_COMMENT:
+                continue
+            if kind == KIND_UNTERMINATED:
+                # 与参考实现一致, 在源码末尾报告缺少的右引号
+                err('期望", 实际eof', len(prog))
+            err(f'非法字符{v}', start)
+
+        append_kind(kind)
+        append_val(v)
+        append_start(start)
+        append_length(end - start)
+
+    return r
+
+
+'''
+cilly 内存映射词法分析
+
+直接在 mmap 的字节上匹配, 只解码需要保存的标识符和字符串词素,
+token 的位置是映射中的字节 offset
+'''
+
+class MappedTokenStore(TokenStore):
+    """
+    cilly_lexer_mmap 的结果, starts 列是映射中的字节 offset, 列号仍按字符计, 与 cilly_lexer 一致.
+    source 是文件的映射, 用完后 close() 或用 with 语句关闭, 关闭后文件才能改写或删除 (Windows),
+    之后不能再取 token 的行号列号
+    """
+
+    __slots__ = ()
+
+    def column(self, line_start, offset):
+        return len(self.source[line_start:offset].decode('utf-8', 'replace')) + 1
+
+    def close(self):
+        if isinstance(self.source, mmap.mmap):
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def cilly_lexer_mmap(path):
+    """把源文件映射进内存后直接扫描字节, 不先把整个文件读成 str. 返回的 MappedTokenStore 用完后要关闭"""
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return MappedTokenStore(b'')
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    r = MappedTokenStore(source)
+
+    def err(msg, offset):
+        line, column = r.position(offset)
+        error('cilly lexer', f'第{line}行第{column}列 : {msg}')
+
+    append_kind = r.kinds.append
+    append_val = r.values.append
+    append_start = r.starts.append
+    append_length = r.lengths.append
+
+    try:
+        for kind, v, start, end in match_tokens(source):
+            if kind < 0:
+                if kind == KIND_COMMENT:
+                    continue
+                if kind == KIND_UNTERMINATED:
+                    err('期望", 实际eof', len(source))
+                err(f'非法字符{v}', start)
+
+            append_kind(kind)
+            append_val(v)
+            append_start(start)
+            append_length(end - start)
+    except BaseException:
+        # 出错时没有人拿到结果, 在这里关闭映射
+        r.close()
+        raise
+
+    return r
+
+
 if __name__ == "__main__":
     from syntactic_analyzer import cilly_parser
 
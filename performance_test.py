@@ -1,16 +1,29 @@
+import contextlib
+import io
+import os
 import time
-from lexical_analyzer import cilly_lexer
-from syntactic_analyzer import cilly_parser
-from vm import cilly_vm_compiler, cilly_vm
-from eval import cilly_eval, reset_environment
+import tracemalloc
+from lexical_analyzer import cilly_lexer, cilly_lexer_ref, cilly_lexer_stream, cilly_lexer_mmap
+from incremental_lexer import IncrementalLexer
+from syntactic_analyzer import cilly_parser, cilly_parser_ref
+from vm import cilly_vm_compiler, cilly_vm, cilly_vm_ref
+import vm
+import register_vm
+from register_vm import cilly_reg_compiler, cilly_reg_vm
+from eval import cilly_eval, reset_environment, Environment
+from closure_eval import cilly_closure_eval
+from cek_eval import cilly_cek_eval, CEKMachine
+from compile_cache import CompileCache, default_cache
+from compact_ast import to_compact
+from values import to_tagged
+import bytecode_file
 
 def test_performance(code, iterations=10):
     """比较虚拟机和解释器的性能"""
     print(f"程序代码:\n{code}\n")
     
-    # 解析代码
-    tokens = cilly_lexer(code)
-    ast = cilly_parser(tokens)
+    # 解析代码, 源码没有改动时直接取编译缓存中的 ast
+    ast = default_cache.ast(code)
     
     # 测试解释器性能
     reset_environment()
@@ -55,6 +68,616 @@ def test_performance(code, iterations=10):
     
     print("-" * 50)
 
+LEXER_CORPUS_UNIT = '''
+# 生成的测试程序片段
+var total_count = 0;
+var ratio = 3.1415926;
+fun step(a, b) {
+    if (a >= b && b != 0 || !(a < 0)) {
+        return a * b - a / b ^ 2;
+    }
+    return a > b ? a : b;
+}
+while (total_count <= 100) {
+    total_count = total_count + 1;
+    print("count =", step(total_count, ratio));
+}
+'''
+
+
+def make_lexer_corpus(size_mb):
+    """把示例程序重复拼接成约 size_mb MB 的大语料"""
+    n = max(1, int(size_mb * 1024 * 1024 / len(LEXER_CORPUS_UNIT)))
+    return LEXER_CORPUS_UNIT * n
+
+
+def iter_lexer_corpus(size_mb):
+    """与 make_lexer_corpus 内容相同, 但逐块产生, 不在内存中拼出整个源码"""
+    n = max(1, int(size_mb * 1024 * 1024 / len(LEXER_CORPUS_UNIT)))
+    for _ in range(n):
+        yield LEXER_CORPUS_UNIT
+
+
+def bench_lexer(size_mb=4, ref_size_mb=0.5):
+    """词法分析吞吐量(MB/s), 对比正则主模式词法分析器与逐字符的参考实现"""
+    print(f"词法分析基准: 语料约 {size_mb} MB")
+
+    corpus = make_lexer_corpus(size_mb)
+    mb = len(corpus) / (1024 * 1024)
+    start_time = time.perf_counter()
+    tokens = cilly_lexer(corpus)
+    elapsed = time.perf_counter() - start_time
+    print(f"cilly_lexer: {len(tokens)} 个token, {elapsed:.3f} 秒, {mb / elapsed:.2f} MB/s")
+
+    # 参考实现太慢, 只在较小的语料上测量
+    ref_corpus = make_lexer_corpus(ref_size_mb)
+    ref_mb = len(ref_corpus) / (1024 * 1024)
+    start_time = time.perf_counter()
+    ref_tokens = cilly_lexer_ref(ref_corpus)
+    ref_elapsed = time.perf_counter() - start_time
+    print(f"cilly_lexer_ref: {len(ref_tokens)} 个token, {ref_elapsed:.3f} 秒, {ref_mb / ref_elapsed:.2f} MB/s")
+
+    if ref_tokens != cilly_lexer(ref_corpus):
+        print("警告: 两个词法分析器的输出不一致")
+
+    print("-" * 50)
+
+
+def bench_lexer_memory(sizes_mb=(0.25, 0.5, 1)):
+    """对比 token 列表、TokenStore 与流式词法分析的内存峰值"""
+    print("词法分析内存峰值:")
+
+    for size_mb in sizes_mb:
+        tracemalloc.start()
+        tokens = list(cilly_lexer_stream(make_lexer_corpus(size_mb)))
+        _, list_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del tokens
+
+        tracemalloc.start()
+        tokens = cilly_lexer(make_lexer_corpus(size_mb))
+        _, store_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del tokens
+
+        tracemalloc.start()
+        count = 0
+        for _ in cilly_lexer_stream(iter_lexer_corpus(size_mb)):
+            count += 1
+        _, stream_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"{size_mb} MB, {count} 个token: token列表 {list_peak / 1024 / 1024:.2f} MB, "
+              f"TokenStore {store_peak / 1024 / 1024:.2f} MB, "
+              f"cilly_lexer_stream {stream_peak / 1024:.1f} KB")
+
+    print("-" * 50)
+
+
+def bench_lexer_mmap(size_mb=4, memory_size_mb=1):
+    """对比读入字符串后词法分析与内存映射词法分析的耗时和 Python 堆内存峰值"""
+    import os
+    import tempfile
+
+    def read_and_lex(path):
+        with open(path, encoding='utf-8') as f:
+            return cilly_lexer(f.read())
+
+    def write_corpus(mb):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.cilly', delete=False) as f:
+            f.write(make_lexer_corpus(mb))
+            return f.name
+
+    print(f"内存映射词法分析基准: 源文件约 {size_mb} MB")
+
+    path = write_corpus(size_mb)
+    try:
+        for name, lex in [("读入字符串 + cilly_lexer", read_and_lex), ("cilly_lexer_mmap", cilly_lexer_mmap)]:
+            start_time = time.perf_counter()
+            tokens = lex(path)
+            elapsed = time.perf_counter() - start_time
+            print(f"{name}: {len(tokens)} 个token, {elapsed:.3f} 秒")
+            del tokens
+    finally:
+        os.unlink(path)
+
+    # tracemalloc 会大幅拖慢执行, 内存峰值在较小的文件上单独测量
+    path = write_corpus(memory_size_mb)
+    try:
+        for name, lex in [("读入字符串 + cilly_lexer", read_and_lex), ("cilly_lexer_mmap", cilly_lexer_mmap)]:
+            tracemalloc.start()
+            tokens = lex(path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{name}: {memory_size_mb} MB 源文件, Python 堆内存峰值 {peak / 1024 / 1024:.2f} MB")
+            del tokens
+    finally:
+        os.unlink(path)
+
+    print("-" * 50)
+
+
+def bench_incremental_lexer(lines=50000, edits=1000):
+    """在约 lines 行的缓冲区上随机做单字符插入/删除, 统计每次增量重扫的耗时"""
+    import random
+
+    print(f"增量词法分析基准: {lines} 行, {edits} 次编辑")
+
+    unit = LEXER_CORPUS_UNIT.replace('# 生成的测试程序片段', '# generated')
+    text = unit * max(1, lines // unit.count('\n'))
+
+    start_time = time.perf_counter()
+    lexer = IncrementalLexer(text)
+    print(f"首次扫描: {len(lexer)} 个token, {time.perf_counter() - start_time:.3f} 秒")
+
+    rng = random.Random(0)
+    times = []
+    while len(times) < edits:
+        offset = rng.randrange(1, len(text))
+        # 不在数字中间编辑, 保证每次编辑后仍是合法的源码
+        if text[offset - 1] in '0123456789.' or text[offset] in '0123456789.':
+            continue
+        if text[offset] == ' ' and rng.random() < 0.5:
+            deleted, inserted = 1, ''
+        else:
+            deleted, inserted = 0, rng.choice(['x', ' ', '\n', ';', '1'])
+
+        start_time = time.perf_counter()
+        lexer.edit(offset, deleted, inserted)
+        times.append(time.perf_counter() - start_time)
+        text = text[:offset] + inserted + text[offset + deleted:]
+
+    times.sort()
+    print(f"每次编辑: 中位数 {times[len(times) // 2] * 1000:.3f} ms, "
+          f"p95 {times[len(times) * 95 // 100] * 1000:.3f} ms, 最大 {times[-1] * 1000:.3f} ms")
+
+    start_time = time.perf_counter()
+    tokens = cilly_lexer(text)
+    print(f"对比: 整体重新扫描 {time.perf_counter() - start_time:.3f} 秒")
+
+    if lexer.tokens() != tokens:
+        print("警告: 增量结果与整体重新扫描不一致")
+
+    print("-" * 50)
+
+
+def bench_parser(size_mb=1):
+    """语法分析吞吐量, 以 token/s 和顶层语句/s 计, 对比表驱动分析器与闭包实现的参考分析器"""
+    print(f"语法分析基准: 语料约 {size_mb} MB")
+
+    tokens = cilly_lexer(make_lexer_corpus(size_mb))
+    for name, parse in [("cilly_parser", cilly_parser), ("cilly_parser_ref", cilly_parser_ref)]:
+        start_time = time.perf_counter()
+        ast = parse(tokens)
+        elapsed = time.perf_counter() - start_time
+        print(f"{name}: {len(tokens)} 个token, {len(ast[1])} 条顶层语句, {elapsed:.3f} 秒, "
+              f"{len(tokens) / elapsed:.0f} token/s, {len(ast[1]) / elapsed:.0f} 语句/s")
+
+    print("-" * 50)
+
+
+def make_compile_corpus(functions):
+    """生成含 functions 个函数定义的程序, 只使用 cilly_vm_compiler 支持的语句"""
+    return ''.join(f'var f{i} = fun(a, b) {{ if (a > b && b != 0) return a - b; else return a + b * 2; }};\n'
+                   f'print(f{i}({i}, 4), "f{i}");\n' for i in range(functions))
+
+
+def bench_compile_cache(functions=200):
+    """编译缓存: 冷启动完整编译, 对比内存命中和新进程从磁盘命中的耗时"""
+    import shutil
+    import tempfile
+
+    print(f"编译缓存基准: {functions} 个函数")
+
+    source = make_compile_corpus(functions)
+    directory = tempfile.mkdtemp()
+    try:
+        cache = CompileCache(directory)
+
+        start_time = time.perf_counter()
+        expected = cache.compile(source)
+        print(f"冷启动 (词法 + 语法 + 编译): {time.perf_counter() - start_time:.4f} 秒")
+
+        start_time = time.perf_counter()
+        cache.compile(source)
+        print(f"内存缓存命中: {time.perf_counter() - start_time:.6f} 秒")
+
+        # 新的缓存对象相当于重新启动的进程, 内存层是空的
+        cache = CompileCache(directory)
+        start_time = time.perf_counter()
+        result = cache.compile(source)
+        print(f"磁盘缓存命中: {time.perf_counter() - start_time:.4f} 秒")
+
+        if result != expected:
+            print("警告: 磁盘缓存的结果与编译结果不一致")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print("-" * 50)
+
+
+def bench_compact_ast(size_mb=1):
+    """列表形式与紧凑形式 AST 的内存占用, 以及两种形式的编译耗时"""
+    print(f"紧凑 AST 基准: 语料约 {size_mb} MB")
+
+    tokens = cilly_lexer(make_lexer_corpus(size_mb))
+
+    tracemalloc.start()
+    ast = cilly_parser(tokens)
+    list_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    compact = to_compact(ast)
+    compact_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"列表形式: {list_size / 1024 / 1024:.2f} MB, 紧凑形式: {compact_size / 1024 / 1024:.2f} MB, "
+          f"为列表形式的 {compact_size / list_size:.0%}")
+    del ast, compact
+
+    # 先建立列表形式再转换时两棵树同时存在, 语法分析器直接生成紧凑节点时没有列表形式
+    for name, parse in [("列表形式再 to_compact", lambda: to_compact(cilly_parser(tokens))),
+                        ("直接生成紧凑形式", lambda: cilly_parser(tokens, compact=True))]:
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        compact = parse()
+        elapsed = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del compact
+        print(f"{name}: 峰值 {peak / 1024 / 1024:.2f} MB, {elapsed:.3f} 秒 (tracemalloc 下)")
+
+    source = make_compile_corpus(200)
+    ast = cilly_parser(cilly_lexer(source))
+    compact = to_compact(ast)
+    for name, tree in [("列表形式", ast), ("紧凑形式", compact)]:
+        start_time = time.perf_counter()
+        cilly_vm_compiler(tree, [], [], [])
+        print(f"{name}编译: {time.perf_counter() - start_time:.4f} 秒")
+
+    print("-" * 50)
+
+
+def bench_bytecode_file(functions=200, repeat=20):
+    """装入 .cillyc 文件的耗时, 对比每次重新词法分析、语法分析和编译"""
+    import shutil
+    import tempfile
+
+    print(f"字节码文件基准: {functions} 个函数")
+
+    source = make_compile_corpus(functions)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'corpus.cillyc')
+
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+        compile_time = (time.perf_counter() - start_time) / repeat
+        print(f"重新编译: {compile_time:.4f} 秒")
+
+        bytecode_file.dump(path, code, consts, scopes, source)
+        print(f"文件大小: {os.path.getsize(path)} 字节, {len(code)} 条指令字, {len(consts)} 个常量")
+
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            result = bytecode_file.load(path, source)
+            result.close()
+        load_time = (time.perf_counter() - start_time) / repeat
+        print(f"装入字节码文件: {load_time:.6f} 秒, 比重新编译快 {compile_time / load_time:.1f} 倍")
+
+        with bytecode_file.load(path, source) as result:
+            if list(result[0]) != code:
+                print("警告: 装入的指令与编译结果不一致")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print("-" * 50)
+
+
+def make_vm_loop(n):
+    """手写的循环字节码: sum = 0 + 1 + ... + (n - 1), 返回 (code, consts, 执行的指令条数)"""
+    consts = [['num', 0], ['num', 1], ['num', n]]
+    code = [
+        vm.ENTER_FRAME, 2,
+        vm.LOAD_CONST, 0, vm.STORE_LOCAL, 0,                          # i = 0
+        vm.LOAD_CONST, 0, vm.STORE_LOCAL, 1,                          # sum = 0
+        vm.LOAD_LOCAL, 0, vm.LOAD_CONST, 2, vm.BINARY_LT,             # 10: i < n
+        vm.JMP_FALSE, 33,
+        vm.LOAD_LOCAL, 1, vm.LOAD_LOCAL, 0, vm.BINARY_ADD, vm.STORE_LOCAL, 1,  # sum = sum + i
+        vm.LOAD_LOCAL, 0, vm.LOAD_CONST, 1, vm.BINARY_ADD, vm.STORE_LOCAL, 0,  # i = i + 1
+        vm.JMP, 10,
+        vm.LOAD_LOCAL, 1, vm.PRINT_ITEM, vm.PRINT_NEWLINE,            # 33: print(sum)
+    ]
+    return code, consts, 5 + 13 * n + 4 + 3
+
+
+def bench_vm_dispatch(n=200000):
+    """预译码的 cilly_vm 与逐条查表分派的 cilly_vm_ref, 以每秒执行的指令条数计"""
+    print(f"虚拟机分派基准: 循环 {n} 次")
+
+    code, consts, count = make_vm_loop(n)
+    times = {}
+    for name, run in [("cilly_vm", cilly_vm), ("cilly_vm_ref", cilly_vm_ref)]:
+        start_time = time.perf_counter()
+        run(code, consts, [])
+        times[name] = time.perf_counter() - start_time
+        print(f"{name}: {times[name]:.3f} 秒, {count / times[name]:.0f} 条指令/秒")
+
+    print(f"预译码加速 {times['cilly_vm_ref'] / times['cilly_vm']:.2f} 倍")
+    print("-" * 50)
+
+
+def count_instructions(code, consts, ops_name=vm.OPS_NAME):
+    """主程序和常量表中各个函数的指令条数, 寄存器虚拟机的代码用 register_vm.OPS_NAME 解码"""
+    n = 0
+    pc = 0
+    while pc < len(code):
+        pc = pc + ops_name[code[pc]][1]
+        n = n + 1
+    for c in consts:
+        if isinstance(c, vm.CodeObject):
+            n = n + count_instructions(c.code, c.consts, ops_name)
+    return n
+
+
+def make_call_loop_source(n):
+    """两层循环中调用函数的程序, 外层循环 n 次"""
+    return f'''
+    var total = 0;
+    var step = fun(a, b) {{
+        if (a >= b && b != 0 || false) return a - b; else return a > b ? a : b;
+        print("unreachable");
+    }};
+    for (var i = 0; i < {n}; i = i + 1;) {{
+        var j = 0;
+        while (true) {{
+            j = j + 1;
+            total = total + step(i, j);
+            if (j >= 20) break;
+        }}
+    }}
+    print(total);
+    '''
+
+
+def bench_peephole(n=200, repeat=5):
+    """各个优化级别的指令条数和 cilly_vm 的执行时间, 时间取 repeat 次中最短的一次"""
+    print(f"窥孔优化基准: 循环 {n} 次")
+
+    ast = cilly_parser(cilly_lexer(make_call_loop_source(n)))
+    for level in (0, 1, 2):
+        code, consts, scopes = cilly_vm_compiler(ast, [], [], [], optimize=level)
+        elapsed = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            cilly_vm(code, consts, scopes)
+            elapsed = min(elapsed, time.perf_counter() - start_time)
+        print(f"优化级别 {level}: {count_instructions(code, consts)} 条指令, 执行 {elapsed:.3f} 秒")
+    print("-" * 50)
+
+
+def bench_register_vm(n=200, repeat=5):
+    """同一棵 ast 在栈式虚拟机和寄存器虚拟机上的指令条数 (静态/实际执行) 和执行时间"""
+    print(f"寄存器虚拟机基准: 循环 {n} 次, 以及 fib(15)")
+
+    sources = [make_call_loop_source(n), test_cases[3]]
+    for source in sources:
+        ast = cilly_parser(cilly_lexer(source))
+        programs = [
+            ("栈式, 不优化", cilly_vm_compiler(ast, [], [], []), cilly_vm),
+            ("栈式, 优化级别 2", cilly_vm_compiler(ast, [], [], [], optimize=2), cilly_vm),
+            ("寄存器", cilly_reg_compiler(ast, [], [], []), cilly_reg_vm),
+        ]
+        for name, program, run in programs:
+            executed = 0
+
+            def count(code, pc):
+                nonlocal executed
+                executed = executed + 1
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                if run is cilly_reg_vm:
+                    run(*program, trace=count)
+                else:
+                    executed = sum(vm.opcode_ngrams([program], 1).values())
+                elapsed = float('inf')
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    run(*program)
+                    elapsed = min(elapsed, time.perf_counter() - start_time)
+            ops_name = register_vm.OPS_NAME if run is cilly_reg_vm else vm.OPS_NAME
+            static = count_instructions(*program[:2], ops_name)
+            print(f"{name}: {static} 条指令, 执行 {executed} 条, {elapsed:.3f} 秒")
+    print("-" * 50)
+
+
+def bench_opcode_ngrams(top=10):
+    """在性能测试用例上统计连续执行的指令对和三元组, 超级指令就是按这个结果选出的"""
+    print("指令序列频率: 性能测试用例, 优化级别 1")
+
+    programs = [cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [], optimize=1)
+                for source in test_cases]
+    for n in (2, 3):
+        with contextlib.redirect_stdout(io.StringIO()):
+            counts = vm.opcode_ngrams(programs, n)
+        total = sum(counts.values())
+        print(f"{n} 条指令的序列, 共 {total} 次:")
+        for seq, count in counts.most_common(top):
+            print(f"  {count:8d} {count / total:6.1%}  {' '.join(seq)}")
+    print("-" * 50)
+
+
+def bench_const_pool(sizes=(25000, 50000, 100000)):
+    """只计编译时间: 字面量个数翻倍时编译时间也只约翻倍, 常量表是按哈希查找的"""
+    print("常量表基准: 每条语句一个不同的字面量, 另有一个重复的字面量")
+
+    for n in sizes:
+        source = ''.join(f'print({i}, "s");\n' for i in range(n))
+        ast = cilly_parser(cilly_lexer(source))
+        start_time = time.perf_counter()
+        code, consts, scopes = cilly_vm_compiler(ast, [], [], [])
+        elapsed = time.perf_counter() - start_time
+        print(f"{2 * n} 个字面量, {len(consts)} 个常量: {elapsed:.3f} 秒, "
+              f"每个字面量 {elapsed / (2 * n) * 1e6:.2f} 微秒")
+    print("-" * 50)
+
+
+def bench_symbol_table(sizes=(2000, 4000, 8000)):
+    """只计编译时间: n 个全局变量, 一个函数引用其中每一个, 外加一个有 n 个局部变量的块"""
+    print("符号表基准: 作用域宽度翻倍, 编译时间也只约翻倍")
+
+    for n in sizes:
+        source = (''.join(f'var g{i} = {i};\n' for i in range(n)) +
+                  'fun f() {\n' + ''.join(f'print(g{i});\n' for i in range(n)) + '}\n' +
+                  '{\n' + ''.join(f'var l{i} = g{i};\n' for i in range(n)) + '}\n')
+        ast = cilly_parser(cilly_lexer(source))
+        for name, compiler in (("栈式", cilly_vm_compiler), ("寄存器", cilly_reg_compiler)):
+            start_time = time.perf_counter()
+            compiler(ast, [], [], [])
+            elapsed = time.perf_counter() - start_time
+            print(f"{name}, 作用域宽 {n}: {elapsed:.3f} 秒")
+    print("-" * 50)
+
+
+def bench_closure_eval(iterations=10):
+    """性能测试用例上 cilly_eval 与闭包编译的解释器的执行时间, 后者包括把 ast 编译成闭包的时间"""
+    print("闭包编译解释器基准: 性能测试用例")
+
+    for i, source in enumerate(test_cases):
+        ast = cilly_parser(cilly_lexer(source))
+        times = []
+        for run in (cilly_eval, cilly_closure_eval):
+            elapsed = float('inf')
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(iterations):
+                    start_time = time.perf_counter()
+                    run(ast)
+                    elapsed = min(elapsed, time.perf_counter() - start_time)
+            times.append(elapsed)
+        print(f"用例 {i + 1}: cilly_eval {times[0] * 1000:.3f} 毫秒, 闭包 {times[1] * 1000:.3f} 毫秒, "
+              f"快 {times[0] / times[1]:.2f} 倍")
+    print("-" * 50)
+
+
+def bench_environment(n=100000, iterations=10):
+    """cilly_eval 每次函数调用都新建一个 Environment, 它的开销以及 fib(15) 的执行时间"""
+    print(f"环境基准: 新建 {n} 个环境, 以及 cilly_eval 执行 fib(15)")
+
+    start_time = time.perf_counter()
+    for _ in range(n):
+        Environment()
+    elapsed = time.perf_counter() - start_time
+    print(f"每个环境 {elapsed / n * 1e6:.2f} 微秒")
+
+    ast = cilly_parser(cilly_lexer(test_cases[3]))
+    elapsed = float('inf')
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            start_time = time.perf_counter()
+            cilly_eval(ast)
+            elapsed = min(elapsed, time.perf_counter() - start_time)
+    print(f"fib(15): {elapsed * 1000:.3f} 毫秒")
+    print("-" * 50)
+
+
+def bench_vm_profile(repeat=5):
+    """cilly_vm 的剖面: fib(15) 上各 opcode 的次数和耗时, 以及打开计数和计时的额外开销"""
+    print("cilly_vm 执行剖面: fib(15), 优化级别 2")
+
+    program = cilly_vm_compiler(cilly_parser(cilly_lexer(test_cases[3])), [], [], [], optimize=2)
+    for name, make_profile in [("不剖面", lambda: None),
+                               ("计数", lambda: vm.VMProfile()),
+                               ("计数和计时", lambda: vm.VMProfile(timing=True))]:
+        elapsed = float('inf')
+        for _ in range(repeat):
+            profile = make_profile()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start_time = time.perf_counter()
+                cilly_vm(*program, profile=profile)
+                elapsed = min(elapsed, time.perf_counter() - start_time)
+        print(f"{name}: {elapsed:.3f} 秒")
+    profile.report(top=5)
+    print("-" * 50)
+
+
+def bench_values(n=100000, loop=20000, repeat=5):
+    """值的表示: 带标签列表和直接用 Python 值时每个值占用的内存, 以及算术循环在各个引擎上的执行时间"""
+    print(f"值的表示基准: {n} 个数值的内存, 以及 {loop} 次迭代的算术循环")
+
+    for name, make in [("带标签列表", lambda i: to_tagged(i)), ("Python 值", lambda i: i)]:
+        tracemalloc.start()
+        values = [make(i) for i in range(1000, 1000 + n)]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del values
+        print(f"{name}: 每个值 {current / n:.1f} 字节")
+
+    source = f'''
+    var s = 0;
+    var i = 0;
+    while (i < {loop}) {{
+        s = s + i * 2 - 1;
+        i = i + 1;
+    }}
+    print(s);
+    '''
+    ast = cilly_parser(cilly_lexer(source))
+    runs = [("cilly_eval", lambda: cilly_eval(ast)),
+            ("闭包编译", lambda: cilly_closure_eval(ast)),
+            ("cilly_vm", lambda: cilly_vm(*cilly_vm_compiler(ast, [], [], []))),
+            ("寄存器虚拟机", lambda: cilly_reg_vm(*cilly_reg_compiler(ast, [], [], [])))]
+    for name, run in runs:
+        elapsed = float('inf')
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                run()
+                elapsed = min(elapsed, time.perf_counter() - start_time)
+        print(f"{name}: {elapsed * 1000:.3f} 毫秒")
+    print("-" * 50)
+
+
+def bench_cek_eval(depths=(50, 10000, 100000, 1000000), repeat=5):
+    """CEK 机器: 深递归的时间和内存峰值, 以及性能测试用例上与 cilly_eval 的执行时间对比"""
+    print("CEK 机器基准: 递归 sum(n)")
+
+    def timed(run, ast):
+        start_time = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                run(ast)
+        except RecursionError:
+            return "RecursionError"
+        return f"{time.perf_counter() - start_time:.3f} 秒"
+
+    for n in depths:
+        ast = cilly_parser(cilly_lexer(f'fun sum(n) {{ return n == 0 ? 0 : n + sum(n - 1); }} print(sum({n}));'))
+        eval_time, cek_time = timed(cilly_eval, ast), timed(cilly_cek_eval, ast)
+        # 内存峰值单独测, tracemalloc 会让执行慢很多
+        tracemalloc.start()
+        timed(cilly_cek_eval, ast)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"深度 {n}: cilly_eval {eval_time}, CEK {cek_time}, 峰值 {peak / 1024 / 1024:.1f} MB")
+
+    for i, source in enumerate(test_cases):
+        ast = cilly_parser(cilly_lexer(source))
+        times = []
+        for run in (cilly_eval, cilly_cek_eval, lambda ast: CEKMachine(ast).run(max_steps=10 ** 9)):
+            elapsed = float('inf')
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    run(ast)
+                    elapsed = min(elapsed, time.perf_counter() - start_time)
+            times.append(elapsed)
+        print(f"用例 {i + 1}: cilly_eval {times[0] * 1000:.3f} 毫秒, CEK {times[1] * 1000:.3f} 毫秒, "
+              f"限定步数 {times[2] * 1000:.3f} 毫秒")
+    print("-" * 50)
+
+
 # 测试用例
 test_cases = [
     # 简单计算
@@ -86,49 +709,85 @@ test_cases = [
     # """,
     
     # 简单递归函数调用 (避免过深递归)
-    # """
-    # var odd = fun(n){
-    #   if(n == 1)
-    #     return true;
-    #   else
-    #    return even(n-1);
-    # };
-    # var even = fun(n) {
-    #  if(n==0)
-    #    return true;
-    #  else
-    #    return odd(n-1);
-    # };
-    
-    # # print(even(4), odd(3));
-    # # """,
-    
+    """
+    var odd = fun(n){
+      if(n == 1)
+        return true;
+      else
+       return even(n-1);
+    };
+    var even = fun(n) {
+     if(n==0)
+       return true;
+     else
+       return odd(n-1);
+    };
+
+    print(even(40), odd(31));
+    """,
+
     # 简单的斐波那契计算 (避免过深递归)
-    # """
-    # var fib = fun(n) {
-    #     if (n <= 1)
-    #         return n;
-    #     else
-    #         return fib(n-1) + fib(n-2);
-    # };
-    
-    # print(fib(8)); // 计算第8个斐波那契数
-    # """,
+    """
+    var fib = fun(n) {
+        if (n <= 1)
+            return n;
+        else
+            return fib(n-1) + fib(n-2);
+    };
+
+    print(fib(15));
+    """,
     
-    # # 循环测试
-    # """
-    # var sum = 0;
-    # var i = 0;
-    # while (i < 50) {
-    #     sum = sum + i;
-    #     i = i + 1;
-    # }
-    # print("Sum of 0 to 49:", sum);
-    # """
+    # 循环测试
+    """
+    var sum = 0;
+    var i = 0;
+    while (i < 50) {
+        sum = sum + i;
+        i = i + 1;
+    }
+    print("Sum of 0 to 49:", sum);
+    """,
+
+    # 嵌套循环, break 和 continue
+    """
+    var count = 0;
+    var j = 0;
+    for (var i = 0; i < 30; i = i + 1;) {
+        if (i == 3) continue;
+        j = 0;
+        while (true) {
+            j = j + 1;
+            count = count + (j > i ? 1 : 2);
+            if (j >= 20) break;
+        }
+    }
+    print("count:", count);
+    """,
 ]
 
 if __name__ == "__main__":
     print("开始性能测试...\n")
     for i, test_code in enumerate(test_cases):
         print(f"测试用例 {i+1}:")
-        test_performance(test_code) 
\ No newline at end of file
+        test_performance(test_code) 
+
+    bench_lexer()
+    bench_lexer_memory()
+    bench_lexer_mmap()
+    bench_incremental_lexer()
+    bench_parser()
+    bench_compile_cache()
+    bench_compact_ast()
+    bench_bytecode_file()
+    bench_vm_dispatch()
+    bench_peephole()
+    bench_opcode_ngrams()
+    bench_register_vm()
+    bench_vm_profile()
+    bench_const_pool()
+    bench_symbol_table()
+    bench_closure_eval()
+    bench_environment()
+    bench_values()
+    bench_cek_eval()
@@ -0,0 +1,798 @@
+'''
+cilly register vm
+
+与 vm.py 中的栈式虚拟机并列的第二个后端. 指令是三地址的, 操作数直接是当前栈帧中的寄存器号,
+ADD r3, r1, r2 一条指令完成栈式虚拟机中 LOAD; LOAD; BINARY_ADD; STORE 四条指令的工作.
+
+寄存器分配沿用栈式编译器的作用域和槽位表: 变量占用它在栈帧中的槽位作为寄存器,
+表达式的中间结果依次放在当前作用域的变量之后的临时寄存器中, 每条语句结束后全部释放.
+最外层程序的寄存器同时是全局变量表, 函数中用 GET_GLOBAL / SET_GLOBAL 读写全局变量.
+
+调用约定: 参数放在连续的寄存器中, CALL dst, f, base, n 以它们作为被调函数栈帧最前面的
+n 个寄存器, 被调函数 RETURN r 时把 r 的值写回调用者的 dst.
+'''
+
+from lexical_analyzer import error
+from values import val, NULL, TRUE, FALSE, Function
+from vm import CodeObject, const_key, cilly_vm_compiler, cilly_vm, cilly_vm_dis
+
+LOAD_CONST = 1     # dst, 常量下标
+LOAD_NULL = 2      # dst
+LOAD_TRUE = 3      # dst
+LOAD_FALSE = 4     # dst
+MOVE = 5           # dst, src
+GET_GLOBAL = 6     # dst, 全局变量槽位
+SET_GLOBAL = 7     # 全局变量槽位, src
+
+PRINT_ITEM = 8     # src
+PRINT_NEWLINE = 9
+
+JMP = 10           # 目标
+JMP_TRUE = 11      # src, 目标
+JMP_FALSE = 12     # src, 目标
+
+ENTER_FRAME = 13   # 寄存器个数, 只在程序入口执行一次
+
+MAKE_FUNCTION = 20  # dst, 常量下标
+CALL = 21           # dst, 函数, 第一个参数, 参数个数
+RETURN = 22         # src
+
+NEG = 101          # dst, src
+NOT = 102          # dst, src
+
+ADD = 111          # dst, src1, src2
+SUB = 112
+MUL = 113
+DIV = 114
+MOD = 115
+POW = 116
+EQ = 117
+NE = 118
+LT = 119
+GE = 120
+
+OPS_NAME = {
+    LOAD_CONST: ('LOAD_CONST', 3),
+    LOAD_NULL: ('LOAD_NULL', 2),
+    LOAD_TRUE: ('LOAD_TRUE', 2),
+    LOAD_FALSE: ('LOAD_FALSE', 2),
+    MOVE: ('MOVE', 3),
+    GET_GLOBAL: ('GET_GLOBAL', 3),
+    SET_GLOBAL: ('SET_GLOBAL', 3),
+
+    PRINT_ITEM: ('PRINT_ITEM', 2),
+    PRINT_NEWLINE: ('PRINT_NEWLINE', 1),
+
+    JMP: ('JMP', 2),
+    JMP_TRUE: ('JMP_TRUE', 3),
+    JMP_FALSE: ('JMP_FALSE', 3),
+
+    ENTER_FRAME: ('ENTER_FRAME', 2),
+
+    MAKE_FUNCTION: ('MAKE_FUNCTION', 3),
+    CALL: ('CALL', 5),
+    RETURN: ('RETURN', 2),
+
+    NEG: ('NEG', 3),
+    NOT: ('NOT', 3),
+
+    ADD: ('ADD', 4),
+    SUB: ('SUB', 4),
+    MUL: ('MUL', 4),
+    DIV: ('DIV', 4),
+    MOD: ('MOD', 4),
+    POW: ('POW', 4),
+    EQ: ('EQ', 4),
+    NE: ('NE', 4),
+    LT: ('LT', 4),
+    GE: ('GE', 4),
+}
+
+BINARY_OPS = {'+': ADD, '-': SUB, '*': MUL, '/': DIV, '%': MOD, '^': POW,
+              '==': EQ, '!=': NE, '<': LT, '>=': GE}
+
+# 操作数是寄存器号的位置, 反汇编时打印成 rN, 其余操作数是常量下标、槽位、跳转目标或个数
+REG_OPERANDS = {
+    LOAD_CONST: (0,), LOAD_NULL: (0,), LOAD_TRUE: (0,), LOAD_FALSE: (0,),
+    MOVE: (0, 1), GET_GLOBAL: (0,), SET_GLOBAL: (1,),
+    PRINT_ITEM: (0,), JMP_TRUE: (0,), JMP_FALSE: (0,),
+    MAKE_FUNCTION: (0,), CALL: (0, 1, 2), RETURN: (0,),
+    NEG: (0, 1), NOT: (0, 1),
+    **{op: (0, 1, 2) for op in BINARY_OPS.values()},
+}
+
+
+class RegFrame:
+    """一次函数调用: 正在执行的代码对象, 返回后继续执行的 pc, 寄存器, 返回值写入调用者的哪个寄存器"""
+
+    def __init__(self, code, pc, regs, dst):
+        self.code = code
+        self.pc = pc
+        self.regs = regs
+        self.dst = dst
+
+
+'''
+cilly register vm compiler
+'''
+
+
+def cilly_reg_compiler(ast, code, consts, scopes):
+    """与 cilly_vm_compiler 接口相同, 函数编译成 nlocals 为寄存器个数的 CodeObject"""
+    def err(msg):
+        error('cilly register compiler', msg)
+
+    # const_key(常量) -> 常量表中的下标, 与 consts 一起在编译函数体时保存和恢复
+    const_index = {}
+    for i in range(len(consts) - 1, -1, -1):
+        const_index[const_key(consts[i])] = i
+
+    def add_const(c):
+        key = const_key(c)
+        index = const_index.get(key)
+        if index is None:
+            index = len(consts)
+            consts.append(c)
+            const_index[key] = index
+        return index
+
+    def get_next_emit_addr():
+        return len(code)
+
+    def emit(opcode, *operands):
+        addr = get_next_emit_addr()
+        code.append(opcode)
+        code.extend(operands)
+        return addr
+
+    def backpatch(addr, index, operand):
+        code[addr + 1 + index] = operand
+
+    # scopes / tables / bases / frame_size 与 cilly_vm_compiler 相同, 变量的槽位就是它的寄存器.
+    # next_reg 是下一个空闲的临时寄存器, frame_size 同时记录用到的临时寄存器
+    bases = []
+    tables = []
+    frame_size = 0
+    next_reg = 0
+    global_names = []
+    global_table = {}
+    loops = []
+
+    def define_var(name):
+        nonlocal frame_size
+        scope, table = scopes[-1], tables[-1]
+        if name in table:
+            err(f'已定义变量: {name}')
+        slot = bases[-1] + len(scope)
+        scope.append(name)
+        table[name] = slot
+        frame_size = max(frame_size, slot + 1)
+        return slot
+
+    def declare_var(name):
+        if tables[-1] is global_table and name in global_table:
+            return global_table[name]
+        return define_var(name)
+
+    def lookup_var(name):
+        """返回 (是否要用 GET_GLOBAL / SET_GLOBAL 访问, 槽位)"""
+        for i in range(len(tables) - 1, -1, -1):
+            slot = tables[i].get(name)
+            if slot is not None:
+                # 最外层程序中全局变量就是寄存器
+                return False, slot
+        slot = global_table.get(name)
+        if slot is None:
+            err(f'未定义变量: {name}')
+        return True, slot
+
+    def first_temp():
+        """当前作用域的变量之后的第一个寄存器"""
+        return bases[-1] + len(scopes[-1])
+
+    def alloc():
+        nonlocal next_reg, frame_size
+        r = next_reg
+        next_reg = next_reg + 1
+        frame_size = max(frame_size, next_reg)
+        return r
+
+    def target(dst):
+        return alloc() if dst is None else dst
+
+    def compile_stat(node):
+        # 语句的临时寄存器在语句结束时全部释放
+        nonlocal next_reg
+        next_reg = first_temp()
+        visit(node)
+        next_reg = first_temp()
+
+    def compile_program(node):
+        _, statements = node
+        nonlocal scopes, tables, bases, frame_size
+        scopes = [global_names]
+        tables = [global_table]
+        bases = [0]
+        frame_size = 0
+        for stmt in statements:
+            if stmt[0] in ('define', 'fun_def'):
+                define_var(stmt[1])
+        addr = emit(ENTER_FRAME, -1)
+        for s in statements:
+            compile_stat(s)
+        backpatch(addr, 0, frame_size)
+        scopes = [global_names]
+
+    def compile_expr_stat(node):
+        _, e = node
+        expr(e)
+
+    def compile_print(node):
+        nonlocal next_reg
+        _, args = node
+        for a in args:
+            saved = next_reg
+            emit(PRINT_ITEM, expr(a))
+            next_reg = saved
+        emit(PRINT_NEWLINE)
+
+    def compile_if(node):
+        _, cond, true_s, false_s = node
+        addr1 = emit(JMP_FALSE, expr(cond), -1)
+        compile_stat(true_s)
+        if false_s is None:
+            backpatch(addr1, 1, get_next_emit_addr())
+        else:
+            addr2 = emit(JMP, -1)
+            backpatch(addr1, 1, get_next_emit_addr())
+            compile_stat(false_s)
+            backpatch(addr2, 0, get_next_emit_addr())
+
+    def compile_loop_end(continue_target, exit_jmp):
+        break_addrs, continue_addrs = loops.pop()
+        for addr in continue_addrs:
+            backpatch(addr, 0, continue_target)
+        end = get_next_emit_addr()
+        backpatch(exit_jmp, 1, end)
+        for addr in break_addrs:
+            backpatch(addr, 0, end)
+
+    def compile_while(node):
+        _, cond, body = node
+        start = get_next_emit_addr()
+        addr = emit(JMP_FALSE, expr(cond), -1)
+        loops.append(([], []))
+        compile_stat(body)
+        emit(JMP, start)
+        compile_loop_end(start, addr)
+
+    def compile_for(node):
+        _, init, cond, incr, body = node
+        # 与栈式编译器一样, 初始化语句定义的变量属于 for 所在的作用域
+        compile_stat(init)
+        start = get_next_emit_addr()
+        if cond[0] != 'expr_stat':
+            err(f'for循环条件必须是表达式: {cond[0]}')
+        addr = emit(JMP_FALSE, expr(cond[1]), -1)
+        loops.append(([], []))
+        compile_stat(body)
+        incr_addr = get_next_emit_addr()
+        compile_stat(incr)
+        emit(JMP, start)
+        compile_loop_end(incr_addr, addr)
+
+    def compile_break(node):
+        if not loops:
+            err('break不在循环中')
+        loops[-1][0].append(emit(JMP, -1))
+
+    def compile_continue(node):
+        if not loops:
+            err('continue不在循环中')
+        loops[-1][1].append(emit(JMP, -1))
+
+    def compile_block(node):
+        _, statements = node
+        scopes.append([])
+        tables.append({})
+        bases.append(bases[-1] + len(scopes[-2]))
+        for s in statements:
+            compile_stat(s)
+        scopes.pop()
+        tables.pop()
+        bases.pop()
+
+    def store_var(name, node):
+        is_global, slot = lookup_var(name)
+        if is_global:
+            emit(SET_GLOBAL, slot, expr(node))
+        else:
+            expr(node, slot)
+
+    def compile_define(node):
+        _, name, e = node
+        if e[0] == 'fun':
+            e = ['fun', e[1], e[2], name]
+        if tables[-1] is global_table and name in global_table:
+            expr(e, global_table[name])
+        else:
+            # 新变量的寄存器就是它的值所在的临时寄存器
+            nonlocal next_reg
+            r = first_temp()
+            next_reg = r + 1
+            expr(e, r)
+            declare_var(name)
+
+    def compile_assign(node):
+        _, name, e = node
+        store_var(name, e)
+
+    def compile_fun_def(node):
+        _, name, params, body = node
+        compile_define(['define', name, ['fun', params, body, name]])
+
+    def compile_return(node):
+        _, e = node
+        if e is None:
+            r = alloc()
+            emit(LOAD_NULL, r)
+        else:
+            r = expr(e)
+        emit(RETURN, r)
+
+    '''
+    表达式编译后的值在哪个寄存器中. 给出 dst 时值一定放在 dst 中,
+    否则变量直接返回它的寄存器, 其余的值放在新分配的临时寄存器中.
+    '''
+
+    def expr(node, dst=None):
+        nonlocal next_reg
+        tag = node[0]
+        if tag not in exprs:
+            err(f'非法ast节点: {tag}')
+        saved = next_reg
+        r = exprs[tag](node, dst)
+        # 子表达式的临时寄存器用完即释放, 保留结果所在的寄存器
+        next_reg = max(saved, r + 1) if r >= saved else saved
+        return r
+
+    def expr_literal(node, dst):
+        tag = node[0]
+        r = target(dst)
+        if tag == 'null':
+            emit(LOAD_NULL, r)
+        elif tag == 'true':
+            emit(LOAD_TRUE, r)
+        elif tag == 'false':
+            emit(LOAD_FALSE, r)
+        else:
+            emit(LOAD_CONST, r, add_const(node[1]))
+        return r
+
+    def expr_id(node, dst):
+        _, name, _, _ = node
+        is_global, slot = lookup_var(name)
+        if is_global:
+            r = target(dst)
+            emit(GET_GLOBAL, r, slot)
+            return r
+        if dst is None or dst == slot:
+            return slot
+        emit(MOVE, dst, slot)
+        return dst
+
+    def expr_unary(node, dst):
+        _, op, e = node
+        r = target(dst)
+        if op == '-':
+            emit(NEG, r, expr(e))
+        elif op == '!':
+            emit(NOT, r, expr(e))
+        else:
+            err(f'非法一元运算符：{op}')
+        return r
+
+    def is_var_reg(r):
+        return r < first_temp()
+
+    def expr_binary(node, dst):
+        _, op, e1, e2 = node
+        if op in ('&&', '||'):
+            # 分几步写入结果, 结果是变量时先放在临时寄存器中, 以免右边读到改了一半的变量
+            r = alloc() if dst is None or is_var_reg(dst) else dst
+            expr(e1, r)
+            addr = emit(JMP_FALSE if op == '&&' else JMP_TRUE, r, -1)
+            expr(e2, r)
+            backpatch(addr, 1, get_next_emit_addr())
+            if dst is not None and dst != r:
+                emit(MOVE, dst, r)
+                return dst
+            return r
+
+        r = target(dst)
+        v1 = expr(e1)
+        v2 = expr(e2)
+        if op == '>':
+            emit(LT, r, v2, v1)
+        elif op == '<=':
+            emit(GE, r, v2, v1)
+        elif op in BINARY_OPS:
+            emit(BINARY_OPS[op], r, v1, v2)
+        else:
+            err(f'非法二元运算符：{op}')
+        return r
+
+    def expr_ternary(node, dst):
+        _, cond, true_e, false_e = node
+        r = alloc() if dst is None or is_var_reg(dst) else dst
+        addr1 = emit(JMP_FALSE, expr(cond), -1)
+        expr(true_e, r)
+        addr2 = emit(JMP, -1)
+        backpatch(addr1, 1, get_next_emit_addr())
+        expr(false_e, r)
+        backpatch(addr2, 0, get_next_emit_addr())
+        if dst is not None and dst != r:
+            emit(MOVE, dst, r)
+            return dst
+        return r
+
+    def expr_fun(node, dst):
+        params, body = node[1], node[2]
+        name = node[3] if len(node) > 3 else '<fun>'
+        nonlocal code, consts, const_index, scopes, tables, bases, frame_size, next_reg, loops
+        saved = code, consts, const_index, scopes, tables, bases, frame_size, next_reg, loops
+        code, consts, const_index = [], [], {}
+        scopes = [[]]
+        tables = [{}]
+        bases = [0]
+        frame_size = 0
+        loops = []
+        for param in params:
+            define_var(param)
+        compile_stat(body)
+        r = alloc()
+        emit(LOAD_NULL, r)
+        emit(RETURN, r)
+        fun = CodeObject(code, consts, len(params), frame_size, 0, name)
+        code, consts, const_index, scopes, tables, bases, frame_size, next_reg, loops = saved
+        r = target(dst)
+        emit(MAKE_FUNCTION, r, add_const(fun))
+        return r
+
+    def expr_call(node, dst):
+        _, fun, args = node
+        r = target(dst)
+        f = expr(fun)
+        # 参数放在连续的新寄存器中
+        base = next_reg
+        for _ in args:
+            alloc()
+        for i in range(len(args)):
+            expr(args[i], base + i)
+        emit(CALL, r, f, base, len(args))
+        return r
+
+    visitors = {
+        'program': compile_program,
+        'expr_stat': compile_expr_stat,
+        'print': compile_print,
+        'if': compile_if,
+        'while': compile_while,
+        'for': compile_for,
+        'break': compile_break,
+        'continue': compile_continue,
+        'define': compile_define,
+        'assign': compile_assign,
+        'block': compile_block,
+        'fun_def': compile_fun_def,
+        'return': compile_return,
+    }
+
+    exprs = {
+        'id': expr_id,
+        'num': expr_literal,
+        'str': expr_literal,
+        'true': expr_literal,
+        'false': expr_literal,
+        'null': expr_literal,
+        'unary': expr_unary,
+        'binary': expr_binary,
+        'ternary': expr_ternary,
+        'fun': expr_fun,
+        'call': expr_call,
+    }
+
+    def visit(node):
+        tag = node[0]
+        if tag not in visitors:
+            err(f'非法ast节点: {tag}')
+        visitors[tag](node)
+
+    visit(ast)
+    return code, consts, scopes
+
+
+'''
+cilly register vm: 与 cilly_vm 一样预译码成处理函数表, 寄存器号在翻译时绑定到处理函数上
+'''
+
+
+def cilly_reg_vm(code, consts, scopes, trace=None):
+    """给出 trace 时每条指令执行前调用 trace(code, pc), 不给时没有任何额外开销"""
+    def err(msg):
+        error('cilly register vm', msg)
+
+    call_stack = []
+    frame = RegFrame(CodeObject(code, consts, 0, 0, 0, '<program>'), 0, [], None)
+    regs = frame.regs
+    global_regs = regs
+
+    def load_value(dst, v, next_pc):
+        def op():
+            regs[dst] = v
+            return next_pc
+        return op
+
+    def move(dst, src, next_pc):
+        def op():
+            regs[dst] = regs[src]
+            return next_pc
+        return op
+
+    def get_global(dst, slot, next_pc):
+        def op():
+            regs[dst] = global_regs[slot]
+            return next_pc
+        return op
+
+    def set_global(slot, src, next_pc):
+        def op():
+            global_regs[slot] = regs[src]
+            return next_pc
+        return op
+
+    def print_item(src, next_pc):
+        def op():
+            print(val(regs[src]), end=' ')
+            return next_pc
+        return op
+
+    def print_newline(next_pc):
+        def op():
+            print('')
+            return next_pc
+        return op
+
+    def jmp(target):
+        def op():
+            return target
+        return op
+
+    def jmp_true(src, target, next_pc):
+        def op():
+            if regs[src] is TRUE:
+                return target
+            return next_pc
+        return op
+
+    def jmp_false(src, target, next_pc):
+        def op():
+            if regs[src] is FALSE:
+                return target
+            return next_pc
+        return op
+
+    def enter_frame(size, next_pc):
+        def op():
+            regs.extend([NULL] * (size - len(regs)))
+            return next_pc
+        return op
+
+    def neg(dst, src, next_pc):
+        def op():
+            regs[dst] = -regs[src]
+            return next_pc
+        return op
+
+    def not_op(dst, src, next_pc):
+        def op():
+            regs[dst] = FALSE if regs[src] else TRUE
+            return next_pc
+        return op
+
+    def arith(f):
+        def make(dst, src1, src2, next_pc):
+            def op():
+                regs[dst] = f(regs[src1], regs[src2])
+                return next_pc
+            return op
+        return make
+
+    def compare(f):
+        def make(dst, src1, src2, next_pc):
+            def op():
+                regs[dst] = TRUE if f(regs[src1], regs[src2]) else FALSE
+                return next_pc
+            return op
+        return make
+
+    def add(dst, src1, src2, next_pc):
+        def op():
+            regs[dst] = regs[src1] + regs[src2]
+            return next_pc
+        return op
+
+    def sub(dst, src1, src2, next_pc):
+        def op():
+            regs[dst] = regs[src1] - regs[src2]
+            return next_pc
+        return op
+
+    def lt(dst, src1, src2, next_pc):
+        def op():
+            regs[dst] = regs[src1] < regs[src2]
+            return next_pc
+        return op
+
+    def ge(dst, src1, src2, next_pc):
+        def op():
+            regs[dst] = regs[src1] >= regs[src2]
+            return next_pc
+        return op
+
+    def make_function(dst, fun_code, next_pc):
+        def op():
+            regs[dst] = Function(fun_code)
+            return next_pc
+        return op
+
+    def call(dst, f, base, arg_count, next_pc):
+        def op():
+            nonlocal frame, regs, ops
+            fun = regs[f]
+            if not isinstance(fun, Function):
+                err('调用非函数对象')
+            fun_code = fun.code
+            if arg_count != fun_code.nparams:
+                err(f'函数{fun_code.name}需要{fun_code.nparams}个参数, 实际{arg_count}个')
+            # 参数就是新栈帧最前面的寄存器
+            new_regs = regs[base:base + arg_count]
+            new_regs.extend([NULL] * (fun_code.nlocals - arg_count))
+            frame.pc = next_pc
+            call_stack.append(frame)
+            frame = RegFrame(fun_code, 0, new_regs, dst)
+            regs = new_regs
+            ops = code_ops(fun_code)
+            return 0
+        return op
+
+    def return_proc(src):
+        def op():
+            nonlocal frame, regs, ops
+            if not call_stack:
+                err('在非函数上下文中返回')
+            v = regs[src]
+            dst = frame.dst
+            frame = call_stack.pop()
+            regs = frame.regs
+            ops = code_ops(frame.code)
+            regs[dst] = v
+            return frame.pc
+        return op
+
+    def illegal(opcode):
+        def op():
+            err(f'非法opcode: {opcode}')
+        return op
+
+    def halt():
+        return -1
+
+    # opcode -> 由操作数、常量表和下一条指令的地址构造处理函数
+    translators = {
+        LOAD_CONST: lambda a, consts, next_pc: load_value(a[0], consts[a[1]], next_pc),
+        LOAD_NULL: lambda a, consts, next_pc: load_value(a[0], NULL, next_pc),
+        LOAD_TRUE: lambda a, consts, next_pc: load_value(a[0], TRUE, next_pc),
+        LOAD_FALSE: lambda a, consts, next_pc: load_value(a[0], FALSE, next_pc),
+        MOVE: lambda a, consts, next_pc: move(a[0], a[1], next_pc),
+        GET_GLOBAL: lambda a, consts, next_pc: get_global(a[0], a[1], next_pc),
+        SET_GLOBAL: lambda a, consts, next_pc: set_global(a[0], a[1], next_pc),
+        PRINT_ITEM: lambda a, consts, next_pc: print_item(a[0], next_pc),
+        PRINT_NEWLINE: lambda a, consts, next_pc: print_newline(next_pc),
+        JMP: lambda a, consts, next_pc: jmp(a[0]),
+        JMP_TRUE: lambda a, consts, next_pc: jmp_true(a[0], a[1], next_pc),
+        JMP_FALSE: lambda a, consts, next_pc: jmp_false(a[0], a[1], next_pc),
+        ENTER_FRAME: lambda a, consts, next_pc: enter_frame(a[0], next_pc),
+        MAKE_FUNCTION: lambda a, consts, next_pc: make_function(a[0], consts[a[1]], next_pc),
+        CALL: lambda a, consts, next_pc: call(a[0], a[1], a[2], a[3], next_pc),
+        RETURN: lambda a, consts, next_pc: return_proc(a[0]),
+        NEG: lambda a, consts, next_pc: neg(a[0], a[1], next_pc),
+        NOT: lambda a, consts, next_pc: not_op(a[0], a[1], next_pc),
+        ADD: lambda a, consts, next_pc: add(*a, next_pc),
+        SUB: lambda a, consts, next_pc: sub(*a, next_pc),
+        MUL: lambda a, consts, next_pc: arith(lambda x, y: x * y)(*a, next_pc),
+        DIV: lambda a, consts, next_pc: arith(lambda x, y: x / y)(*a, next_pc),
+        MOD: lambda a, consts, next_pc: arith(lambda x, y: x % y)(*a, next_pc),
+        POW: lambda a, consts, next_pc: arith(lambda x, y: x ** y)(*a, next_pc),
+        EQ: lambda a, consts, next_pc: compare(lambda x, y: x == y)(*a, next_pc),
+        NE: lambda a, consts, next_pc: compare(lambda x, y: x != y)(*a, next_pc),
+        LT: lambda a, consts, next_pc: lt(*a, next_pc),
+        GE: lambda a, consts, next_pc: ge(*a, next_pc),
+    }
+
+    def traced(op, code, pc):
+        def r():
+            trace(code, pc)
+            return op()
+        return r
+
+    # id(代码对象) -> 处理函数表
+    translated = {}
+
+    def code_ops(code_obj):
+        r = translated.get(id(code_obj))
+        if r is not None:
+            return r
+
+        code, consts = code_obj.code, code_obj.consts
+        n = len(code)
+        r = [None] * n + [halt]
+        pc = 0
+        while pc < n:
+            opcode = code[pc]
+            if opcode not in translators:
+                r[pc] = illegal(opcode)
+                break
+            size = OPS_NAME[opcode][1]
+            r[pc] = translators[opcode](code[pc + 1:pc + size], consts, pc + size)
+            if trace is not None:
+                r[pc] = traced(r[pc], code, pc)
+            pc = pc + size
+
+        translated[id(code_obj)] = r
+        return r
+
+    ops = code_ops(frame.code)
+    pc = 0
+    while pc >= 0:
+        pc = ops[pc]()
+
+
+'''
+cilly register vm 反汇编器
+'''
+
+
+def cilly_reg_dis(code, consts, var_names):
+    def err(msg):
+        error('cilly register vm disassembler', msg)
+
+    pc = 0
+    while pc < len(code):
+        opcode = code[pc]
+        if opcode not in OPS_NAME:
+            err(f'非法opcode:{opcode}')
+        name, size = OPS_NAME[opcode]
+        operands = code[pc + 1:pc + size]
+        regs = REG_OPERANDS.get(opcode, ())
+        text = ', '.join(f'r{v}' if i in regs else str(v) for i, v in enumerate(operands))
+        if opcode in (LOAD_CONST, MAKE_FUNCTION) and operands[1] < len(consts):
+            text = f'{text} ({consts[operands[1]]})'
+        elif opcode in (GET_GLOBAL, SET_GLOBAL) and len(var_names) > 0:
+            slot = operands[1] if opcode == GET_GLOBAL else operands[0]
+            if slot < len(var_names[0]):
+                text = f'{text} ({var_names[0][slot]})'
+        print(f'{pc}\t {name} {text}'.rstrip())
+        pc = pc + size
+
+    for c in consts:
+        if isinstance(c, CodeObject):
+            print(f'\n{c} 参数{c.nparams}个, 寄存器{c.nlocals}个')
+            cilly_reg_dis(c.code, c.consts, var_names)
+
+
+# 后端名 -> (编译器, 虚拟机, 反汇编器), 编译器和虚拟机的接口相同, 可以互相替换
+VM_BACKENDS = {
+    'stack': (cilly_vm_compiler, cilly_vm, cilly_vm_dis),
+    'register': (cilly_reg_compiler, cilly_reg_vm, cilly_reg_dis),
+}
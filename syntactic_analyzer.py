@@ -79,12 +79,24 @@ expr
     ;
 '''
 
-from lexical_analyzer import error, mk_tk, tk_tag, tk_val, cilly_lexer
+from collections import deque
+
+from array import array
+
+from lexical_analyzer import (error, mk_tk, tk_tag, tk_val, cilly_lexer, cilly_token_tags, cilly_token_kinds,
+                              TokenStore, KIND_EOF, KIND_ID)
+from compact_ast import NODE_FIELDS, NODE_BUILDERS, leaf_node, to_compact
 
 EOF = mk_tk('eof')
 
 
 def make_token_reader(ts, err):
+    if isinstance(ts, TokenStore):
+        return make_store_token_reader(ts, err)
+
+    if not hasattr(ts, '__len__'):
+        return make_stream_token_reader(iter(ts), err)
+
     pos = -1
     cur = None
 
@@ -118,7 +130,82 @@ def make_token_reader(ts, err):
     return peek, match, next
 
 
-def cilly_parser(tokens):
+def make_stream_token_reader(ts, err):
+    """从 token 迭代器(如 cilly_lexer_stream)中按需读取, 只缓存 peek 需要的几个 token"""
+    ahead = deque()
+    cur = None
+
+    def fill(n):
+        if len(ahead) < n:
+            for t in ts:
+                ahead.append(t)
+                if len(ahead) >= n:
+                    break
+        return len(ahead) >= n
+
+    def peek(p=0):
+        if p == 0:
+            return tk_tag(cur)
+        if not fill(p):
+            return 'eof'
+        return tk_tag(ahead[p - 1])
+
+    def match(t):
+        if peek() != t:
+            err(f'期望{t},实际为{cur}', cur)
+
+        return next()
+
+    def next():
+        nonlocal cur
+
+        old = cur
+        if fill(1):
+            cur = ahead.popleft()
+        else:
+            cur = EOF
+
+        return old
+
+    next()
+
+    return peek, match, next
+
+
+def make_store_token_reader(ts, err):
+    """直接读 TokenStore 的 kind 列, peek 不再构造 token, 只有 next/match 返回兼容视图"""
+    kinds = ts.kinds
+    tags = cilly_token_tags
+    n = len(kinds)
+    pos = 0
+
+    def peek(p=0):
+        if pos + p >= n:
+            return 'eof'
+        else:
+            return tags[kinds[pos + p]]
+
+    def match(t):
+        if peek() != t:
+            cur = ts[pos] if pos < n else EOF
+            err(f'期望{t},实际为{cur}', cur)
+
+        return next()
+
+    def next():
+        nonlocal pos
+
+        old = ts[pos] if pos < n else EOF
+        pos = pos + 1
+
+        return old
+
+    return peek, match, next
+
+
+def cilly_parser_ref(tokens):
+    """闭包实现的 Pratt 语法分析器, 流式输入时使用, 也作为 cilly_parser 的参考实现保留"""
+
     def err(msg, token=None):
         error('cilly parser', msg, token)
 
@@ -447,6 +534,421 @@ def cilly_parser(tokens):
     return program()
 
 
+'''
+表驱动的 Pratt 语法分析器
+
+绑定力和各个 token 的分析函数都放在模块级的表中, 以整数 kind 为下标.
+分析状态只有 token 数组和当前下标, 每次调用 cilly_parser 不再新建闭包.
+'''
+
+K = cilly_token_kinds
+
+
+def list_node(tag, n):
+    # 按字段个数分别定义, 不经过 *args
+    if n == 0:
+        return lambda: [tag]
+    if n == 1:
+        return lambda a: [tag, a]
+    if n == 2:
+        return lambda a, b: [tag, a, b]
+    if n == 3:
+        return lambda a, b, c: [tag, a, b, c]
+    return lambda a, b, c, d: [tag, a, b, c, d]
+
+
+# 类型名 -> 构造列表形式节点的函数, 与 compact_ast.NODE_BUILDERS 对应
+LIST_BUILDERS = {tag: list_node(tag, len(fields)) for tag, fields in NODE_FIELDS}
+
+
+class ParserState:
+    __slots__ = ('kinds', 'values', 'tokens', 'n', 'pos', 'compact', 'node')
+
+    def __init__(self, tokens, compact=False):
+        if isinstance(tokens, TokenStore):
+            kinds = array('i', tokens.kinds)
+            values = tokens.values
+        else:
+            kinds = array('i', [K[tk_tag(t)] for t in tokens])
+            values = [tk_val(t) for t in tokens]
+
+        self.n = len(kinds)
+        # 末尾补两个 eof, peek 不用检查越界
+        kinds.append(KIND_EOF)
+        kinds.append(KIND_EOF)
+
+        self.kinds = kinds
+        self.values = values
+        self.tokens = tokens
+        self.pos = 0
+        # compact 时直接生成紧凑形式的节点, 不先建立整棵列表形式的 AST
+        self.compact = compact
+        self.node = NODE_BUILDERS if compact else LIST_BUILDERS
+
+    def err(self, msg, token=None):
+        error('cilly parser', msg, token)
+
+    def current(self):
+        return self.tokens[self.pos] if self.pos < self.n else EOF
+
+    def next(self):
+        t = self.current()
+        self.pos = self.pos + 1
+        return t
+
+    def match(self, kind):
+        if self.kinds[self.pos] != kind:
+            cur = self.current()
+            self.err(f'期望{cilly_token_tags[kind]},实际为{cur}', cur)
+        self.pos = self.pos + 1
+
+    def match_id(self):
+        """匹配一个 id, 只取它的值, 不构造 token"""
+        pos = self.pos
+        if self.kinds[pos] != KIND_ID:
+            cur = self.current()
+            self.err(f'期望id,实际为{cur}', cur)
+        self.pos = pos + 1
+        return self.values[pos]
+
+
+def program(p):
+    r = []
+
+    kinds = p.kinds
+    while kinds[p.pos] != KIND_EOF:
+        r.append(statement(p))
+
+    return p.node['program'](r)
+
+
+def statement(p):
+    return STATEMENTS[p.kinds[p.pos]](p)
+
+
+def id_stat(p):
+    if p.kinds[p.pos + 1] == K['=']:
+        return assign_stat(p)
+    return expr_stat(p)
+
+
+def fun_or_expr_stat(p):
+    if p.kinds[p.pos + 1] == KIND_ID:
+        return fun_stat(p)
+    return expr_stat(p)
+
+
+def define_stat(p):
+    p.match(K['var'])
+    id = p.match_id()
+    p.match(K['='])
+    e = expr(p)
+    p.match(K[';'])
+
+    return p.node['define'](id, e)
+
+
+def assign_stat(p):
+    id = p.match_id()
+    p.match(K['='])
+    e = expr(p)
+    p.match(K[';'])
+
+    return p.node['assign'](id, e)
+
+
+def print_stat(p):
+    p.match(K['print'])
+    p.match(K['('])
+
+    if p.kinds[p.pos] == K[')']:
+        alist = []
+    else:
+        alist = args(p)
+
+    p.match(K[')'])
+    p.match(K[';'])
+
+    return p.node['print'](alist)
+
+
+def args(p):
+    r = [expr(p)]
+
+    while p.kinds[p.pos] == K[',']:
+        p.pos = p.pos + 1
+        r.append(expr(p))
+
+    return r
+
+
+def if_stat(p):
+    p.match(K['if'])
+    p.match(K['('])
+    cond = expr(p)
+    p.match(K[')'])
+
+    true_stat = statement(p)
+
+    if p.kinds[p.pos] == K['else']:
+        p.pos = p.pos + 1
+        false_stat = statement(p)
+    else:
+        false_stat = None
+
+    return p.node['if'](cond, true_stat, false_stat)
+
+
+def while_stat(p):
+    p.match(K['while'])
+    p.match(K['('])
+    cond = expr(p)
+    p.match(K[')'])
+    body = statement(p)
+
+    return p.node['while'](cond, body)
+
+
+def for_stat(p):
+    p.match(K['for'])
+    p.match(K['('])
+
+    init = statement(p)
+    cond = statement(p)
+    incr = statement(p)
+
+    p.match(K[')'])
+    body = statement(p)
+
+    return p.node['for'](init, cond, incr, body)
+
+
+def continue_stat(p):
+    p.match(K['continue'])
+    p.match(K[';'])
+
+    return p.node['continue']()
+
+
+def break_stat(p):
+    p.match(K['break'])
+    p.match(K[';'])
+
+    return p.node['break']()
+
+
+def return_stat(p):
+    p.match(K['return'])
+
+    if p.kinds[p.pos] != K[';']:
+        e = expr(p)
+    else:
+        e = None
+
+    p.match(K[';'])
+
+    return p.node['return'](e)
+
+
+def params(p):
+    r = [p.match_id()]
+
+    while p.kinds[p.pos] == K[',']:
+        p.pos = p.pos + 1
+        r.append(p.match_id())
+
+    return r
+
+
+def fun_stat(p):
+    p.match(K['fun'])
+    name = p.match_id()
+
+    p.match(K['('])
+    if p.kinds[p.pos] == K[')']:
+        plist = []
+    else:
+        plist = params(p)
+    p.match(K[')'])
+
+    body = block_stat(p)
+
+    return p.node['fun_def'](name, plist, body)
+
+
+def block_stat(p):
+    p.match(K['{'])
+
+    r = []
+
+    kinds = p.kinds
+    while kinds[p.pos] != K['}']:
+        r.append(statement(p))
+
+    p.pos = p.pos + 1
+
+    return p.node['block'](r)
+
+
+def expr_stat(p):
+    e = expr(p)
+    p.match(K[';'])
+
+    return p.node['expr_stat'](e)
+
+
+def literal(p, bp):
+    t = p.next()
+    if p.compact:
+        return leaf_node(t)
+    return t
+
+
+def unary(p, bp):
+    op = cilly_token_tags[p.kinds[p.pos]]
+    p.pos = p.pos + 1
+    e = expr(p, bp)
+
+    return p.node['unary'](op, e)
+
+
+def fun_expr(p, bp):
+    p.match(K['fun'])
+    p.match(K['('])
+    if p.kinds[p.pos] == K[')']:
+        plist = []
+    else:
+        plist = params(p)
+
+    p.match(K[')'])
+    body = block_stat(p)
+
+    return p.node['fun'](plist, body)
+
+
+def parens(p, bp):
+    p.pos = p.pos + 1
+    e = expr(p)
+    p.match(K[')'])
+
+    return e
+
+
+def ternary(p, left, bp):
+    p.pos = p.pos + 1
+    true_expr = expr(p, 0)
+    p.match(K[':'])
+    false_expr = expr(p, bp)
+
+    return p.node['ternary'](left, true_expr, false_expr)
+
+
+def binary(p, left, bp):
+    op = cilly_token_tags[p.kinds[p.pos]]
+    p.pos = p.pos + 1
+    right = expr(p, bp)
+
+    return p.node['binary'](op, left, right)
+
+
+def call(p, fun_expr, bp):
+    p.pos = p.pos + 1
+    if p.kinds[p.pos] != K[')']:
+        alist = args(p)
+    else:
+        alist = []
+    p.match(K[')'])
+
+    return p.node['call'](fun_expr, alist)
+
+
+def illegal(p, bp):
+    p.err(f'非法token: {cilly_token_tags[p.kinds[p.pos]]}')
+
+
+def make_table(default, entries):
+    table = [default] * len(cilly_token_tags)
+    for tag, v in entries.items():
+        table[K[tag]] = v
+    return table
+
+
+# 语句开头的 token -> 语句分析函数
+STATEMENTS = make_table(expr_stat, {
+    'var': define_stat,
+    'id': id_stat,
+    'print': print_stat,
+    'if': if_stat,
+    'while': while_stat,
+    'for': for_stat,
+    'break': break_stat,
+    'continue': continue_stat,
+    'return': return_stat,
+    'fun': fun_or_expr_stat,
+    '{': block_stat,
+})
+
+# 前缀: token -> (右绑定力, 分析函数)
+PREFIX = make_table((0, illegal), {
+    'id': (100, literal),
+    'num': (100, literal),
+    'str': (100, literal),
+    'true': (100, literal),
+    'false': (100, literal),
+    'null': (100, literal),
+    '-': (85, unary),
+    '!': (85, unary),
+    'fun': (98, fun_expr),
+    '(': (100, parens),
+})
+
+# 中缀: token -> (左绑定力, 右绑定力, 分析函数), 左绑定力为 0 的 token 结束表达式
+INFIX = make_table((0, 0, None), {
+    '^': (88, 87, binary),
+    '*': (80, 81, binary),
+    '/': (80, 81, binary),
+    '+': (70, 71, binary),
+    '-': (70, 71, binary),
+    '>': (60, 61, binary),
+    '>=': (60, 61, binary),
+    '<': (60, 61, binary),
+    '<=': (60, 61, binary),
+    '==': (50, 51, binary),
+    '!=': (50, 51, binary),
+    '&&': (40, 41, binary),
+    '||': (30, 31, binary),
+    '?': (20, 21, ternary),
+    '(': (90, 91, call),
+})
+
+INFIX_BP = [e[0] for e in INFIX]
+
+
+def expr(p, bp=0):
+    kinds = p.kinds
+
+    r_bp, parser = PREFIX[kinds[p.pos]]
+    left = parser(p, r_bp)
+
+    while INFIX_BP[kinds[p.pos]] > bp:
+        _, r_bp, parser = INFIX[kinds[p.pos]]
+        left = parser(p, left, r_bp)
+
+    return left
+
+
+def cilly_parser(tokens, compact=False):
+    """
+    token 列表或 TokenStore 用表驱动的分析器, 没有长度的 token 流交给 cilly_parser_ref 按需读取.
+    compact 为真时返回紧凑形式的 AST (见 compact_ast.py)
+    """
+    if not isinstance(tokens, TokenStore) and not hasattr(tokens, '__len__'):
+        ast = cilly_parser_ref(tokens)
+        return to_compact(ast) if compact else ast
+
+    return program(ParserState(tokens, compact))
+
+
 if __name__ == "__main__":
     from lexical_analyzer import cilly_lexer
 
@@ -1,6 +1,17 @@
 
+import io
+import os
+import random
+import tempfile
+
 import pytest
-from lexical_analyzer import cilly_lexer
+from lexical_analyzer import cilly_lexer, cilly_lexer_ref, cilly_lexer_stream, cilly_lexer_mmap, cilly_token_kinds
+from syntactic_analyzer import cilly_parser, cilly_parser_ref
+from incremental_lexer import IncrementalLexer
+from compile_cache import CompileCache
+import bytecode_file
+from compact_ast import to_compact, to_list, Node, NODE_KINDS
+from vm import cilly_vm_compiler, cilly_vm, cilly_vm_ref
 
 
 def test_var():
@@ -170,5 +181,830 @@ def test_errors():
     assert 'cilly lexer : 第1行第28列 : 期望", 实际eof' in str(excinfo.value)
 
 
+def test_illegal_char():
+    source = "var x = 1;\n  x @ 2;"
+    with pytest.raises(Exception) as excinfo:
+        cilly_lexer(source)
+    assert 'cilly lexer : 第2行第5列 : 非法字符@' in str(excinfo.value)
+
+
+def test_same_as_reference_lexer():
+    source = '''
+    # 注释\r
+    var s = "多行
+    字符串";
+    fun f(a, b) { return a >= b && b != 0 || !(a < 1.5) ? a ^ 2 : -b; }
+    print(f(3, 2.), s);
+    '''
+    assert cilly_lexer(source) == cilly_lexer_ref(source)
+
+
+def test_token_store():
+    tokens = cilly_lexer("var x = 1;\nx >= 2;")
+    assert list(tokens.kinds) == [cilly_token_kinds[t] for t in ['var', 'id', '=', 'num', ';', 'id', '>=', 'num', ';']]
+    assert list(tokens.starts) == [0, 4, 6, 8, 9, 11, 13, 16, 17]
+    assert list(tokens.lengths) == [3, 1, 1, 1, 1, 1, 2, 1, 1]
+    assert tokens.line_column(6) == (2, 3)
+    assert tokens[5] == ['id', 'x', 2, 1]
+    assert tokens.tag(6) == '>='
+
+
+def test_stream_chunk_boundaries():
+    source = 'var abc = 12.5; # 注释\nif (abc >= 1 && "a b" != "") { print(abc); }'
+    expected_tokens = cilly_lexer(source)
+    for size in range(1, len(source) + 1):
+        chunks = [source[i:i + size] for i in range(0, len(source), size)]
+        assert list(cilly_lexer_stream(chunks)) == expected_tokens
+    assert list(cilly_lexer_stream(io.StringIO(source), chunk_size=3)) == expected_tokens
+
+
+def test_stream_errors():
+    source = "var x = \"unfinished string;"
+    with pytest.raises(Exception) as excinfo:
+        list(cilly_lexer_stream(io.StringIO(source), chunk_size=4))
+    assert 'cilly lexer : 第1行第28列 : 期望", 实际eof' in str(excinfo.value)
+
+
+def test_parser_reads_stream():
+    source = "var x = 2 ^ 3 ^ 2; fun f(a) { return a > 0 ? a : -a; } print(f(x));"
+    expected_ast = cilly_parser(cilly_lexer(source))
+    assert cilly_parser(cilly_lexer_stream(io.StringIO(source), chunk_size=5)) == expected_ast
+
+
+def test_parser_same_as_reference():
+    source = '''
+    var x = 2 ^ 3 ^ 2;
+    fun f(a, b) { return a > 0 && !b ? a : -(a + b) * 2; }
+    print(f(x, 1)(2), "s", true, null);
+    if (x >= 1) { x = x - 1; } else while (x) for (var i = 0; i < 3; i = i + 1;) { break; continue; }
+    var g = fun() { return; };
+    '''
+    tokens = cilly_lexer(source)
+    assert cilly_parser(tokens) == cilly_parser_ref(tokens)
+    assert cilly_parser(list(tokens)) == cilly_parser_ref(tokens)
+
+    for source in ['var = 1;', 'print(1;', 'f(1,);', '{ x = 1;', 'x ^;']:
+        tokens = cilly_lexer(source)
+        with pytest.raises(Exception) as expected:
+            cilly_parser_ref(tokens)
+        with pytest.raises(Exception) as excinfo:
+            cilly_parser(tokens)
+        assert str(excinfo.value) == str(expected.value)
+
+
+def test_mmap_lexer():
+    source = '# 中文注释\nvar s = "你好";\nprint(s, 1.5 >= 2);\n'
+    with tempfile.NamedTemporaryFile('wb', suffix='.cilly', delete=False) as f:
+        f.write(source.encode('utf-8'))
+    try:
+        with cilly_lexer_mmap(f.name) as tokens:
+            assert tokens == cilly_lexer(source)
+            assert tokens.starts[0] == len('# 中文注释\n'.encode('utf-8'))
+            assert cilly_parser(tokens) == cilly_parser(cilly_lexer(source))
+        # 关闭后映射释放, 文件可以改写
+        assert tokens.source.closed
+
+        with open(f.name, 'wb') as f2:
+            f2.write('var 变量 = 1;'.encode('utf-8'))
+        with pytest.raises(Exception) as excinfo:
+            cilly_lexer_mmap(f.name)
+        assert 'cilly lexer : 第1行第5列 : 非法字符变' in str(excinfo.value)
+    finally:
+        os.unlink(f.name)
+
+
+def test_lexers_share_token_decoding():
+    # 与 token tag 同名的标识符仍是标识符, 四个词法分析器对同一源码的结果相同
+    source = 'var id = 1; var num = id + 2.5; # 注释\nprint(num, str, eof, "中文", var1 >= 0);\n'
+    expected = [list(t) for t in cilly_lexer_ref(source)]
+    assert [t[:2] for t in expected[1:4]] == [['id', 'id'], ['=', None], ['num', 1]]
+    assert list(cilly_lexer(source)) == expected
+    assert list(cilly_lexer_stream(io.StringIO(source), chunk_size=7)) == expected
+    assert list(IncrementalLexer(source)) == expected
+    with tempfile.NamedTemporaryFile('wb', suffix='.cilly', delete=False) as f:
+        f.write(source.encode('utf-8'))
+    try:
+        with cilly_lexer_mmap(f.name) as tokens:
+            assert list(tokens) == expected
+    finally:
+        os.unlink(f.name)
+
+
+def test_incremental_lexer():
+    source = 'var x = 1;\nfun f(a) { return a >= 2; }\n# 注释\nprint("s", f(x));\n' * 20
+    lexer = IncrementalLexer(source)
+    rng = random.Random(1)
+    pieces = ['x', ' ', '\n', ';', '>', '=', '"', '#', '12', 'var ']
+    for _ in range(300):
+        offset = rng.randint(0, len(source))
+        deleted = rng.randint(0, min(2, len(source) - offset))
+        inserted = rng.choice(pieces)
+        source = source[:offset] + inserted + source[offset + deleted:]
+        try:
+            lexer.edit(offset, deleted, inserted)
+        except Exception as e:
+            with pytest.raises(Exception) as excinfo:
+                cilly_lexer(source)
+            assert str(excinfo.value) == str(e)
+        else:
+            assert list(lexer) == cilly_lexer(source)
+
+    for source in ['var yy = 1;\nprint(yy);\n', 'var yy = 1;\n\nprint(yy, 2);\n']:
+        lexer.update(source)
+        assert lexer.tokens() == cilly_lexer(source)
+
+    # 没有 token 的文本: 空文本、只有空白或注释, 以及删掉所有 token 后再输入
+    for source in ['', ' \n\t', '# 只有注释']:
+        lexer = IncrementalLexer(source)
+        assert list(lexer) == [] and lexer.blocks == []
+        lexer.edit(len(source), 0, '\nvar x = 1;')
+        assert list(lexer) == cilly_lexer(source + '\nvar x = 1;')
+        lexer = IncrementalLexer(source)
+        lexer.update('var x = 1;')
+        assert lexer.tokens() == cilly_lexer('var x = 1;')
+    lexer = IncrementalLexer('# comment only')
+    lexer.edit(3, 0, 'x')
+    assert list(lexer) == [] and lexer.blocks == []
+
+    source = 'var x = 1;\nprint(x);\n'
+    lexer = IncrementalLexer(source)
+    lexer.edit(0, len(source), '')
+    assert list(lexer) == [] and lexer.blocks == []
+    lexer.edit(0, 0, 'print(2);')
+    assert list(lexer) == cilly_lexer('print(2);')
+
+
+def test_compile_cache():
+    source = 'var f = fun(a) { return a + 1; };\nprint(f(2), "s");\n'
+    expected = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    with tempfile.TemporaryDirectory() as directory:
+        cache = CompileCache(directory)
+        assert cache.compile(source) == expected
+        assert cache.compile(source) is cache.compile(source)
+        assert cache.misses == 3
+
+        # 新的缓存对象从磁盘读出, 不再重新编译
+        cache = CompileCache(directory)
+        assert cache.compile(source) == expected
+        assert (cache.disk_hits, cache.misses) == (1, 0)
+
+        # 编译器版本不同时不使用旧缓存
+        assert CompileCache(directory, version='other').get('code', source) is None
+
+        # 大小限制为 0 时任何结果都不留在缓存中
+        cache = CompileCache(directory, memory_limit=0, disk_limit=0)
+        cache.clear()
+        cache.compile(source)
+        assert cache.memory_size == 0 and os.listdir(directory) == []
+
+    # 产生缓存内容的模块导入的本项目模块也都参与编译器版本的哈希
+    import sys
+    from compile_cache import SOURCE_MODULES
+    root = os.path.dirname(os.path.abspath(SOURCE_MODULES[0].__file__))
+    for m in SOURCE_MODULES:
+        for v in vars(m).values():
+            dep = sys.modules.get(getattr(v, '__module__', None)) or v
+            path = getattr(dep, '__file__', None)
+            if path is not None and os.path.dirname(os.path.abspath(path)) == root:
+                assert dep in SOURCE_MODULES, f'{m.__name__} 依赖的 {dep.__name__} 没有参与哈希'
+
+
+def test_compact_ast(capsys):
+    import pickle
+    from eval import cilly_eval
+
+    source = 'var f = fun(a, b) { if (a > b && b != 0) return a - b; else return -a; };\nprint(f(3, 2), "s", true, null);\n'
+    ast = cilly_parser(cilly_lexer(source))
+    compact = to_compact(ast)
+    assert isinstance(compact, Node) and compact.kind == NODE_KINDS['program']
+    assert compact == ast and to_list(compact) == ast and type(to_list(compact)) is list
+    assert pickle.loads(pickle.dumps(compact)) == ast
+
+    # 同名标识符驻留为同一个字符串
+    f_define, print_stat = compact.statements
+    assert f_define.name is print_stat.args[0].fun.value
+    assert print_stat.args[0].fun[1:] == ('f', 2, 7)
+    assert f_define[2] is f_define.expr and f_define[-1] is f_define.expr and print_stat.args[0].fun[3] == 7
+
+    # 语法分析器直接生成紧凑形式, 结果与转换得到的相同, 名字同样驻留
+    direct = cilly_parser(cilly_lexer(source), compact=True)
+    assert isinstance(direct, Node) and direct == compact and to_list(direct) == ast
+    assert direct.statements[0].name is direct.statements[1].args[0].fun.value
+    assert cilly_parser(cilly_lexer_stream(source), compact=True) == compact
+
+    assert cilly_vm_compiler(compact, [], [], []) == cilly_vm_compiler(ast, [], [], [])
+    cilly_eval(ast)
+    expected = capsys.readouterr().out
+    cilly_eval(compact)
+    assert capsys.readouterr().out == expected
+
+
+def test_bytecode_file(capsys, monkeypatch):
+    source = 'var x = 1.5;\n{ var y = x; print(y >= 1, "中文", 123456789012345678901234567890, -7); }\nvar f = fun(a) { return a; };\n'
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'p.cillyc')
+        bytecode_file.dump(path, code, consts, scopes, source)
+        with bytecode_file.load(path, source) as loaded:
+            code2, consts2, scopes2 = loaded
+            assert list(code2) == code and scopes2 == scopes
+            assert consts[:-1] == consts2[:-1] and consts[-1] == consts2[-1]
+        # close() 释放映射, 之后可以改写或删除文件
+        assert loaded.data is None
+        with pytest.raises(ValueError):
+            code2[0]
+        with pytest.raises(ValueError):
+            consts2[-1].code[0]
+        loaded.close()
+
+        # 装入的程序在 cilly_vm 上执行结果相同
+        program = cilly_vm_compiler(cilly_parser(cilly_lexer(source + 'print(f(x), f("s"));')), [], [], [])
+        cilly_vm(*program)
+        expected = capsys.readouterr().out
+        cilly_vm(*bytecode_file.loads(bytecode_file.dumps(*program)))
+        assert capsys.readouterr().out == expected
+
+        with pytest.raises(Exception) as excinfo:
+            bytecode_file.load(path, source + ' ')
+        assert 'cilly bytecode : 字节码文件与源码不一致' in str(excinfo.value)
+
+        # 不给出源码时也拒绝其他版本的编译器生成的文件
+        with monkeypatch.context() as m:
+            m.setattr(bytecode_file, 'compiler_hash', lambda: bytes(32))
+            for source_arg in (None, source):
+                with pytest.raises(Exception) as excinfo:
+                    bytecode_file.load(path, source_arg)
+                assert 'cilly bytecode : 字节码文件由其他版本的编译器生成' in str(excinfo.value)
+
+        data = bytecode_file.dumps(code, consts, scopes)
+        with pytest.raises(Exception) as excinfo:
+            bytecode_file.loads(data[:-1])
+        assert 'cilly bytecode : 文件已损坏' in str(excinfo.value)
+        with pytest.raises(Exception) as excinfo:
+            bytecode_file.loads(b'XXXX' + data[4:])
+        assert 'cilly bytecode : 不是cilly字节码文件' in str(excinfo.value)
+
+        # 源文件旁边的 .cillyc 在源码不变时直接装入
+        source_path = os.path.join(directory, 'p.cilly')
+        with open(source_path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        with bytecode_file.compile_file(source_path) as (code2, _, _):
+            assert list(code2) == code
+        with bytecode_file.compile_file(source_path) as (code2, _, _):
+            assert isinstance(code2, memoryview)
+
+
+def test_vm_imports():
+    import subprocess
+    import sys
+
+    # 虚拟机不依赖解释器, 导入 vm 不导入 eval 和它的内置函数表
+    script = 'import sys, vm; print("eval" in sys.modules, "syntactic_analyzer" in sys.modules)'
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    assert out == 'False False\n'
+
+
+def test_vm_same_as_reference(capsys):
+    source = '''
+    var x = 7;
+    { var y = x * 2 - 1; print(y, y / 2, 2 ^ 10, -y, !true); }
+    if (x > 5 && x != 6 || false) print("a"); else print("b");
+    if (!(x <= 7)) print("c");
+    print(x == 7, x >= 8, x < 8, null, "s");
+    '''
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    cilly_vm_ref(code, consts, scopes)
+    expected = capsys.readouterr().out
+    cilly_vm(code, consts, scopes)
+    assert capsys.readouterr().out == expected
+
+    for code in [[999], [1, 0, 999]]:
+        with pytest.raises(Exception) as expected:
+            cilly_vm_ref(code, [['num', 1]], [])
+        with pytest.raises(Exception) as excinfo:
+            cilly_vm(code, [['num', 1]], [])
+        assert str(excinfo.value) == str(expected.value) == 'cilly vm : 非法opcode: 999'
+
+
+def test_vm_frame_slots(capsys):
+    import vm
+
+    source = '''
+    var x = 7;
+    { var y = x * 2; { var z = y + 1; print(z); } var w = 3; print(y, w); }
+    { var y = 9; print(y, x); }
+    x = x + 1;
+    print(x);
+    '''
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    # 两个并列的块共用槽位, 整个程序只需要 3 个槽位, 块不产生指令
+    assert code[:2] == [vm.ENTER_FRAME, 3]
+    assert scopes == [['x']]
+    assert vm.STORE_LOCAL in code and vm.LOAD_GLOBAL in code
+
+    cilly_vm(code, consts, scopes)
+    assert capsys.readouterr().out == '15 \n14 3 \n9 7 \n8 \n'
+
+    with pytest.raises(Exception) as excinfo:
+        cilly_vm_compiler(cilly_parser(cilly_lexer('{ var y = 1; } print(y);')), [], [], [])
+    assert 'cilly vm compiler : 未定义变量: y' in str(excinfo.value)
+
+
+
+def test_vm_functions(capsys):
+    from vm import CodeObject
+
+    source = '''
+    var fib = fun(n) { if (n <= 1) return n; else return fib(n - 1) + fib(n - 2); };
+    var odd = fun(n) { if (n == 1) return true; else return even(n - 1); };
+    var even = fun(n) { if (n == 0) return true; else return odd(n - 1); };
+    fun add3(a, b, c) { var s = a + b; { var t = s + c; return t; } }
+    var noret = fun() { var z = 1; };
+    print(fib(15), even(100), odd(7), add3(1, 2, 3), noret());
+    '''
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    fib = [c for c in consts if isinstance(c, CodeObject) and c.name == 'fib'][0]
+    # 函数体在自己的代码对象中, 不在主程序的指令里
+    assert (fib.nparams, fib.nlocals) == (1, 1) and fib.max_stack >= 3
+    add3 = [c for c in consts if isinstance(c, CodeObject) and c.name == 'add3'][0]
+    assert (add3.nparams, add3.nlocals) == (3, 5)
+
+    for run in (cilly_vm, cilly_vm_ref):
+        run(code, consts, scopes)
+        assert capsys.readouterr().out == '610 True True 6 None \n'
+
+    for source, msg in [('var f = fun(a) { return a; }; f(1, 2);', '函数f需要1个参数, 实际2个'),
+                        ('var x = 1; x(2);', '调用非函数对象')]:
+        program = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+        for run in (cilly_vm, cilly_vm_ref):
+            with pytest.raises(Exception) as excinfo:
+                run(*program)
+            assert f'cilly vm : {msg}' in str(excinfo.value)
+
+
+def test_vm_nested_loops(capsys):
+    source = '''
+    var sum = 0;
+    var i = 0;
+    while (i < 50) { sum = sum + i; i = i + 1; }
+    print(sum);
+    for (var j = 0; j < 10; j = j + 1;) {
+        var k = j * 2;
+        if (j == 2) continue;
+        { var m = k + 1; if (m > 11) break; }
+        var n = 0;
+        while (true) { n = n + 1; if (n >= j) break; }
+        print(j, n, j > 3 ? "big" : "small");
+    }
+    var f = fun(x) { var r = 0; while (x > 0) { x = x - 1; if (x == 3) continue; r = r + x; } return r; };
+    print(f(5), true ? false ? "a" : "b" : "c");
+    '''
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    for run in (cilly_vm, cilly_vm_ref):
+        run(code, consts, scopes)
+        assert capsys.readouterr().out == '1225 \n0 1 small \n1 1 small \n3 3 small \n4 4 big \n5 5 big \n7 b \n'
+
+    for source, msg in [('break;', 'break不在循环中'),
+                        ('while (true) { var f = fun() { continue; }; }', 'continue不在循环中')]:
+        with pytest.raises(Exception) as excinfo:
+            cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+        assert f'cilly vm compiler : {msg}' in str(excinfo.value)
+
+
+def test_vm_loops(capsys):
+    source = '''
+    var sum = 0;
+    var i = 0;
+    while (i < 50) { sum = sum + i; i = i + 1; }
+    print(sum);
+    for (var j = 0; j < 10; j = j + 1;) {
+        if (j == 2) continue;
+        { var y = j * 2; if (y > 8) break; print(j, y); }
+    }
+    for (var m = 0; m < 3; m = m + 1;) {
+        var k = 0;
+        while (true) { k = k + 1; if (k >= m) break; }
+        print(m, k, m > 1 ? "big" : "small");
+    }
+    var f = fun(n) { var r = 0; while (true) { if (n == 0) return r; r = r + n; n = n - 1; } };
+    print(f(4), f(0) == 0 ? "zero" : "other");
+    '''
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    for run in (cilly_vm, cilly_vm_ref):
+        run(code, consts, scopes)
+        assert capsys.readouterr().out == (
+            '1225 \n0 0 \n1 2 \n3 6 \n4 8 \n0 1 small \n1 1 small \n2 2 big \n10 zero \n')
+
+    # 函数体中的 break 和 continue 不能跳出函数外面的循环
+    for source, msg in [('break;', 'break不在循环中'),
+                        ('while (true) { var f = fun() { continue; }; }', 'continue不在循环中')]:
+        with pytest.raises(Exception) as excinfo:
+            cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+        assert f'cilly vm compiler : {msg}' in str(excinfo.value)
+
+
+def test_vm_optimize(capsys):
+    import vm
+
+    source = '''
+    var x = 1;
+    x = x + 1;
+    print(x);
+    if (x > 1 && x != 0 || false) print("a"); else print("b");
+    while (true) { if (x > 5) break; x = x + 1; }
+    var f = fun(a) { return a > 3 ? "big" : "small"; print(a); };
+    print(f(x), f(1));
+    '''
+    plain = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+    code, consts, scopes = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [], optimize=1)
+    assert len(code) < len(plain[0])
+    # STORE x; LOAD x 换成 DUP_TOP; STORE x, 常量条件和 return 之后的 print 都被删除
+    assert code[2:6] == [vm.LOAD_CONST, 0, vm.DUP_TOP, vm.STORE_GLOBAL]
+    assert vm.cilly_vm_optimize(code) == code
+    vm.cilly_vm_dis(code, consts, scopes)
+    dis = capsys.readouterr().out
+    assert 'LOAD_TRUE' not in dis and 'LOAD_FALSE' not in dis and dis.count('PRINT_ITEM') == 5
+
+    for run in (cilly_vm, cilly_vm_ref):
+        for program in (plain, (code, consts, scopes)):
+            run(*program)
+            assert capsys.readouterr().out == '2 \na \nbig small \n'
+
+    # 跳到 JMP 和常量条件跳转的跳转直接跳到最终目标, 跳到下一条的 JMP 删除
+    code = [vm.JMP, 4, vm.JMP, 6, vm.JMP, 2, vm.LOAD_NULL, vm.POP]
+    assert vm.cilly_vm_optimize(code) == [vm.LOAD_NULL, vm.POP]
+    code = [vm.LOAD_NULL, vm.JMP_FALSE, 3, vm.LOAD_FALSE, vm.JMP_FALSE, 0]
+    assert vm.cilly_vm_optimize(code) == [vm.LOAD_NULL, vm.JMP_FALSE, 0, vm.JMP, 0]
+
+
+
+def test_vm_superinstructions(capsys):
+    import vm
+
+    source = '''
+    var total = 0;
+    var sub = fun(n) { var k = 1; n = n + 2; k = 0; return n - 1 + k; };
+    for (var i = 0; i < 5; i = i + 1;) {
+        if (i == 3) continue;
+        total = total + sub(i) + (i + 10);
+    }
+    print(total, total != 0, total >= 60);
+    '''
+    ast = cilly_parser(cilly_lexer(source))
+    plain = cilly_vm_compiler(ast, [], [], [], optimize=1)
+    code, consts, scopes = cilly_vm_compiler(ast, [], [], [], optimize=2)
+    assert len(code) < len(plain[0])
+    vm.cilly_vm_dis(code, consts, scopes)
+    dis = capsys.readouterr().out
+    for name in ('INC_GLOBAL', 'INC_LOCAL', 'LOAD_LOCAL_CONST_SUB', 'LT_JMP_FALSE', 'EQ_JMP_FALSE'):
+        assert name in dis
+
+    for run in (cilly_vm, cilly_vm_ref):
+        for program in (plain, (code, consts, scopes)):
+            run(*program)
+            assert capsys.readouterr().out == '58 True False \n'
+
+    # 序列中间的指令是跳转目标时不合并
+    code = [vm.LOAD_NULL, vm.JMP_FALSE, 4, vm.BINARY_LT, vm.JMP_FALSE, 0]
+    assert vm.cilly_vm_optimize(code, 2) == code
+
+    counts = vm.opcode_ngrams([plain], 2)
+    capsys.readouterr()
+    assert counts[('LOAD_LOCAL', 'LOAD_CONST')] > 0 and counts.most_common(1)[0][1] >= 4
+
+
+
+def test_register_vm(capsys):
+    from register_vm import VM_BACKENDS, cilly_reg_compiler, cilly_reg_vm, cilly_reg_dis
+
+    source = '''
+    var x = 3;
+    var y = 0;
+    var a = x > 2 && y == 0;
+    a = !a || a;
+    var fib = fun(n) { if (n <= 1) return n; else return fib(n - 1) + fib(n - 2); };
+    fun g(p, q) { var t = p * q; { var u = t - p; return u / 2 + q; } }
+    for (var i = 0; i < 5; i = i + 1;) { if (i == 1) continue; x = x + i; if (x > 10) break; }
+    y = y > 5 ? y : 1 - y;
+    print(x, y, a, fib(10), g(g(1, 2), 3), -x, 2 ^ 5, "s", null);
+    '''
+    ast = cilly_parser(cilly_lexer(source))
+    outputs = []
+    for name, (compiler, run, dis) in VM_BACKENDS.items():
+        run(*compiler(ast, [], [], []))
+        outputs.append(capsys.readouterr().out)
+    assert outputs == ['12 1 True 55 5.5 -12 32 s None \n'] * 2
+
+    code, consts, scopes = cilly_reg_compiler(ast, [], [], [])
+    cilly_reg_dis(code, consts, scopes)
+    dis = capsys.readouterr().out
+    # 局部变量直接作为寄存器参加运算, x = x + i 是一条指令
+    assert '\t MUL r2, r0, r1\n' in dis and 'ADD r0, r0, r' in dis
+    assert 'GET_GLOBAL r' in dis and '(fib)' in dis
+
+    executed = []
+    cilly_reg_vm(code, consts, scopes, trace=lambda code, pc: executed.append(pc))
+    capsys.readouterr()
+    assert len(executed) > len(code) // 4
+
+    with pytest.raises(Exception) as excinfo:
+        cilly_reg_vm(*cilly_reg_compiler(cilly_parser(cilly_lexer('var f = fun(a) { return a; }; f();')), [], [], []))
+    assert 'cilly register vm : 函数f需要1个参数, 实际0个' in str(excinfo.value)
+
+
+def test_vm_profile(capsys):
+    from vm import VMProfile, OPS_NAME, opcode_ngrams
+
+    source = '''
+    var f = fun(n) { if (n < 2) return n; return f(n - 1) + f(n - 2); };
+    var i = 0;
+    while (i < 10) { i = i + 1; }
+    print(f(10), i);
+    '''
+    for level in (0, 2):
+        program = cilly_vm_compiler(cilly_parser(cilly_lexer(source)), [], [], [], optimize=level)
+        profile = VMProfile(timing=level == 2)
+        cilly_vm(*program, profile=profile)
+        assert capsys.readouterr().out == '55 10 \n'
+
+        # 计数与参考实现逐条跟踪的结果一致
+        expected = opcode_ngrams([program], 1)
+        capsys.readouterr()
+        assert {(OPS_NAME[opcode][0],): n for opcode, n in profile.opcodes.items()} == expected
+        assert profile.total() == sum(profile.pcs.values()) == sum(profile.pairs.values()) + 1
+        assert (set(profile.times) == set(profile.opcodes)) == (level == 2)
+
+        code, consts, scopes = program
+        profile.annotate(code, consts, scopes)
+        dis = capsys.readouterr().out
+        # 函数体入口执行 177 次, 循环条件 11 次
+        assert '       177 0\t ' in dis and '        11 ' in dis
+
+        profile.report()
+        report = capsys.readouterr().out
+        assert f'共执行指令 {profile.total()} 条' in report and 'CALL_FUNCTION' in report
+
+
+def test_const_pool(capsys):
+    from vm import CodeObject
+    from register_vm import cilly_reg_compiler, cilly_reg_vm
+
+    source = '''
+    var f = fun() { return 1; };
+    var g = fun() { return 1; };
+    print(1, 1.0, 1, "1", "a", 2.5, "a", 2.5, f() + g());
+    '''
+    ast = cilly_parser(cilly_lexer(source))
+    for compiler, run in ((cilly_vm_compiler, cilly_vm), (cilly_reg_compiler, cilly_reg_vm)):
+        code, consts, scopes = compiler(ast, [], [], [])
+        run(code, consts, scopes)
+        assert capsys.readouterr().out == '1 1.0 1 1 a 2.5 a 2.5 2 \n'
+        # 相同类型相同值的字面量共用一个常量, 1 和 1.0 不合并, 两个函数体相同的函数仍是两个常量
+        literals = [c for c in consts if not isinstance(c, CodeObject)]
+        assert sorted(literals, key=repr) == sorted([1, 1.0, '1', 'a', 2.5], key=repr)
+        assert [type(c) for c in literals if c == 1] == [int, float]
+        assert sum(isinstance(c, CodeObject) for c in consts) == 2
+
+
+def test_compiler_symbol_table(capsys):
+    from register_vm import VM_BACKENDS
+
+    source = '''
+    var x = 1;
+    fun show() { print(x, later(), y); }
+    {
+        var x = 2;
+        { var x = 3; print(x); }
+        print(x);
+        var y = x + 10;
+        print(y);
+    }
+    { var y = 20; print(y); }
+    var later = fun() { return x + 100; };
+    var y = 30;
+    fun shadow(x) { var y = x * 2; { var x = y + 1; return x; } }
+    show();
+    print(shadow(5), x);
+    '''
+    ast = cilly_parser(cilly_lexer(source))
+    for name, (compiler, run, dis) in VM_BACKENDS.items():
+        code, consts, scopes = compiler(ast, [], [], [])
+        # 全局变量按定义顺序排列, 函数中在后面才定义的全局变量也能访问
+        assert scopes == [['x', 'show', 'later', 'y', 'shadow']]
+        run(code, consts, scopes)
+        assert capsys.readouterr().out == '3 \n2 \n12 \n20 \n1 101 30 \n11 1 \n'
+
+        for source, msg in [('var a = 1; var a = 2;', '已定义变量: a'),
+                            ('{ var a = 1; var a = 2; }', '已定义变量: a'),
+                            ('fun f(a, a) { return a; }', '已定义变量: a'),
+                            ('fun f() { return b; }', '未定义变量: b'),
+                            ('{ var b = 1; } print(b);', '未定义变量: b'),
+                            ('{ var b = 1; fun f() { return b; } }', '未定义变量: b')]:
+            with pytest.raises(Exception) as excinfo:
+                compiler(cilly_parser(cilly_lexer(source)), [], [], [])
+            assert msg in str(excinfo.value)
+
+
+def test_closure_eval(capsys):
+    from eval import cilly_eval
+    from closure_eval import cilly_closure_eval
+
+    sources = [
+        'var f = fun(n) { if (n < 2) return n; else return f(n - 1) + f(n - 2); }; print(f(12));',
+        'print(0 && 1, 1 || 2, 2 || 3, !0, !"", -3, 2 ^ 10, 7 / 2, "a" + "b", 1 <= 1, 2 >= 3, 1 != 1);',
+        # 函数调用以调用者的环境为父环境, h 中的 x 遮住了全局的 x
+        'var x = 1; fun g() { return x; } fun h() { var x = 2; return g(); } print(h(), g());',
+        'var i = 0; while (i < 5) { i = i + 1; if (i == 2) continue; if (i == 4) break; print(i); }',
+        'for (var i = 0; i < 3; i = i + 1;) { print(i > 1 ? "big" : "small"); }',
+        # return 不中断块, 函数的值是函数体最后一条语句的值
+        'fun f(n) { if (n > 0) return 1; return 2; } print(f, f(1)); greet("me");',
+        'print(1); { break; }',
+        # 被调函数读写的是调用者的局部变量, 没有传的参数取调用者环境中的同名变量
+        'fun inc() { c = c + 1; } fun outer() { var c = 0; inc(); inc(); return c; } print(outer());',
+        'fun f(a, b) { return b; } var b = 7; print(f(1));',
+        'var a = 1; fun f() { a = 5; var a = 2; a = 3; return a; } print(f(), a);',
+        # 内置函数名可以被参数和变量遮住
+        'fun f(left) { return left; } print(f(1)); var pencolor = 2; forward = 3; print(pencolor, forward);',
+    ]
+    for source in sources:
+        ast = cilly_parser(cilly_lexer(source))
+        result, env = cilly_eval(ast)
+        expected = capsys.readouterr().out
+        for tree in (ast, to_compact(ast)):
+            r, e = cilly_closure_eval(tree)
+            assert capsys.readouterr().out == expected
+            assert r == result and e.variables.keys() == env.variables.keys()
+
+    # 在同一个环境中继续执行, 可以调用 cilly_eval 定义的函数
+    _, env = cilly_eval(cilly_parser(cilly_lexer('var n = 5; fun sq(a) { return a * a; }')))
+    cilly_closure_eval(cilly_parser(cilly_lexer('print(sq(n));')), env)
+    assert capsys.readouterr().out == '25 \n'
+
+    for source, msg in [('print(y);', 'lookup var : 未定义变量y'), ('x = 1;', 'set var : 未定义变量x'),
+                        ('var q = 1; var q = 2;', 'define var : 变量已定义q'),
+                        ('var f = 3; f();', 'cilly eval : 非法函数3')]:
+        with pytest.raises(Exception) as excinfo:
+            cilly_closure_eval(cilly_parser(cilly_lexer(source)))
+        assert msg in str(excinfo.value)
+
+
+def test_builtin_frame(capsys):
+    import math
+    import subprocess
+    import sys
+    from eval import Environment, builtin_frame, register_native_module, cilly_eval, Primitive
+
+    # 环境里不再各自定义内置函数, 执行不用 turtle 的程序不导入 turtle
+    script = ('import sys; from eval import *; '
+              'cilly_eval(cilly_parser(cilly_lexer("fun f(n) { return n; } greet(\\"me\\"); print(f(1));"))); '
+              'print("turtle" in sys.modules)')
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    assert out == 'Hello me\n1 \nFalse\n'
+
+    env = Environment()
+    assert env.variables == {} and env.parent is builtin_frame
+    assert Environment(env).parent is env
+
+    # 模块中的函数第一次调用时才导入, 之后函数值中就是模块中的函数
+    register_native_module('math', ['sqrt'])
+    try:
+        p = builtin_frame.variables['sqrt']
+        assert p.f is not math.sqrt
+        assert cilly_eval(cilly_parser(cilly_lexer('sqrt(16);')))[0] == 4.0
+        assert p.f is math.sqrt
+    finally:
+        del builtin_frame.variables['sqrt']
+
+    # 给内置函数名赋值在最外层环境中定义同名变量, 内置函数表不变
+    _, env = cilly_eval(cilly_parser(cilly_lexer('fun f() { greet = 1; } f(); var left = 2;')))
+    assert env.variables['greet'] == 1 and env.variables['left'] == 2
+    assert isinstance(builtin_frame.variables['greet'], Primitive)
+
+    for f, msg in [(lambda: builtin_frame.define_var('x', 1), 'define var : 不能在内置函数表中定义变量x'),
+                   (lambda: builtin_frame.set_var('greet', 1), 'set var : 不能修改内置函数greet'),
+                   (lambda: Environment().set_var('x', 1), 'set var : 未定义变量x'),
+                   (lambda: Environment().lookup_var('x'), 'lookup var : 未定义变量x')]:
+        with pytest.raises(Exception) as excinfo:
+            f()
+        assert msg in str(excinfo.value)
+
+
+def test_values(capsys):
+    from values import NULL, Proc, Primitive, Function, to_tagged, from_tagged, val
+    from eval import cilly_eval
+    from closure_eval import cilly_closure_eval
+    from register_vm import cilly_reg_compiler, cilly_reg_vm
+
+    # 原来的带标签列表和现在的值可以互相转换
+    for v, t in [(1, ['num', 1]), (2.5, ['num', 2.5]), ('s', ['str', 's']), (True, ['bool', True]),
+                 (False, ['bool', False]), (NULL, ['null', None])]:
+        assert to_tagged(v) == t and from_tagged(t) == v
+    p = from_tagged(['proc', ['a'], ['block', []]])
+    assert isinstance(p, Proc) and to_tagged(p) == ['proc', ['a'], ['block', []]]
+    assert to_tagged(Primitive(print)) == ['primitive', print] and from_tagged(['primitive', print]).f is print
+    assert from_tagged(['num', 3, 1, 5]) == 3
+    assert val(NULL) is None and val(Primitive(print)) is print and val(7) == 7 and val(['num', 7]) == 7
+    assert isinstance(from_tagged(['function', None]), Function)
+    with pytest.raises(TypeError):
+        to_tagged([1])
+
+    # 运算的结果直接是 Python 的值, 各个引擎输出相同
+    source = '''
+    var a = 7; var b = 2.5; var s = "x";
+    fun f(n) { return n > 1 ? n * f(n - 1) : 1; }
+    var t = a > b && !(a == 7.0 || false);
+    var u = f(5) + a / 2 - b ^ 2;
+    print(a, b, s + "y", t, u, null, 1 != 1, -a, a >= 7, b <= 1);
+    '''
+    ast = cilly_parser(cilly_lexer(source))
+    result, env = cilly_eval(ast)
+    expected = capsys.readouterr().out
+    assert expected == '7 2.5 xy False 117.25 None False -7 True False \n'
+    assert result is NULL and env.variables['t'] is False and env.variables['u'] == 117.25
+    assert isinstance(env.variables['f'], Proc)
+
+    cilly_closure_eval(ast)
+    assert capsys.readouterr().out == expected
+    for compiler, run in ((cilly_vm_compiler, cilly_vm), (cilly_vm_compiler, cilly_vm_ref),
+                          (cilly_reg_compiler, cilly_reg_vm)):
+        run(*compiler(ast, [], [], []))
+        assert capsys.readouterr().out == expected
+
+
+def test_cek_eval(capsys):
+    from eval import cilly_eval, Environment, Primitive
+    from cek_eval import cilly_cek_eval, CEKMachine, CHUNK
+
+    sources = [
+        'var f = fun(n) { if (n < 2) return n; else return f(n - 1) + f(n - 2); }; print(f(12));',
+        'print(0 && 1, 1 || 2, 2 || 3, !0, !"", -3, 2 ^ 10, 7 / 2, "a" + "b", 1 <= 1, 2 >= 3, 1 != 1);',
+        'var x = 1; fun g() { return x; } fun h() { var x = 2; return g(); } print(h(), g());',
+        'fun f(n) { if (n > 0) return 1; return 2; } print(f, f(1)); greet("me");',
+        'fun inc() { c = c + 1; } fun outer() { var c = 0; inc(); inc(); return c; } print(outer());',
+        'fun f(a, b) { return b; } var b = 7; print(f(1));',
+        'var a = 1; fun f() { a = 5; var a = 2; a = 3; return a; } print(f(), a);',
+        'fun f(left) { return left; } print(f(1)); var pencolor = 2; forward = 3; print(pencolor, forward);',
+        # 循环的值: break 时是上一次循环体的值, continue 的值会留下来
+        'var i = 0; while (i < 5) { i = i + 1; if (i == 3) break; i * 10; }',
+        'var i = 0; while (i < 5) { i = i + 1; if (i == 5) continue; i; }',
+        'for (var i = 0; i < 4; i = i + 1;) { if (i == 3) break; print(i); i + 100; }',
+        'for (var i = 0; i < 4; i = i + 1;) { if (i == 1) continue; i; }',
+        'print(1); { break; }',
+        '',
+    ]
+    for source in sources:
+        ast = cilly_parser(cilly_lexer(source))
+        result, env = cilly_eval(ast)
+        expected = capsys.readouterr().out
+        for tree in (ast, to_compact(ast)):
+            r, e = cilly_cek_eval(tree)
+            assert capsys.readouterr().out == expected
+            assert r == result and e.variables.keys() == env.variables.keys()
+
+    _, env = cilly_eval(cilly_parser(cilly_lexer('var n = 5; fun sq(a) { return a * a; }')))
+    cilly_cek_eval(cilly_parser(cilly_lexer('print(sq(n));')), env)
+    assert capsys.readouterr().out == '25 \n'
+
+    for source, msg in [('print(y);', 'lookup var : 未定义变量y'), ('x = 1;', 'set var : 未定义变量x'),
+                        ('var q = 1; var q = 2;', 'define var : 变量已定义q'),
+                        ('fun f() { var q = 1; var q = 2; } f();', 'define var : 变量已定义q'),
+                        ('var f = 3; f();', 'cilly eval : 非法函数3')]:
+        with pytest.raises(Exception) as excinfo:
+            cilly_cek_eval(cilly_parser(cilly_lexer(source)))
+        assert msg in str(excinfo.value)
+
+    # 递归深度远远超过 Python 的递归限制
+    deep = cilly_parser(cilly_lexer('fun sum(n) { return n == 0 ? 0 : n + sum(n - 1); } print(sum(20000));'))
+    with pytest.raises(RecursionError):
+        cilly_eval(deep)
+    capsys.readouterr()
+    cilly_cek_eval(deep)
+    assert capsys.readouterr().out == '200010000 \n'
+
+    # 限定步数执行和单步执行, 停下后继续执行结果不变
+    machine = CEKMachine(cilly_parser(cilly_lexer('var i = 0; while (i < 3) { print(i); i = i + 1; }')))
+    steps = 1
+    while not machine.step():
+        steps += 1
+    assert capsys.readouterr().out == '0 \n1 \n2 \n' and machine.env.variables['i'] == 3
+    machine = CEKMachine(deep)
+    assert not machine.run(max_steps=steps) and not machine.run(max_steps=CHUNK * 3 + 1)
+    assert machine.run() and capsys.readouterr().out == '200010000 \n'
+
+    # 执行完毕后再 run 或 step 直接返回 True, 结果不变
+    result = machine.result
+    assert machine.run() and machine.step() and machine.run(max_steps=1)
+    assert machine.result is result and capsys.readouterr().out == ''
+
+    # 原生函数中调用 interrupt(), run 在 CHUNK 步之内返回
+    env = Environment()
+    machine = CEKMachine(cilly_parser(cilly_lexer('var i = 0; stop(); while (i < 100000) i = i + 1;')), env)
+    env.variables['stop'] = Primitive(machine.interrupt)
+    assert not machine.run() and env.variables['i'] < CHUNK
+    assert machine.run() and env.variables['i'] == 100000
+
+
 if __name__ == "__main__":
     pytest.main()
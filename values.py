@@ -0,0 +1,134 @@
+'''
+cilly 的运行时值
+
+数、字符串和布尔值直接是 Python 的 int / float、str 和 bool, 运算不再为结果分配带标签的列表,
+判断真假用 v is True, 不再逐个元素比较列表. null、解释器的函数、原生函数和虚拟机的函数
+是带 __slots__ 的小类. eval.py 和 closure_eval.py 的解释器以及 vm.py 和 register_vm.py 的虚拟机
+都使用这套表示.
+
+mk_num / mk_str / mk_bool / val 仍然可用, val(v) 与原来的 v[1] 一样取出 Python 值, 也接受带标签列表.
+仍然需要 ['num', 1] 这种带标签列表的代码用 to_tagged / from_tagged 转换.
+'''
+
+
+class Null:
+    """null, 只有 NULL 一个实例"""
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'None'
+
+
+NULL = Null()
+TRUE = True
+FALSE = False
+
+
+class Proc:
+    """解释器中的函数: 参数名列表和函数体的 ast"""
+    __slots__ = ('params', 'body')
+
+    def __init__(self, params, body):
+        self.params = params
+        self.body = body
+
+    def __repr__(self):
+        return f'<proc {self.params}>'
+
+
+class Primitive:
+    """用 Python 函数实现的原生函数, 参数和返回值都是 cilly 的值"""
+    __slots__ = ('f',)
+
+    def __init__(self, f):
+        self.f = f
+
+    def __repr__(self):
+        return f'<primitive {self.f}>'
+
+
+class Function:
+    """虚拟机中的函数, code 是 vm.CodeObject"""
+    __slots__ = ('code',)
+
+    def __init__(self, code):
+        self.code = code
+
+    def __repr__(self):
+        return f'<function {self.code.name}>'
+
+
+def mk_num(i):
+    return i
+
+
+def mk_str(s):
+    return s
+
+
+def mk_bool(b):
+    return True if b else False
+
+
+def mk_proc(params, body):
+    return Proc(params, body)
+
+
+def mk_primitive(f):
+    return Primitive(f)
+
+
+def val(v):
+    """v 对应的 Python 值: null 是 None, 函数是参数列表, 原生函数是 Python 函数, 虚拟机的函数是代码对象
+
+    cilly 的值不会是列表, 所以 v 是列表时当作带标签的值取 v[1], 仍然使用带标签列表的代码可以照常调用.
+    """
+    if v is NULL:
+        return None
+    if isinstance(v, Proc):
+        return v.params
+    if isinstance(v, Primitive):
+        return v.f
+    if isinstance(v, Function):
+        return v.code
+    if type(v) is list:
+        return v[1]
+    return v
+
+
+def to_tagged(v):
+    """转换成原来的带标签列表, 如 ['num', 1], ['bool', True], ['proc', params, body]"""
+    if v is NULL:
+        return ['null', None]
+    if isinstance(v, bool):
+        return ['bool', v]
+    if isinstance(v, (int, float)):
+        return ['num', v]
+    if isinstance(v, str):
+        return ['str', v]
+    if isinstance(v, Proc):
+        return ['proc', v.params, v.body]
+    if isinstance(v, Primitive):
+        return ['primitive', v.f]
+    if isinstance(v, Function):
+        return ['function', v.code]
+    raise TypeError(f'不是 cilly 的值: {v!r}')
+
+
+def from_tagged(t):
+    """to_tagged 的逆变换, 也接受 ast 中带行号列号的 num / str 节点"""
+    tag = t[0]
+    if tag in ('num', 'str', 'bool'):
+        return t[1]
+    if tag == 'null':
+        return NULL
+    if tag == 'proc':
+        return Proc(t[1], t[2])
+    if tag == 'primitive':
+        return Primitive(t[1])
+    if tag == 'function':
+        return Function(t[1])
+    raise TypeError(f'不是带标签的 cilly 值: {t!r}')
@@ -1,8 +1,8 @@
+from collections import Counter
+from time import perf_counter_ns
+
 from lexical_analyzer import error
-from eval import mk_num, mk_str, mk_bool, val, NULL, TRUE, FALSE
-from lexical_analyzer import cilly_lexer
-from syntactic_analyzer import cilly_parser
-from eval import cilly_eval
+from values import mk_num, mk_bool, val, NULL, TRUE, FALSE, Function
 
 '''
 very simple stack machine
@@ -107,8 +107,9 @@ LOAD_NULL = 2
 LOAD_TRUE = 3
 LOAD_FALSE = 4
 
-LOAD_VAR = 5
-STORE_VAR = 6
+# 读写当前函数栈帧中的槽位, 操作数是槽位号
+LOAD_LOCAL = 5
+STORE_LOCAL = 6
 
 PRINT_ITEM = 7
 PRINT_NEWLINE = 8
@@ -119,8 +120,15 @@ JMP_FALSE = 11
 
 POP = 12
 
-ENTER_SCOPE = 13
-LEAVE_SCOPE = 14
+# 复制栈顶, 窥孔优化把 STORE x; LOAD x 换成 DUP_TOP; STORE x
+DUP_TOP = 14
+
+# 把当前栈帧扩充到操作数个槽位, 只在程序和函数入口执行一次, 块不再产生指令
+ENTER_FRAME = 13
+
+# 读写最外层程序栈帧中的槽位, 即全局变量
+LOAD_GLOBAL = 15
+STORE_GLOBAL = 16
 
 UNARY_NEG = 101
 UNARY_NOT = 102
@@ -142,6 +150,17 @@ MAKE_FUNCTION = 20
 CALL_FUNCTION = 21
 RETURN = 22
 
+# 超级指令, 由优化级别 2 把常见的指令序列合并而成, 按 opcode_ngrams 统计的执行频率选出
+LOAD_LOCAL_CONST = 30        # LOAD_LOCAL x; LOAD_CONST c
+LOAD_LOCAL_CONST_ADD = 31    # LOAD_LOCAL x; LOAD_CONST c; BINARY_ADD
+LOAD_LOCAL_CONST_SUB = 32    # LOAD_LOCAL x; LOAD_CONST c; BINARY_SUB
+INC_LOCAL = 33               # LOAD_LOCAL x; LOAD_CONST c; BINARY_ADD; STORE_LOCAL x
+INC_GLOBAL = 34              # LOAD_GLOBAL x; LOAD_CONST c; BINARY_ADD; STORE_GLOBAL x
+LT_JMP_FALSE = 35            # BINARY_LT; JMP_FALSE t
+GE_JMP_FALSE = 36            # BINARY_GE; JMP_FALSE t
+EQ_JMP_FALSE = 37            # BINARY_EQ; JMP_FALSE t
+NE_JMP_FALSE = 38            # BINARY_NE; JMP_FALSE t
+
 OPS_NAME = {
     LOAD_CONST: ('LOAD_CONST', 2),
 
@@ -149,16 +168,18 @@ OPS_NAME = {
     LOAD_TRUE: ('LOAD_TRUE', 1),
     LOAD_FALSE: ('LOAD_FALSE', 1),
 
-    LOAD_VAR: ('LOAD_VAR', 3),
-    STORE_VAR: ('STORE_VAR', 3),
+    LOAD_LOCAL: ('LOAD_LOCAL', 2),
+    STORE_LOCAL: ('STORE_LOCAL', 2),
+    LOAD_GLOBAL: ('LOAD_GLOBAL', 2),
+    STORE_GLOBAL: ('STORE_GLOBAL', 2),
 
     PRINT_ITEM: ('PRINT_ITEM', 1),
     PRINT_NEWLINE: ('PRINT_NEWLINE', 1),
 
     POP: ('POP', 1),
+    DUP_TOP: ('DUP_TOP', 1),
 
-    ENTER_SCOPE: ('ENTER_SCOPE', 2),
-    LEAVE_SCOPE: ('LEAVE_SCOPE', 1),
+    ENTER_FRAME: ('ENTER_FRAME', 2),
 
     JMP: ('JMP', 2),
     JMP_TRUE: ('JMP_TRUE', 2),
@@ -180,18 +201,168 @@ OPS_NAME = {
     BINARY_GE: ('BINARY_GE', 1),
 
     MAKE_FUNCTION: ('MAKE_FUNCTION', 2),
-    CALL_FUNCTION: ('CALL_FUNCTION', 1),
+    CALL_FUNCTION: ('CALL_FUNCTION', 2),
     RETURN: ('RETURN', 1),
 
+    LOAD_LOCAL_CONST: ('LOAD_LOCAL_CONST', 3),
+    LOAD_LOCAL_CONST_ADD: ('LOAD_LOCAL_CONST_ADD', 3),
+    LOAD_LOCAL_CONST_SUB: ('LOAD_LOCAL_CONST_SUB', 3),
+    INC_LOCAL: ('INC_LOCAL', 3),
+    INC_GLOBAL: ('INC_GLOBAL', 3),
+    LT_JMP_FALSE: ('LT_JMP_FALSE', 2),
+    GE_JMP_FALSE: ('GE_JMP_FALSE', 2),
+    EQ_JMP_FALSE: ('EQ_JMP_FALSE', 2),
+    NE_JMP_FALSE: ('NE_JMP_FALSE', 2),
+
 }
 
 
-def cilly_vm(code, consts, scopes):
+class CodeObject:
+    """一个函数编译后的结果, 作为常量保存在定义它的代码的常量表中"""
+
+    def __init__(self, code, consts, nparams, nlocals, max_stack, name):
+        self.code = code
+        self.consts = consts
+        self.nparams = nparams
+        # 栈帧的槽位数, 参数占用最前面的 nparams 个
+        self.nlocals = nlocals
+        # 执行函数体时操作数栈最多增加的深度
+        self.max_stack = max_stack
+        self.name = name
+
+    def __eq__(self, other):
+        if not isinstance(other, CodeObject):
+            return NotImplemented
+        return (self.name, self.nparams, self.nlocals, self.max_stack, list(self.code), self.consts) == \
+            (other.name, other.nparams, other.nlocals, other.max_stack, list(other.code), other.consts)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'<code {self.name}>'
+
+
+def const_key(c):
+    """常量表去重用的键: 数和字符串按 (类型, 值), 1 和 1.0 不会合并; 函数的代码对象按身份"""
+    if isinstance(c, CodeObject):
+        return 'code', id(c)
+    return type(c), c
+
+
+class Frame:
+    """一次函数调用: 正在执行的代码对象, 返回后继续执行的 pc, 局部变量槽位, 调用时操作数栈的高度"""
+
+    def __init__(self, code, pc, locals, stack_base):
+        self.code = code
+        self.pc = pc
+        self.locals = locals
+        self.stack_base = stack_base
+
+
+class VMProfile:
+    """cilly_vm 的执行剖面: 每个 opcode, 每个 pc, 每对相继执行的 opcode 的执行次数
+
+    timing 为真时还累计每个 opcode 处理函数的 perf_counter_ns 耗时.
+    pc 的计数按 (id(字节码), pc) 记录, 函数体和主程序的 pc 互不混淆.
+    """
+
+    def __init__(self, timing=False):
+        self.timing = timing
+        self.opcodes = Counter()
+        self.pcs = Counter()
+        self.pairs = Counter()
+        self.times = Counter()
+
+    def total(self):
+        return sum(self.opcodes.values())
+
+    def report(self, top=10):
+        total = self.total()
+        print(f'共执行指令 {total} 条')
+
+        print('\nopcode\t\t\t次数\t占比', end='')
+        print('\t耗时(ns)\t平均(ns)' if self.timing else '')
+        for opcode, n in self.opcodes.most_common():
+            print(f'{OPS_NAME[opcode][0]:<20}\t{n}\t{n * 100 / total:.1f}%', end='')
+            if self.timing:
+                t = self.times[opcode]
+                print(f'\t{t}\t{t / n:.0f}')
+            else:
+                print('')
+
+        print(f'\n最常相继执行的 {top} 对 opcode')
+        for (a, b), n in self.pairs.most_common(top):
+            print(f'{OPS_NAME[a][0]} {OPS_NAME[b][0]}\t{n}')
+
+    def annotate(self, code, consts, var_names):
+        """反汇编, 每条指令前标出它的执行次数"""
+        cilly_vm_dis(code, consts, var_names, counts=self.pcs)
+
+
+# 各条指令对操作数栈高度的影响, CALL_FUNCTION 另外计算
+STACK_EFFECT = {
+    LOAD_CONST: 1, LOAD_NULL: 1, LOAD_TRUE: 1, LOAD_FALSE: 1,
+    LOAD_LOCAL: 1, STORE_LOCAL: -1, LOAD_GLOBAL: 1, STORE_GLOBAL: -1,
+    PRINT_ITEM: -1, PRINT_NEWLINE: 0,
+    JMP: 0, JMP_TRUE: -1, JMP_FALSE: -1,
+    POP: -1, DUP_TOP: 1, ENTER_FRAME: 0,
+    UNARY_NEG: 0, UNARY_NOT: 0,
+    BINARY_ADD: -1, BINARY_SUB: -1, BINARY_MUL: -1, BINARY_DIV: -1, BINARY_MOD: -1, BINARY_POW: -1,
+    BINARY_EQ: -1, BINARY_NE: -1, BINARY_LT: -1, BINARY_GE: -1,
+    MAKE_FUNCTION: 1, RETURN: -1,
+    LOAD_LOCAL_CONST: 2, LOAD_LOCAL_CONST_ADD: 1, LOAD_LOCAL_CONST_SUB: 1, INC_LOCAL: 0, INC_GLOBAL: 0,
+    LT_JMP_FALSE: -2, GE_JMP_FALSE: -2, EQ_JMP_FALSE: -2, NE_JMP_FALSE: -2,
+}
+
+# 操作数是跳转目标的指令
+JUMPS = (JMP, JMP_TRUE, JMP_FALSE, LT_JMP_FALSE, GE_JMP_FALSE, EQ_JMP_FALSE, NE_JMP_FALSE)
+
+
+def max_stack_depth(code):
+    """沿所有跳转路径计算操作数栈的最大深度"""
+    depths = {0: 0}
+    todo = [0]
+    r = 0
+    while todo:
+        pc = todo.pop()
+        depth = depths[pc]
+        while pc < len(code):
+            opcode = code[pc]
+            if opcode == CALL_FUNCTION:
+                # 弹出函数和参数, 压入返回值
+                depth = depth - code[pc + 1]
+            else:
+                depth = depth + STACK_EFFECT[opcode]
+            r = max(r, depth)
+            if opcode in JUMPS:
+                target = code[pc + 1]
+                if target not in depths:
+                    depths[target] = depth
+                    todo.append(target)
+            if opcode in (JMP, RETURN):
+                break
+            pc = pc + OPS_NAME[opcode][1]
+            if pc in depths:
+                break
+            depths[pc] = depth
+    return r
+
+
+def cilly_vm_ref(code, consts, scopes, trace=None):
+    """逐条取指令、查表分派的参考实现, cilly_vm 的执行结果应与它相同
+
+    给出 trace 时每条指令执行前调用 trace(code, pc)
+    """
     def err(msg):
         error('cilly vm', msg)
 
     stack = Stack()
-    call_stack = []  # 用于保存函数调用的返回地址和局部变量
+    call_stack = []  # 调用者的栈帧, 其中的 pc 是返回地址
+
+    # 当前栈帧; 最外层程序的局部变量槽位同时是全局变量表
+    frame = Frame(CodeObject(code, consts, 0, 0, 0, '<program>'), 0, [], 0)
+    slots = frame.locals
+    global_slots = slots
 
     def push(v):
         stack.push(v)
@@ -217,39 +388,26 @@ def cilly_vm(code, consts, scopes):
         push(FALSE)
         return pc + 1
 
-    def load_var(pc):
-        scope_i = code[pc + 1]
-        if scope_i >= len(scopes):
-            err(f'作用域索引超出访问: {scope_i}')
-        scope = scopes[-scope_i - 1]
-        index = code[pc + 2]
-        if index >= len(scope):
-            err(f'load_var变量索引超出范围:{index}')
-        push(scope[index])
-        return pc + 3
+    def load_local(pc):
+        push(slots[code[pc + 1]])
+        return pc + 2
 
-    def store_var(pc):
-        scope_i = code[pc + 1]
-        if scope_i >= len(scopes):
-            err(f'作用域索引超出访问: {scope_i}')
-        scope = scopes[-scope_i - 1]
-        index = code[pc + 2]
-        if index >= len(scope):
-            err(f'store_var变量索引超出范围:{index}')
-        scope[index] = pop()
-        return pc + 3
+    def store_local(pc):
+        slots[code[pc + 1]] = pop()
+        return pc + 2
 
-    def enter_scope(pc):
-        var_count = code[pc + 1]
-        scope = [NULL for _ in range(var_count)]
-        nonlocal scopes
-        scopes = scopes + [scope]
+    def load_global(pc):
+        push(global_slots[code[pc + 1]])
         return pc + 2
 
-    def leave_scope(pc):
-        nonlocal scopes
-        scopes = scopes[:-1]
-        return pc + 1
+    def store_global(pc):
+        global_slots[code[pc + 1]] = pop()
+        return pc + 2
+
+    def enter_frame(pc):
+        slot_count = code[pc + 1]
+        slots.extend([NULL] * (slot_count - len(slots)))
+        return pc + 2
 
     def print_item(pc):
         v = val(pop())
@@ -264,20 +422,24 @@ def cilly_vm(code, consts, scopes):
         pop()
         return pc + 1
 
+    def dup_top(pc):
+        push(stack.top())
+        return pc + 1
+
     def jmp(pc):
         target = code[pc + 1]
         return target
 
     def jmp_true(pc):
         target = code[pc + 1]
-        if pop() == TRUE:
+        if pop() is TRUE:
             return target
         else:
             return pc + 2
 
     def jmp_false(pc):
         target = code[pc + 1]
-        if pop() == FALSE:
+        if pop() is FALSE:
             return target
         else:
             return pc + 2
@@ -324,53 +486,98 @@ def cilly_vm(code, consts, scopes):
     def make_function(pc):
         index = code[pc + 1]
         fun_code = consts[index]
-        push(['function', fun_code])
+        push(Function(fun_code))
         return pc + 2
 
+    def load_local_const(pc):
+        push(slots[code[pc + 1]])
+        push(consts[code[pc + 2]])
+        return pc + 3
+
+    def load_local_const_op(pc):
+        v1 = val(slots[code[pc + 1]])
+        v2 = val(consts[code[pc + 2]])
+        if code[pc] == LOAD_LOCAL_CONST_ADD:
+            push(mk_num(v1 + v2))
+        else:
+            push(mk_num(v1 - v2))
+        return pc + 3
+
+    def inc_var(pc):
+        var_slots = slots if code[pc] == INC_LOCAL else global_slots
+        slot = code[pc + 1]
+        var_slots[slot] = mk_num(val(var_slots[slot]) + val(consts[code[pc + 2]]))
+        return pc + 3
+
+    def compare_jmp_false(pc):
+        v2 = val(pop())
+        v1 = val(pop())
+        opcode = code[pc]
+        if opcode == LT_JMP_FALSE:
+            r = v1 < v2
+        elif opcode == GE_JMP_FALSE:
+            r = v1 >= v2
+        elif opcode == EQ_JMP_FALSE:
+            r = v1 == v2
+        else:
+            r = v1 != v2
+        if r:
+            return pc + 2
+        return code[pc + 1]
+
     def call_function(pc):
+        nonlocal frame, code, consts, slots
         arg_count = code[pc + 1]
-        # 获取函数对象
-        fun = pop()
-        if not isinstance(fun, list) or fun[0] != 'function':
+        # 函数在参数下面
+        values = stack.stack
+        base = len(values) - arg_count - 1
+        if base < 0:
+            err('操作数栈中缺少函数和参数')
+        fun = values[base]
+        if not isinstance(fun, Function):
             err('调用非函数对象')
-        # 获取参数
-        args = []
-        for _ in range(arg_count):
-            args.insert(0, pop())
+        fun_code = fun.code
+        if arg_count != fun_code.nparams:
+            err(f'函数{fun_code.name}需要{fun_code.nparams}个参数, 实际{arg_count}个')
+        # 参数就是新栈帧最前面的槽位
+        args = values[base + 1:]
+        del values[base:]
         # 保存当前状态
-        nonlocal scopes
-        call_stack.append((pc + 2, scopes))
-        # 创建新的作用域
-        scopes = [[]]
-        # 设置参数
-        for arg in args:
-            scopes[0].append(arg)
-        # 执行函数代码
-        return 0  # 从函数代码开始处执行
+        frame.pc = pc + 2
+        call_stack.append(frame)
+        frame = Frame(fun_code, 0, args + [NULL] * (fun_code.nlocals - arg_count), base)
+        code, consts, slots = fun_code.code, fun_code.consts, frame.locals
+        # 从函数代码开始处执行
+        return 0
 
     def return_proc(pc):
+        nonlocal frame, code, consts, slots
         if not call_stack:
             err('在非函数上下文中返回')
         # 获取返回值
         ret_val = pop()
+        del stack.stack[frame.stack_base:]
         # 恢复调用前的状态
-        pc, scopes = call_stack.pop()
+        frame = call_stack.pop()
+        code, consts, slots = frame.code.code, frame.code.consts, frame.locals
         # 将返回值压入栈
         push(ret_val)
-        return pc
+        return frame.pc
 
     ops = {
         LOAD_CONST: load_const,
         LOAD_NULL: load_null,
         LOAD_TRUE: load_true,
         LOAD_FALSE: load_false,
-        LOAD_VAR: load_var,
-        STORE_VAR: store_var,
-        ENTER_SCOPE: enter_scope,
-        LEAVE_SCOPE: leave_scope,
+        LOAD_LOCAL: load_local,
+        STORE_LOCAL: store_local,
+        LOAD_GLOBAL: load_global,
+        STORE_GLOBAL: store_global,
+        ENTER_FRAME: enter_frame,
         PRINT_ITEM: print_item,
         PRINT_NEWLINE: print_newline,
         POP: pop_proc,
+        DUP_TOP: dup_top,
         JMP: jmp,
         JMP_TRUE: jmp_true,
         JMP_FALSE: jmp_false,
@@ -389,6 +596,15 @@ def cilly_vm(code, consts, scopes):
         MAKE_FUNCTION: make_function,
         CALL_FUNCTION: call_function,
         RETURN: return_proc,
+        LOAD_LOCAL_CONST: load_local_const,
+        LOAD_LOCAL_CONST_ADD: load_local_const_op,
+        LOAD_LOCAL_CONST_SUB: load_local_const_op,
+        INC_LOCAL: inc_var,
+        INC_GLOBAL: inc_var,
+        LT_JMP_FALSE: compare_jmp_false,
+        GE_JMP_FALSE: compare_jmp_false,
+        EQ_JMP_FALSE: compare_jmp_false,
+        NE_JMP_FALSE: compare_jmp_false,
     }
 
     def get_opcode_proc(opcode):
@@ -401,17 +617,451 @@ def cilly_vm(code, consts, scopes):
         while pc < len(code):
             opcode = code[pc]
             proc = get_opcode_proc(opcode)
+            if trace is not None:
+                trace(code, pc)
             pc = proc(pc)
 
     run()
 
 
+'''
+cilly vm: 预译码的直接线索执行
+
+装入时把平坦的字节码翻译成与 code 等长的处理函数表, 每条指令的操作数和常量都已经绑定在
+处理函数上, 二元运算每个 opcode 一个专门的处理函数. 执行时只剩 pc = ops[pc]().
+处理函数放在指令原来的地址上, 跳转目标和返回地址不用改写.
+'''
+
+
+def cilly_vm(code, consts, scopes, profile=None):
+    """给出 VMProfile 时在翻译时给每个处理函数套上计数的外壳, 不给时没有任何额外开销"""
+
+    def err(msg):
+        error('cilly vm', msg)
+
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    call_stack = []
+
+    frame = Frame(CodeObject(code, consts, 0, 0, 0, '<program>'), 0, [], 0)
+    slots = frame.locals
+    global_slots = slots
+
+    def load_value(v, next_pc):
+        def op():
+            push(v)
+            return next_pc
+        return op
+
+    def load_local(slot, next_pc):
+        def op():
+            push(slots[slot])
+            return next_pc
+        return op
+
+    def store_local(slot, next_pc):
+        def op():
+            slots[slot] = pop()
+            return next_pc
+        return op
+
+    def load_global(slot, next_pc):
+        def op():
+            push(global_slots[slot])
+            return next_pc
+        return op
+
+    def store_global(slot, next_pc):
+        def op():
+            global_slots[slot] = pop()
+            return next_pc
+        return op
+
+    def enter_frame(slot_count, next_pc):
+        def op():
+            slots.extend([NULL] * (slot_count - len(slots)))
+            return next_pc
+        return op
+
+    def print_item(next_pc):
+        def op():
+            print(val(pop()), end=' ')
+            return next_pc
+        return op
+
+    def print_newline(next_pc):
+        def op():
+            print('')
+            return next_pc
+        return op
+
+    def pop_proc(next_pc):
+        def op():
+            pop()
+            return next_pc
+        return op
+
+    def dup_top(next_pc):
+        def op():
+            push(stack[-1])
+            return next_pc
+        return op
+
+    def jmp(target):
+        def op():
+            return target
+        return op
+
+    def jmp_true(target, next_pc):
+        def op():
+            if pop() is TRUE:
+                return target
+            return next_pc
+        return op
+
+    def jmp_false(target, next_pc):
+        def op():
+            if pop() is FALSE:
+                return target
+            return next_pc
+        return op
+
+    def unary_neg(next_pc):
+        def op():
+            push(-pop())
+            return next_pc
+        return op
+
+    def unary_not(next_pc):
+        def op():
+            push(FALSE if pop() else TRUE)
+            return next_pc
+        return op
+
+    def binary_add(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() + v2)
+            return next_pc
+        return op
+
+    def binary_sub(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() - v2)
+            return next_pc
+        return op
+
+    def binary_mul(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() * v2)
+            return next_pc
+        return op
+
+    def binary_div(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() / v2)
+            return next_pc
+        return op
+
+    def binary_mod(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() % v2)
+            return next_pc
+        return op
+
+    def binary_pow(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() ** v2)
+            return next_pc
+        return op
+
+    def binary_eq(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() == v2)
+            return next_pc
+        return op
+
+    def binary_ne(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() != v2)
+            return next_pc
+        return op
+
+    def binary_lt(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() < v2)
+            return next_pc
+        return op
+
+    def binary_ge(next_pc):
+        def op():
+            v2 = pop()
+            push(pop() >= v2)
+            return next_pc
+        return op
+
+    def make_function(fun_code, next_pc):
+        def op():
+            push(Function(fun_code))
+            return next_pc
+        return op
+
+    def load_local_const(slot, v, next_pc):
+        def op():
+            push(slots[slot])
+            push(v)
+            return next_pc
+        return op
+
+    def load_local_const_add(slot, v, next_pc):
+        def op():
+            push(slots[slot] + v)
+            return next_pc
+        return op
+
+    def load_local_const_sub(slot, v, next_pc):
+        def op():
+            push(slots[slot] - v)
+            return next_pc
+        return op
+
+    def inc_local(slot, v, next_pc):
+        def op():
+            slots[slot] = slots[slot] + v
+            return next_pc
+        return op
+
+    def inc_global(slot, v, next_pc):
+        def op():
+            global_slots[slot] = global_slots[slot] + v
+            return next_pc
+        return op
+
+    def lt_jmp_false(target, next_pc):
+        def op():
+            v2 = pop()
+            if pop() < v2:
+                return next_pc
+            return target
+        return op
+
+    def ge_jmp_false(target, next_pc):
+        def op():
+            v2 = pop()
+            if pop() >= v2:
+                return next_pc
+            return target
+        return op
+
+    def eq_jmp_false(target, next_pc):
+        def op():
+            v2 = pop()
+            if pop() == v2:
+                return next_pc
+            return target
+        return op
+
+    def ne_jmp_false(target, next_pc):
+        def op():
+            v2 = pop()
+            if pop() != v2:
+                return next_pc
+            return target
+        return op
+
+    def call_function(arg_count, next_pc):
+        def op():
+            nonlocal frame, slots, ops
+            # 函数在参数下面
+            base = len(stack) - arg_count - 1
+            if base < 0:
+                err('操作数栈中缺少函数和参数')
+            fun = stack[base]
+            if not isinstance(fun, Function):
+                err('调用非函数对象')
+            fun_code = fun.code
+            if arg_count != fun_code.nparams:
+                err(f'函数{fun_code.name}需要{fun_code.nparams}个参数, 实际{arg_count}个')
+            # 参数就是新栈帧最前面的槽位
+            args = stack[base + 1:]
+            del stack[base:]
+            if fun_code.nlocals > arg_count:
+                args.extend([NULL] * (fun_code.nlocals - arg_count))
+            frame.pc = next_pc
+            call_stack.append(frame)
+            frame = Frame(fun_code, 0, args, base)
+            slots = args
+            ops = code_ops(fun_code)
+            return 0
+        return op
+
+    def return_proc():
+        def op():
+            nonlocal frame, slots, ops
+            if not call_stack:
+                err('在非函数上下文中返回')
+            ret_val = pop()
+            del stack[frame.stack_base:]
+            frame = call_stack.pop()
+            slots = frame.locals
+            ops = code_ops(frame.code)
+            push(ret_val)
+            return frame.pc
+        return op
+
+    def illegal(opcode):
+        def op():
+            err(f'非法opcode: {opcode}')
+        return op
+
+    def halt():
+        return -1
+
+    # opcode -> 由 code、consts 和 pc 构造处理函数
+    translators = {
+        LOAD_CONST: lambda code, consts, pc: load_value(consts[code[pc + 1]], pc + 2),
+        LOAD_NULL: lambda code, consts, pc: load_value(NULL, pc + 1),
+        LOAD_TRUE: lambda code, consts, pc: load_value(TRUE, pc + 1),
+        LOAD_FALSE: lambda code, consts, pc: load_value(FALSE, pc + 1),
+        LOAD_LOCAL: lambda code, consts, pc: load_local(code[pc + 1], pc + 2),
+        STORE_LOCAL: lambda code, consts, pc: store_local(code[pc + 1], pc + 2),
+        LOAD_GLOBAL: lambda code, consts, pc: load_global(code[pc + 1], pc + 2),
+        STORE_GLOBAL: lambda code, consts, pc: store_global(code[pc + 1], pc + 2),
+        ENTER_FRAME: lambda code, consts, pc: enter_frame(code[pc + 1], pc + 2),
+        PRINT_ITEM: lambda code, consts, pc: print_item(pc + 1),
+        PRINT_NEWLINE: lambda code, consts, pc: print_newline(pc + 1),
+        POP: lambda code, consts, pc: pop_proc(pc + 1),
+        DUP_TOP: lambda code, consts, pc: dup_top(pc + 1),
+        JMP: lambda code, consts, pc: jmp(code[pc + 1]),
+        JMP_TRUE: lambda code, consts, pc: jmp_true(code[pc + 1], pc + 2),
+        JMP_FALSE: lambda code, consts, pc: jmp_false(code[pc + 1], pc + 2),
+        UNARY_NEG: lambda code, consts, pc: unary_neg(pc + 1),
+        UNARY_NOT: lambda code, consts, pc: unary_not(pc + 1),
+        BINARY_ADD: lambda code, consts, pc: binary_add(pc + 1),
+        BINARY_SUB: lambda code, consts, pc: binary_sub(pc + 1),
+        BINARY_MUL: lambda code, consts, pc: binary_mul(pc + 1),
+        BINARY_DIV: lambda code, consts, pc: binary_div(pc + 1),
+        BINARY_MOD: lambda code, consts, pc: binary_mod(pc + 1),
+        BINARY_POW: lambda code, consts, pc: binary_pow(pc + 1),
+        BINARY_EQ: lambda code, consts, pc: binary_eq(pc + 1),
+        BINARY_NE: lambda code, consts, pc: binary_ne(pc + 1),
+        BINARY_LT: lambda code, consts, pc: binary_lt(pc + 1),
+        BINARY_GE: lambda code, consts, pc: binary_ge(pc + 1),
+        MAKE_FUNCTION: lambda code, consts, pc: make_function(consts[code[pc + 1]], pc + 2),
+        CALL_FUNCTION: lambda code, consts, pc: call_function(code[pc + 1], pc + 2),
+        RETURN: lambda code, consts, pc: return_proc(),
+        LOAD_LOCAL_CONST: lambda code, consts, pc: load_local_const(code[pc + 1], consts[code[pc + 2]], pc + 3),
+        LOAD_LOCAL_CONST_ADD: lambda code, consts, pc: load_local_const_add(code[pc + 1], consts[code[pc + 2]],
+                                                                            pc + 3),
+        LOAD_LOCAL_CONST_SUB: lambda code, consts, pc: load_local_const_sub(code[pc + 1], consts[code[pc + 2]],
+                                                                            pc + 3),
+        INC_LOCAL: lambda code, consts, pc: inc_local(code[pc + 1], consts[code[pc + 2]], pc + 3),
+        INC_GLOBAL: lambda code, consts, pc: inc_global(code[pc + 1], consts[code[pc + 2]], pc + 3),
+        LT_JMP_FALSE: lambda code, consts, pc: lt_jmp_false(code[pc + 1], pc + 2),
+        GE_JMP_FALSE: lambda code, consts, pc: ge_jmp_false(code[pc + 1], pc + 2),
+        EQ_JMP_FALSE: lambda code, consts, pc: eq_jmp_false(code[pc + 1], pc + 2),
+        NE_JMP_FALSE: lambda code, consts, pc: ne_jmp_false(code[pc + 1], pc + 2),
+    }
+
+    def translate(code, consts, pc):
+        opcode = code[pc]
+        if opcode not in translators:
+            return illegal(opcode)
+        return translators[opcode](code, consts, pc)
+
+    if profile is not None:
+        opcode_counts, pc_counts, pair_counts, times = profile.opcodes, profile.pcs, profile.pairs, profile.times
+        # 上一条执行的 opcode
+        prev = None
+
+    def timed(op, opcode):
+        def r():
+            t = perf_counter_ns()
+            next_pc = op()
+            times[opcode] += perf_counter_ns() - t
+            return next_pc
+        return r
+
+    def counted(op, code, pc):
+        opcode = code[pc]
+        key = (id(code), pc)
+        if profile.timing:
+            op = timed(op, opcode)
+
+        def r():
+            nonlocal prev
+            opcode_counts[opcode] += 1
+            pc_counts[key] += 1
+            if prev is not None:
+                pair_counts[(prev, opcode)] += 1
+            prev = opcode
+            return op()
+
+        return r
+
+    def lazy(ops, code, consts, pc):
+        # 跳到操作数所在的地址时, 与参考实现一样把那里的数当作 opcode, 第一次执行时才翻译
+        def op():
+            ops[pc] = translate(code, consts, pc)
+            if profile is not None and code[pc] in translators:
+                ops[pc] = counted(ops[pc], code, pc)
+            return ops[pc]()
+        return op
+
+    # id(代码对象) -> 处理函数表, 每个函数第一次被调用时翻译
+    translated = {}
+
+    def code_ops(code_obj):
+        r = translated.get(id(code_obj))
+        if r is not None:
+            return r
+
+        code, consts = code_obj.code, code_obj.consts
+        n = len(code)
+        # 执行到代码末尾时停机
+        r = [None] * n + [halt]
+        pc = 0
+        while pc < n:
+            opcode = code[pc]
+            if opcode not in translators:
+                break
+            r[pc] = translate(code, consts, pc)
+            if profile is not None:
+                r[pc] = counted(r[pc], code, pc)
+            pc = pc + OPS_NAME[opcode][1]
+        for i in range(n):
+            if r[i] is None:
+                r[i] = lazy(r, code, consts, i)
+
+        translated[id(code_obj)] = r
+        return r
+
+    ops = code_ops(frame.code)
+    pc = 0
+    while pc >= 0:
+        pc = ops[pc]()
+
 '''
 cilly vm反汇编器
 '''
 
 
-def cilly_vm_dis(code, consts, var_names):
+# 第二个操作数是常量下标的超级指令
+CONST_OPERAND2 = (LOAD_LOCAL_CONST, LOAD_LOCAL_CONST_ADD, LOAD_LOCAL_CONST_SUB, INC_LOCAL, INC_GLOBAL)
+
+
+def cilly_vm_dis(code, consts, var_names, counts=None):
+    """counts 是 VMProfile.pcs 时每条指令前打印它的执行次数"""
+
     def err(msg):
         error('cilly vm disassembler', msg)
 
@@ -419,6 +1069,8 @@ def cilly_vm_dis(code, consts, var_names):
 
     while pc < len(code):
         opcode = code[pc]
+        if counts is not None:
+            print(f'{counts.get((id(code), pc), 0):>10} ', end='')
 
         if opcode == LOAD_CONST:
             index = code[pc + 1]
@@ -428,24 +1080,22 @@ def cilly_vm_dis(code, consts, var_names):
             else:
                 print(f'{pc}\t LOAD_CONST {index} (invalid index)')
             pc = pc + 2
-        elif opcode == LOAD_VAR:
-            scope_i = code[pc + 1]
-            index = code[pc + 2]
-            if scope_i < len(var_names) and index < len(var_names[-scope_i - 1]):
-                var_name = var_names[-scope_i - 1][index]
-                print(f'{pc}\t LOAD_VAR {scope_i} {index} ({var_name})')
-            else:
-                print(f'{pc}\t LOAD_VAR {scope_i} {index}')
+        elif opcode in CONST_OPERAND2:
+            # 超级指令的第二个操作数是常量下标
+            name = OPS_NAME[opcode][0]
+            slot, index = code[pc + 1], code[pc + 2]
+            v = consts[index] if index < len(consts) else 'invalid index'
+            print(f'{pc}\t {name} {slot} {index} ({v})')
             pc = pc + 3
-        elif opcode == STORE_VAR:
-            scope_i = code[pc + 1]
-            index = code[pc + 2]
-            if scope_i < len(var_names) and index < len(var_names[-scope_i - 1]):
-                var_name = var_names[-scope_i - 1][index]
-                print(f'{pc}\t STORE_VAR {scope_i} {index} ({var_name})')
+        elif opcode in (LOAD_GLOBAL, STORE_GLOBAL):
+            # var_names[0] 是全局变量按槽位排列的名字, 局部变量的槽位只打印编号
+            name = OPS_NAME[opcode][0]
+            slot = code[pc + 1]
+            if len(var_names) > 0 and slot < len(var_names[0]):
+                print(f'{pc}\t {name} {slot} ({var_names[0][slot]})')
             else:
-                print(f'{pc}\t STORE_VAR {scope_i} {index}')
-            pc = pc + 3
+                print(f'{pc}\t {name} {slot}')
+            pc = pc + 2
         elif opcode in OPS_NAME:
             name, size = OPS_NAME[opcode]
 
@@ -461,22 +1111,252 @@ def cilly_vm_dis(code, consts, var_names):
         else:
             err(f'非法opcode:{opcode}')
 
+    # 函数的代码对象在常量表中, 接着反汇编它们
+    for c in consts:
+        if isinstance(c, CodeObject):
+            print(f'\n{c} 参数{c.nparams}个, 槽位{c.nlocals}个, 栈深度{c.max_stack}')
+            cilly_vm_dis(c.code, c.consts, var_names, counts)
+
+
+'''
+cilly vm 窥孔优化
+
+编译完成后在指令序列上反复做下面几种变换, 直到没有变化:
+    跳转穿透        跳到 JMP 的跳转直接跳到它的目标
+    常量条件        LOAD_TRUE/LOAD_FALSE 后面紧跟条件跳转时, 在编译期决定跳不跳
+    存取转发        STORE x; LOAD x 换成 DUP_TOP; STORE x
+    删除无用跳转    跳到下一条指令的 JMP 删除, 条件跳转换成 POP
+    删除死代码      从入口沿所有跳转都到达不了的指令
+每一遍先把跳转目标换成指令下标, 变换后重新排列地址并回填跳转目标.
+优化级别 2 最后再把常见的指令序列合并成超级指令.
+'''
+
+# 写变量的指令 -> 读同一个变量的指令
+STORE_LOAD = {STORE_LOCAL: LOAD_LOCAL, STORE_GLOBAL: LOAD_GLOBAL}
+
+
+def cilly_vm_optimize(code, level=1):
+    """返回优化后的指令列表, 不修改 code"""
+    code = list(code)
+    while True:
+        r = peephole_pass(code)
+        if r == code:
+            break
+        code = r
+    if level >= 2:
+        r = superinstruction_pass(r)
+    return r
+
+
+def decode_insts(code):
+    """解码成 [opcode, 操作数...] 列表, 跳转的操作数换成目标指令的下标, 下标 n 表示代码末尾"""
+    insts = []
+    index = {}
+    pc = 0
+    while pc < len(code):
+        opcode = code[pc]
+        size = OPS_NAME[opcode][1]
+        index[pc] = len(insts)
+        insts.append([opcode, *code[pc + 1:pc + size]])
+        pc = pc + size
+    index[pc] = len(insts)
+    for inst in insts:
+        if inst[0] in JUMPS:
+            inst[1] = index[inst[1]]
+    return insts
+
+
+def encode_insts(insts):
+    """decode_insts 的逆过程, 值为 None 的指令已被删除, 跳到它的跳转落到后面第一条保留下来的指令"""
+    n = len(insts)
+    addrs = [0] * (n + 1)
+    addr = 0
+    for i in range(n):
+        addrs[i] = addr
+        if insts[i] is not None:
+            addr = addr + OPS_NAME[insts[i][0]][1]
+    addrs[n] = addr
+
+    r = []
+    for inst in insts:
+        if inst is None:
+            continue
+        r.extend(inst)
+        if inst[0] in JUMPS:
+            r[-1] = addrs[inst[1]]
+    return r
+
+
+def jump_targets(insts):
+    return {inst[1] for inst in insts if inst is not None and inst[0] in JUMPS}
+
+
+def peephole_pass(code):
+    insts = decode_insts(code)
+    n = len(insts)
+
+    def const_jump_taken(load, jump):
+        return (load == LOAD_TRUE) == (jump == JMP_TRUE)
+
+    def is_const_jump(i):
+        return (i + 1 < n and insts[i] is not None and insts[i + 1] is not None and
+                insts[i][0] in (LOAD_TRUE, LOAD_FALSE) and insts[i + 1][0] in (JMP_TRUE, JMP_FALSE))
+
+    def thread(t):
+        seen = set()
+        while t < n and t not in seen:
+            seen.add(t)
+            if insts[t][0] == JMP:
+                t = insts[t][1]
+            elif is_const_jump(t):
+                t = insts[t + 1][1] if const_jump_taken(insts[t][0], insts[t + 1][0]) else t + 2
+            else:
+                break
+        return t
+
+    for inst in insts:
+        if inst[0] in JUMPS:
+            inst[1] = thread(inst[1])
+
+    # 下面的变换会合并相邻的两条指令, 后一条不能是跳转目标
+    targets = jump_targets(insts)
+
+    for i in range(n):
+        inst = insts[i]
+        if inst is None:
+            continue
+        opcode = inst[0]
+        if is_const_jump(i) and i + 1 not in targets:
+            jump = insts[i + 1]
+            insts[i] = [JMP, jump[1]] if const_jump_taken(opcode, jump[0]) else None
+            insts[i + 1] = None
+        elif (opcode in STORE_LOAD and i + 1 < n and i + 1 not in targets and
+              insts[i + 1] == [STORE_LOAD[opcode], inst[1]]):
+            insts[i] = [DUP_TOP]
+            insts[i + 1] = inst
+        elif opcode == JMP and inst[1] == i + 1:
+            insts[i] = None
+        elif opcode in (JMP_TRUE, JMP_FALSE) and inst[1] == i + 1:
+            insts[i] = [POP]
+
+    # 从入口出发标记能到达的指令, 删除的指令相当于什么都不做, 直接落到下一条
+    reached = [False] * n
+    todo = [0]
+    while todo:
+        i = todo.pop()
+        while i < n and not reached[i]:
+            reached[i] = True
+            if insts[i] is None:
+                i = i + 1
+                continue
+            opcode = insts[i][0]
+            if opcode in JUMPS:
+                todo.append(insts[i][1])
+            if opcode in (JMP, RETURN):
+                break
+            i = i + 1
+    for i in range(n):
+        if not reached[i]:
+            insts[i] = None
+
+    return encode_insts(insts)
+
+
+def fuse_inc(load, const, add, store):
+    # 读写的是同一个变量时才是 x = x + c
+    if load[1] == store[1]:
+        return [INC_LOCAL if load[0] == LOAD_LOCAL else INC_GLOBAL, load[1], const[1]]
+
+
+# (被合并的指令序列, 由序列中的各条指令构造超级指令的函数, 返回 None 时不合并), 长的序列在前
+SUPERINSTRUCTIONS = [
+    ((LOAD_LOCAL, LOAD_CONST, BINARY_ADD, STORE_LOCAL), fuse_inc),
+    ((LOAD_GLOBAL, LOAD_CONST, BINARY_ADD, STORE_GLOBAL), fuse_inc),
+    ((LOAD_LOCAL, LOAD_CONST, BINARY_ADD), lambda load, const, op: [LOAD_LOCAL_CONST_ADD, load[1], const[1]]),
+    ((LOAD_LOCAL, LOAD_CONST, BINARY_SUB), lambda load, const, op: [LOAD_LOCAL_CONST_SUB, load[1], const[1]]),
+    ((LOAD_LOCAL, LOAD_CONST), lambda load, const: [LOAD_LOCAL_CONST, load[1], const[1]]),
+    ((BINARY_LT, JMP_FALSE), lambda op, jump: [LT_JMP_FALSE, jump[1]]),
+    ((BINARY_GE, JMP_FALSE), lambda op, jump: [GE_JMP_FALSE, jump[1]]),
+    ((BINARY_EQ, JMP_FALSE), lambda op, jump: [EQ_JMP_FALSE, jump[1]]),
+    ((BINARY_NE, JMP_FALSE), lambda op, jump: [NE_JMP_FALSE, jump[1]]),
+]
+
+
+def superinstruction_pass(code):
+    insts = decode_insts(code)
+    n = len(insts)
+    # 序列中除第一条以外的指令都不能是跳转目标
+    targets = jump_targets(insts)
+
+    i = 0
+    while i < n:
+        for pattern, fuse in SUPERINSTRUCTIONS:
+            k = len(pattern)
+            seq = insts[i:i + k]
+            if (len(seq) == k and all(inst[0] == opcode for inst, opcode in zip(seq, pattern)) and
+                    not any(j in targets for j in range(i + 1, i + k))):
+                inst = fuse(*seq)
+                if inst is not None:
+                    insts[i:i + k] = [inst] + [None] * (k - 1)
+                    i = i + k - 1
+                    break
+        i = i + 1
+
+    return encode_insts(insts)
+
+
+def opcode_ngrams(programs, n=2):
+    """在 cilly_vm_ref 上执行 programs 中的各个 (code, consts, scopes), 统计连续执行的 n 条指令的次数
+
+    返回 (opcode 名字, ...) -> 次数 的 Counter, 用来挑选值得合并成超级指令的序列.
+    只统计在代码中也前后相邻的指令, 跳转、调用和返回前后的指令不能合并, 不计入统计.
+    """
+    counts = Counter()
+    window = []
+    current = None
+    next_pc = 0
+
+    def trace(code, pc):
+        nonlocal current, next_pc
+        if code is not current or pc != next_pc:
+            current = code
+            window.clear()
+        next_pc = pc + OPS_NAME[code[pc]][1]
+        window.append(OPS_NAME[code[pc]][0])
+        if len(window) > n:
+            del window[0]
+        if len(window) == n:
+            counts[tuple(window)] += 1
+
+    for program in programs:
+        current = None
+        cilly_vm_ref(*program, trace=trace)
+    return counts
+
 
 '''
 Cilly vm compiler
 '''
 
 
-def cilly_vm_compiler(ast, code, consts, scopes):
+def cilly_vm_compiler(ast, code, consts, scopes, optimize=0):
+    """optimize 是优化级别, 0 不优化, 1 对每个函数和主程序做窥孔优化, 2 再合并超级指令"""
     def err(msg):
         error('cilly vm compiler', msg)
 
+    # const_key(常量) -> 常量表中的下标, 与 consts 一起在编译函数体时保存和恢复
+    const_index = {}
+    for i in range(len(consts) - 1, -1, -1):
+        const_index[const_key(consts[i])] = i
+
     def add_const(c):
-        for i in range(len(consts)):
-            if consts[i] == c:
-                return i
-        consts.append(c)
-        return len(consts) - 1
+        key = const_key(c)
+        index = const_index.get(key)
+        if index is None:
+            index = len(consts)
+            consts.append(c)
+            const_index[key] = index
+        return index
 
     def get_next_emit_addr():
         return len(code)
@@ -496,37 +1376,72 @@ def cilly_vm_compiler(ast, code, consts, scopes):
         if operand2 != None:
             code[addr + 2] = operand2
 
+    # scopes 是当前函数中由外到内的各层作用域的变量名, bases 是每层第一个变量的槽位.
+    # 块里的变量依次占用所在函数栈帧中的槽位, 块结束后槽位留给后面的块使用,
+    # frame_size 记录当前函数最多同时用到的槽位数
+    bases = []
+    frame_size = 0
+    # 与 scopes 一一对应的符号表, 每层一个 名字 -> 槽位 的字典, 查找变量时不再逐个比较名字
+    tables = []
+    # 最外层程序的作用域, 其中的变量就是全局变量
+    global_names = []
+    global_table = {}
+    # 当前函数中由外到内的各层循环, 每层是 (break 指令地址, continue 指令地址), 循环结束时回填.
+    # 块不产生指令, break 和 continue 跳出多少层块都只是一条 JMP
+    loops = []
+
     def define_var(name):
-        scope = scopes[-1]
-        for i in range(len(scope)):
-            if scope[i] == name:
-                err(f'已定义变量: {name}')
+        nonlocal frame_size
+        scope, table = scopes[-1], tables[-1]
+        if name in table:
+            err(f'已定义变量: {name}')
+        slot = bases[-1] + len(scope)
         scope.append(name)
-        return len(scope) - 1
+        table[name] = slot
+        frame_size = max(frame_size, slot + 1)
+        return slot
+
+    def declare_var(name):
+        """var 和 fun 语句定义的变量, 全局变量已经在编译程序之前统一定义过了"""
+        if tables[-1] is global_table and name in global_table:
+            return global_table[name]
+        return define_var(name)
 
     def lookup_var(name):
-        for scope_i in range(len(scopes)):
-            scope = scopes[-scope_i - 1]
-            for index in range(len(scope)):
-                if scope[index] == name:
-                    return scope_i, index
-        # 对于前向引用，我们返回全局作用域的索引
-        # 这样在运行时可以访问到后续定义的函数
-        return 0, len(scopes[0]) - 1
+        """返回 (是否全局变量, 槽位)"""
+        for i in range(len(tables) - 1, -1, -1):
+            slot = tables[i].get(name)
+            if slot is not None:
+                return tables[i] is global_table, slot
+        # 函数里可以访问全局变量, 包括在函数之后才定义的
+        slot = global_table.get(name)
+        if slot is None:
+            err(f'未定义变量: {name}')
+        return True, slot
+
+    def emit_store(is_global, slot):
+        emit(STORE_GLOBAL if is_global else STORE_LOCAL, slot)
 
     def compile_program(node):
         _, statements = node
         # 创建全局作用域
-        nonlocal scopes
-        scopes = [[]]  # 初始化全局作用域
+        nonlocal scopes, tables, bases, frame_size
+        scopes = [global_names]
+        tables = [global_table]
+        bases = [0]
+        frame_size = 0
         # 先处理所有变量定义，包括函数定义
         for stmt in statements:
             if stmt[0] == 'define':
                 define_var(stmt[1])
-            elif stmt[0] == 'fun':
+            elif stmt[0] == 'fun_def':
                 define_var(stmt[1])  # 为函数名创建变量
-        # 编译所有语句
-        visit(['block', statements])
+        # 编译所有语句, 全局变量和最外层块的变量都在程序的栈帧中
+        addr = emit(ENTER_FRAME, -1)
+        for s in statements:
+            visit(s)
+        backpatch(addr, frame_size)
+        scopes = [global_names]
 
     def compile_expr_stat(node):
         _, e = node
@@ -549,7 +1464,7 @@ def cilly_vm_compiler(ast, code, consts, scopes):
         elif tag == 'false':
             emit(LOAD_FALSE)
         elif tag in ['num', 'str']:
-            index = add_const(node)
+            index = add_const(node[1])
             emit(LOAD_CONST, index)
 
     def compile_unary(node):
@@ -632,71 +1547,134 @@ def cilly_vm_compiler(ast, code, consts, scopes):
             visit(false_s)
             backpatch(addr2, get_next_emit_addr())
 
+    def compile_while(node):
+        _, cond, body = node
+        start = get_next_emit_addr()
+        visit(cond)
+        addr = emit(JMP_FALSE, -1)
+        loops.append(([], []))
+        visit(body)
+        emit(JMP, start)
+        compile_loop_end(start, addr)
+
+    def compile_for(node):
+        _, init, cond, incr, body = node
+        # 与解释器一样, 初始化语句定义的变量属于 for 所在的作用域
+        visit(init)
+        start = get_next_emit_addr()
+        if cond[0] != 'expr_stat':
+            err(f'for循环条件必须是表达式: {cond[0]}')
+        visit(cond[1])
+        addr = emit(JMP_FALSE, -1)
+        loops.append(([], []))
+        visit(body)
+        incr_addr = get_next_emit_addr()
+        visit(incr)
+        emit(JMP, start)
+        compile_loop_end(incr_addr, addr)
+
+    def compile_loop_end(continue_target, exit_jmp):
+        break_addrs, continue_addrs = loops.pop()
+        for addr in continue_addrs:
+            backpatch(addr, continue_target)
+        end = get_next_emit_addr()
+        backpatch(exit_jmp, end)
+        for addr in break_addrs:
+            backpatch(addr, end)
+
+    def compile_break(node):
+        if not loops:
+            err('break不在循环中')
+        loops[-1][0].append(emit(JMP, -1))
+
+    def compile_continue(node):
+        if not loops:
+            err('continue不在循环中')
+        loops[-1][1].append(emit(JMP, -1))
+
+    def compile_ternary(node):
+        _, cond, true_e, false_e = node
+        visit(cond)
+        addr1 = emit(JMP_FALSE, -1)
+        visit(true_e)
+        addr2 = emit(JMP, -1)
+        backpatch(addr1, get_next_emit_addr())
+        visit(false_e)
+        backpatch(addr2, get_next_emit_addr())
+
     def compile_block(node):
         _, statements = node
-        nonlocal scopes
-        # 创建新的作用域并添加变量名
-        scope = []
-        scopes = scopes + [scope]
-        addr = emit(ENTER_SCOPE, -1)
+        # 块的变量接在外层作用域的槽位之后, 运行时进出块没有任何开销
+        scopes.append([])
+        tables.append({})
+        bases.append(bases[-1] + len(scopes[-2]))
         for s in statements:
             visit(s)
-        emit(LEAVE_SCOPE)
-        backpatch(addr, len(scope))
-        scopes = scopes[:-1]
+        scopes.pop()
+        tables.pop()
+        bases.pop()
 
     def compile_define(node):
         _, name, e = node
-        visit(e)
-        index = define_var(name)
-        # 确保变量名被添加到当前作用域
-        if len(scopes[-1]) <= index:
-            scopes[-1].append(name)
-        emit(STORE_VAR, 0, index)
+        if e[0] == 'fun':
+            # var f = fun(...) {...}; 的函数以变量名命名
+            compile_function(e[1], e[2], name)
+        else:
+            visit(e)
+        slot = declare_var(name)
+        emit_store(scopes[-1] is global_names, slot)
 
     def compile_assign(node):
         _, name, e = node
         visit(e)
-        scope_i, index = lookup_var(name)
-        emit(STORE_VAR, scope_i, index)
+        is_global, slot = lookup_var(name)
+        emit_store(is_global, slot)
 
     def compile_id(node):
         _, name, _, _ = node
-        scope_i, index = lookup_var(name)
-        emit(LOAD_VAR, scope_i, index)
-
-    def compile_fun(node):
-        _, params, body = node
-        # 保存当前作用域
-        nonlocal scopes
-        old_scopes = scopes
-        # 创建新的作用域
+        is_global, slot = lookup_var(name)
+        emit(LOAD_GLOBAL if is_global else LOAD_LOCAL, slot)
+
+    def compile_function(params, body, name):
+        # 保存当前函数的代码、常量和作用域
+        nonlocal code, consts, const_index, scopes, tables, bases, frame_size, loops
+        saved = code, consts, const_index, scopes, tables, bases, frame_size, loops
+        # 函数体编译到自己的代码和常量表中, 有自己的栈帧, 参数占用最前面的槽位
+        code, consts, const_index = [], [], {}
         scopes = [[]]
+        tables = [{}]
+        bases = [0]
+        frame_size = 0
+        # 函数体里的 break 和 continue 不能跳出函数
+        loops = []
         # 为参数创建变量
         for param in params:
             define_var(param)
-        # 保存当前代码长度
-        start_addr = len(code)
         # 编译函数体
         visit(body)
-        # 如果没有显式的return语句，添加一个返回null
-        if code[-1] != RETURN:
-            emit(RETURN)
-        # 获取函数代码
-        fun_code = code[start_addr:]
-        # 恢复原来的作用域
-        scopes = old_scopes
-        # 将函数代码添加到常量表
-        index = add_const(fun_code)
+        # 函数体最后没有 return 时返回 null
+        emit(LOAD_NULL)
+        emit(RETURN)
+        if optimize > 0:
+            code = cilly_vm_optimize(code, optimize)
+        fun = CodeObject(code, consts, len(params), frame_size, max_stack_depth(code), name)
+        # 恢复原来的函数
+        code, consts, const_index, scopes, tables, bases, frame_size, loops = saved
+        # 将函数的代码对象添加到常量表
+        index = add_const(fun)
         emit(MAKE_FUNCTION, index)
 
-    def compile_fun_stat(node):
+    def compile_fun(node):
+        _, params, body = node
+        compile_function(params, body, '<fun>')
+
+    def compile_fun_def(node):
         _, name, params, body = node
         # 编译函数体
-        visit(['fun', params, body])
+        compile_function(params, body, name)
         # 存储函数到变量
-        index = define_var(name)
-        emit(STORE_VAR, 0, index)
+        slot = declare_var(name)
+        emit_store(scopes[-1] is global_names, slot)
 
     def compile_call(node):
         _, fun, args = node
@@ -710,8 +1688,11 @@ def cilly_vm_compiler(ast, code, consts, scopes):
 
     def compile_return(node):
         _, e = node
-        # 编译返回值表达式
-        visit(e)
+        # 编译返回值表达式, return; 返回 null
+        if e is None:
+            emit(LOAD_NULL)
+        else:
+            visit(e)
         # 生成返回指令
         emit(RETURN)
 
@@ -720,6 +1701,11 @@ def cilly_vm_compiler(ast, code, consts, scopes):
         'expr_stat': compile_expr_stat,
         'print': compile_print,
         'if': compile_if,
+        'while': compile_while,
+        'for': compile_for,
+        'break': compile_break,
+        'continue': compile_continue,
+        'ternary': compile_ternary,
         'define': compile_define,
         'assign': compile_assign,
         'block': compile_block,
@@ -732,7 +1718,7 @@ def cilly_vm_compiler(ast, code, consts, scopes):
         'false': compile_literal,
         'null': compile_literal,
         'fun': compile_fun,
-        'fun_stat': compile_fun_stat,
+        'fun_def': compile_fun_def,
         'call': compile_call,
         'return': compile_return,
     }
@@ -745,6 +1731,8 @@ def cilly_vm_compiler(ast, code, consts, scopes):
         v(node)
 
     visit(ast)
+    if optimize > 0:
+        code[:] = cilly_vm_optimize(code, optimize)
     return code, consts, scopes
 
 
@@ -798,31 +1786,38 @@ def cilly_vm_compiler(ast, code, consts, scopes):
 # print("outer x1", x1);
 # '''
 
-p1 = '''
-var odd = fun(n){
-  if(n == 1)
-    return true;
-  else
-   return even(n-1);
-};
-var even = fun(n) {
- if(n==0)
-   return true;
- else
-   return odd(n-1);
-};
-
-print(even(3), odd(3));
-'''
-
-ts = cilly_lexer(p1)
-print("tokens:", ts)
-
-ast = cilly_parser(ts)
-print("ast:", ast)
-
-code, consts, scopes = cilly_vm_compiler(ast, [], [], [])
-print("code:", code)
-print("consts:", consts)
-print("scopes:", scopes)
-cilly_vm_dis(code, consts, scopes)
+if __name__ == "__main__":
+    # 缓存中的代码对象是 vm.CodeObject, 不是 __main__ 中的同名类, 要用 vm 模块中的函数处理它们
+    from compile_cache import default_cache
+    from vm import cilly_vm_dis, cilly_vm
+
+    p1 = '''
+    var odd = fun(n){
+      if(n == 1)
+        return true;
+      else
+       return even(n-1);
+    };
+    var even = fun(n) {
+     if(n==0)
+       return true;
+     else
+       return odd(n-1);
+    };
+
+    print(even(4), odd(3));
+    '''
+
+    # 源码没有改动时 token、ast 和字节码都直接从编译缓存中取出
+    ts = default_cache.tokens(p1)
+    print("tokens:", ts)
+
+    ast = default_cache.ast(p1)
+    print("ast:", ast)
+
+    code, consts, scopes = default_cache.compile(p1)
+    print("code:", code)
+    print("consts:", consts)
+    print("scopes:", scopes)
+    cilly_vm_dis(code, consts, scopes)
+    cilly_vm(code, consts, scopes)